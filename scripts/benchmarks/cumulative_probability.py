@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+__doc__ = """
+Compare the cumulative sum in Cumulative_Probability_Layer to the former masked sum over a
+(B, T, T) tensor: latency and agreement for increasing follow-up horizons.
+"""
+
+from os.path import dirname, realpath
+import sys
+sys.path.append(dirname(dirname(dirname(realpath(__file__)))))
+import argparse
+import timeit
+
+import torch
+
+from sybil.models.cumulative_probability_layer import Cumulative_Probability_Layer
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--max-followups", type=int, nargs="+", default=[6, 10, 15, 50, 200])
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--num-features", type=int, default=512)
+    parser.add_argument("--repeat", type=int, default=200)
+    return parser
+
+
+def masked_sum_forward(layer, x):
+    """Former forward, expanding hazards to (B, T, T) and summing under the mask."""
+    hazards = layer.hazards(x)
+    B, T = hazards.size()
+    masked_hazards = hazards.unsqueeze(-1).expand(B, T, T) * layer.upper_triagular_mask
+    return torch.sum(masked_hazards, dim=1) + layer.base_hazard_fc(x)
+
+
+def main():
+    args = _get_parser().parse_args()
+    print(f"torch {torch.__version__}, {torch.get_num_threads()} threads, batch size {args.batch_size}")
+    print("max_followup  masked sum (ms)  cumsum (ms)  speedup  max abs diff")
+    for max_followup in args.max_followups:
+        layer = Cumulative_Probability_Layer(args.num_features, None, max_followup).eval()
+        x = torch.randn(args.batch_size, args.num_features)
+        with torch.no_grad():
+            diff = (layer(x) - masked_sum_forward(layer, x)).abs().max().item()
+            masked_time = timeit.timeit(lambda: masked_sum_forward(layer, x), number=args.repeat)
+            cumsum_time = timeit.timeit(lambda: layer(x), number=args.repeat)
+        masked_ms = 1000 * masked_time / args.repeat
+        cumsum_ms = 1000 * cumsum_time / args.repeat
+        print(f"{max_followup:>12}  {masked_ms:15.3f}  {cumsum_ms:11.3f}  "
+              f"{masked_ms / cumsum_ms:6.1f}x  {diff:12.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+__doc__ = """
+Benchmark per-slice against whole-volume preprocessing of a synthetic DICOM series.
+"""
+
+from os.path import dirname, join, realpath
+import sys
+sys.path.append(dirname(dirname(dirname(realpath(__file__)))))
+# Synthetic DICOM series writer of the tests
+sys.path.append(join(dirname(dirname(dirname(realpath(__file__)))), "tests"))
+import argparse
+import tempfile
+import time
+
+from sybil.utils.loading import get_sample_loader
+from synthetic import write_dicom_series
+from sybil.loaders.image_loaders import DicomLoader
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-slices", type=int, default=300)
+    parser.add_argument("--size", type=int, default=512)
+    # Serie loads single channel volumes
+    parser.add_argument("--num-chan", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=3)
+    return parser
+
+
+def _time(fn, repeats):
+    best, out = float("inf"), None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def main():
+    cli_args = _get_parser().parse_args()
+    args = argparse.Namespace(
+        img_size=[256, 256], img_mean=[128.1722], img_std=[87.1849], num_chan=cli_args.num_chan,
+        img_file_type="dicom", cache_path=None, use_annotations=False,
+    )
+    volume_loader = get_sample_loader("test", args)
+    slice_loader = DicomLoader(None, volume_loader.augmentations, args)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = write_dicom_series(tmp_dir, cli_args.num_slices, cli_args.size)
+        slice_time, slice_out = _time(
+            lambda: slice_loader.get_volume(paths)["input"], cli_args.repeats
+        )
+        volume_time, volume_out = _time(
+            lambda: volume_loader.get_volume(paths)["input"], cli_args.repeats
+        )
+
+    max_diff = (slice_out - volume_out).abs().max().item()
+    print(
+        f"Series of {cli_args.num_slices} slices of {cli_args.size}x{cli_args.size}, "
+        f"{cli_args.num_chan} channels"
+    )
+    print(f"Per-slice:    {slice_time:.3f}s")
+    print(f"Whole-volume: {volume_time:.3f}s ({slice_time / volume_time:.1f}x)")
+    print(f"Max abs difference: {max_diff}")
+
+
+if __name__ == "__main__":
+    main()
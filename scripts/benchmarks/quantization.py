@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+__doc__ = """
+Compare int8 quantized to fp32 inference: latency and risk score drift per follow-up year.
+Runs on synthetic DICOM series unless directories of DICOM series are given.
+"""
+
+from os.path import dirname, join, realpath
+import sys
+sys.path.append(dirname(dirname(dirname(realpath(__file__)))))
+# Synthetic DICOM series writer of the tests
+sys.path.append(join(dirname(dirname(dirname(realpath(__file__)))), "tests"))
+import argparse
+import glob
+import os
+import tempfile
+import time
+
+import torch
+
+from sybil import Serie, Sybil
+from sybil.models.quantization import score_drift
+from synthetic import write_dicom_series
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model-name", default="sybil_ensemble", help="Model alias or checkpoint path")
+    parser.add_argument("--series-dirs", nargs="*", default=[], help="Directories of DICOM series")
+    parser.add_argument("--calibration-dirs", nargs="*", default=[],
+                        help="Directories of DICOM series to calibrate with, random volumes by default")
+    parser.add_argument("--num-series", type=int, default=2, help="Number of synthetic series")
+    parser.add_argument("--num-slices", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=0)
+    return parser
+
+
+def load_series(dirs):
+    return [Serie(sorted(glob.glob(os.path.join(d, "*"))), file_type="dicom") for d in dirs]
+
+
+def timed_predict(model, series, threads):
+    start = time.perf_counter()
+    prediction = model.predict(series, threads=threads)
+    return prediction, time.perf_counter() - start
+
+
+def main():
+    args = _get_parser().parse_args()
+    model_name = args.model_name
+    if os.path.exists(model_name):
+        model_name = [model_name]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        series_dirs = args.series_dirs
+        if not series_dirs:
+            for i in range(args.num_series):
+                series_dir = os.path.join(tmp_dir, str(i))
+                os.makedirs(series_dir)
+                write_dicom_series(series_dir, args.num_slices, 512, seed=i)
+                series_dirs.append(series_dir)
+        series = load_series(series_dirs)
+        calibration_series = load_series(args.calibration_dirs) or None
+
+        fp32 = Sybil(model_name, device="cpu")
+        start = time.perf_counter()
+        int8 = Sybil(model_name, quantize="int8", calibration_series=calibration_series)
+        quantize_time = time.perf_counter() - start
+
+        # Load the volumes once, so the timings only cover the models
+        for serie in series:
+            serie.get_volume()
+        reference, fp32_time = timed_predict(fp32, series, args.threads)
+        prediction, int8_time = timed_predict(int8, series, args.threads)
+
+    drift = score_drift(reference.scores, prediction.scores)
+    print(f"torch {torch.__version__}, quantized engine {torch.backends.quantized.engine}")
+    print(f"Quantization and calibration: {quantize_time:.1f}s")
+    print(f"Inference on {len(series)} series: fp32 {fp32_time:.1f}s, int8 {int8_time:.1f}s "
+          f"({fp32_time / int8_time:.1f}x)")
+    print("Score drift against fp32:")
+    print("year  mean abs  max abs")
+    for year, (mean_abs, max_abs) in enumerate(zip(drift.mean_abs, drift.max_abs), 1):
+        print(f"{year:>4}  {mean_abs:8.5f}  {max_abs:7.5f}")
+
+
+if __name__ == "__main__":
+    main()
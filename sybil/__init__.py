@@ -19,7 +19,8 @@ finally:
 
 from sybil.model import Sybil
 from sybil.serie import Serie
+from sybil.pool import SybilPool
 from sybil.utils.visualization import visualize_attentions, collate_attentions
 import sybil.utils.logging_utils
 
-__all__ = ["Sybil", "Serie", "visualize_attentions", "collate_attentions", "__version__"]
+__all__ = ["Sybil", "Serie", "SybilPool", "visualize_attentions", "collate_attentions", "__version__"]
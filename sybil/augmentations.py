@@ -34,6 +34,25 @@ def get_augmentations(split: Literal["train", "dev", "test"], args):
     return augmentations
 
 
+def get_volume_augmentations(split: Literal["train", "dev", "test"], args):
+    """
+    Vectorized equivalent of the augmentations from get_augmentations,
+    applied to a whole (N, H, W) volume at once.
+    Returns None if there is no equivalent (random augmentations used in training).
+    """
+    if split == "train":
+        return None
+
+    augmentations = [
+        Scale_3d(args, {}),
+        ToTensor(),
+        Force_Num_Chan_Tensor_3d(args, {}),
+        Normalize_Tensor_3d(args, {}),
+    ]
+
+    return augmentations
+
+
 class Abstract_augmentation(object):
     """
     Abstract-transformer.
@@ -229,3 +248,99 @@ class Force_Num_Chan_Tensor_2d(Abstract_augmentation):
             input_dict["input"] = img.expand(self.args.num_chan, *img.size()[1:])
 
         return input_dict
+
+
+
+class Scale_3d(Abstract_augmentation):
+    """
+    Resize every slice of a (N, H, W) volume to args.img_size.
+    Gives the same result as Scale_2d applied slice by slice.
+    DICOM slices are resized as float64, the type load_input gives them,
+    and the resized volume is float32, the type ToTensor gives.
+    """
+
+    def __init__(self, args, kwargs):
+        super(Scale_3d, self).__init__()
+        assert len(kwargs.keys()) == 0
+        self.width, self.height = args.img_size
+        self.set_cachable(self.width, self.height)
+        # DicomLoader.load_volume gives the windowed slices as uint8
+        self.resize_dtype = np.float64 if args.img_file_type == "dicom" else None
+
+    def _resize(self, volume, interpolation, resize_dtype=None, out_dtype=None):
+        # Resizing slices one by one into a preallocated array is faster than a
+        # single cv2 multi-channel resize of the transposed volume, or than
+        # torch's interpolate, even without converting the slices
+        resize_dtype = resize_dtype or volume.dtype
+        out = np.empty(
+            (volume.shape[0], self.height, self.width), dtype=out_dtype or resize_dtype
+        )
+        resized = np.empty((self.height, self.width), dtype=resize_dtype)
+        for i in range(volume.shape[0]):
+            cv2.resize(
+                volume[i].astype(resize_dtype, copy=False),
+                dsize=(self.width, self.height),
+                dst=resized,
+                interpolation=interpolation,
+            )
+            out[i] = resized
+        return out
+
+    def __call__(self, input_dict, sample=None):
+        input_dict["input"] = self._resize(
+            input_dict["input"], cv2.INTER_LINEAR, self.resize_dtype, np.float32
+        )
+        if input_dict.get("mask", None) is not None:
+            input_dict["mask"] = self._resize(input_dict["mask"], cv2.INTER_NEAREST)
+        return input_dict
+
+
+class Normalize_Tensor_3d(Abstract_augmentation):
+    """
+    Normalizes a (N, C, H, W) volume by channel.
+    Gives the same result as Normalize_Tensor_2d applied slice by slice.
+    Channels expanded from a single one, see Force_Num_Chan_Tensor_3d, are
+    normalized once and stay an expanded view.
+    """
+
+    def __init__(self, args, kwargs):
+        super(Normalize_Tensor_3d, self).__init__()
+        assert len(kwargs) == 0
+        self.mean = torch.Tensor(args.img_mean).view(1, -1, 1, 1)
+        self.std = torch.Tensor(args.img_std).view(1, -1, 1, 1)
+
+    def __call__(self, input_dict, sample=None):
+        img = input_dict["input"]
+        if self.mean.numel() == 1 and img.size(1) > 1 and img.stride(1) == 0:
+            img = img[:, :1].sub(self.mean).div_(self.std).expand_as(img)
+        else:
+            img = img.sub(self.mean).div_(self.std)
+        input_dict["input"] = img
+        return input_dict
+
+
+class Force_Num_Chan_Tensor_3d(Abstract_augmentation):
+    """
+    Convert a gray scale (N, H, W) volume to (N, args.num_chan, H, W).
+    The channels are an expanded view, no data is copied.
+    """
+
+    def __init__(self, args, kwargs):
+        super(Force_Num_Chan_Tensor_3d, self).__init__()
+        assert len(kwargs) == 0
+        self.args = args
+
+    def __call__(self, input_dict, sample=None):
+        img = input_dict["input"]
+        mask = input_dict.get("mask", None)
+        if mask is not None:
+            input_dict["mask"] = mask.unsqueeze(1)
+
+        if len(img.shape) == 3:
+            img = img.unsqueeze(1)
+        N, existing_chan = img.size()[:2]
+        if not existing_chan == self.args.num_chan:
+            img = img.expand(N, self.args.num_chan, *img.size()[2:])
+        input_dict["input"] = img
+
+        return input_dict
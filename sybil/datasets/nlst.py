@@ -599,17 +599,21 @@ class NLST_Survival_Dataset(data.Dataset):
 
         # get images for multi image input
         s = copy.deepcopy(sample)
-        input_dicts = []
-        for e, path in enumerate(paths):
-            if self.args.use_annotations:
+        if self.args.use_annotations:
+            input_dicts = []
+            for e, path in enumerate(paths):
                 s["annotations"] = sample["annotations"][e]
-            input_dicts.append(self.input_loader.get_image(path, s))
+                input_dicts.append(self.input_loader.get_image(path, s))
 
-        images = [i["input"] for i in input_dicts]
-        input_arr = self.reshape_images(images)
-        if self.args.use_annotations:
+            images = [i["input"] for i in input_dicts]
+            input_arr = self.reshape_images(images)
             masks = [i["mask"] for i in input_dicts]
-            mask_arr = self.reshape_images(masks) if self.args.use_annotations else None
+            mask_arr = self.reshape_images(masks)
+        else:
+            # Whole series at once, a single file read when it is cached
+            input_arr = self.input_loader.get_volume(paths, s)["input"]
+            # Convert from (T, C, H, W) to (C, T, H, W)
+            input_arr = input_arr.permute(1, 0, 2, 3)
 
         # resample pixel spacing
         resample_now = self.args.resample_pixel_spacing_prob > np.random.uniform()
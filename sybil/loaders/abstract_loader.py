@@ -1,15 +1,30 @@
 import os
 import sys
 import os.path
+import json
+import sqlite3
+import tempfile
+import threading
+import time
 import warnings
+from typing import NamedTuple
 from sybil.datasets.utils import get_scaled_annotation_mask, IMG_PAD_TOKEN
 from sybil.augmentations import ComposeAug
+from sybil.utils.sqlite_index import EVICTION_LOW_WATER, SQLiteIndex
 import numpy as np
+import torch
 from abc import ABCMeta, abstractmethod
 import hashlib
 
 CACHED_FILES_EXT = ".mha"
+CACHED_SERIES_EXT = ".series.npy"
 DEFAULT_CACHE_DIR = "default/"
+CACHE_INDEX_FILE = "cache_index.sqlite"
+EVICTION_BATCH_SIZE = 64
+# Access times of cache hits are kept in memory, and written to the index
+# once this many are pending or this many seconds after the last write
+ACCESS_FLUSH_SIZE = 256
+ACCESS_FLUSH_INTERVAL = 5.0
 
 CORUPTED_FILE_ERR = (
     "WARNING! Error processing file from cache - removed file from cache. Error: {}"
@@ -77,8 +92,84 @@ def apply_augmentations_and_cache(
     return loaded_input
 
 
-class cache:
-    def __init__(self, path, extension=CACHED_FILES_EXT):
+def apply_augmentations_and_cache_series(
+    input_dicts, sample, img_paths, augmentations, cache, base_key=""
+):
+    """
+    Series version of apply_augmentations_and_cache: applies the augmentations
+    one by one to all slices, and caches the stacked slices after each of the
+    first cachable augmentations as a single file.
+    """
+    all_prev_cachable = True
+    key = base_key
+    for ind, trans in enumerate(augmentations):
+        input_dicts = [trans(input_dict, sample) for input_dict in input_dicts]
+        if not all_prev_cachable or not trans.cachable():
+            all_prev_cachable = False
+        else:
+            key += trans.caching_keys()
+            cache.add_series(
+                img_paths, key, np.stack([d["input"] for d in input_dicts])
+            )
+
+    return input_dicts
+
+
+def read_series_index(path):
+    """
+    Reads the index stored after the array data of a cached series file
+    """
+    with open(path, "rb") as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+        f.seek(int(np.prod(shape)) * dtype.itemsize, os.SEEK_CUR)
+        return json.loads(f.read().decode("utf-8"))
+
+
+class DiskCacheStats(NamedTuple):
+    """
+    Statistics of a loader cache, see SQLiteIndex
+    """
+
+    hits: int
+    misses: int
+    evictions: int
+    num_files: int
+    bytes: int
+
+
+class cache(SQLiteIndex):
+    """
+    On-disk cache of preprocessed images and series.
+
+    Cached files are tracked in a small SQLite index in the cache directory,
+    holding the size and last access time of every file, see SQLiteIndex.
+    Access times of cache hits are written to the index in batches,
+    see flush_access_times.
+
+    Parameters
+    ----------
+    path : str
+        Cache directory.
+    extension : str
+        Extension of the per-image cache files.
+    max_bytes : int, optional
+        Byte budget of the cache. When adding a file takes the cache over
+        the budget, the least recently used files are evicted by a
+        background thread, down to `EVICTION_LOW_WATER` of the budget.
+        The cache is unbounded if None.
+    """
+
+    _runtime_attrs = SQLiteIndex._runtime_attrs + (
+        "_evict_event",
+        "_evictor",
+        "_pending_access",
+    )
+
+    def __init__(self, path, extension=CACHED_FILES_EXT, max_bytes=None):
         if not os.path.exists(path):
             os.makedirs(path)
 
@@ -87,6 +178,184 @@ class cache:
         if ".npy" != extension:
             self.files_extension += ".npy"
 
+        self.max_bytes = max_bytes
+        super().__init__(os.path.join(path, CACHE_INDEX_FILE))
+        self._init_index()
+
+    def _init_runtime(self):
+        super()._init_runtime()
+        self._evict_event = threading.Event()
+        self._evictor = None
+        # Last access time of the files hit since the last flush, by index key
+        self._pending_access = {}
+        self._last_flush = time.time()
+
+    def _init_index(self):
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries "
+            "(path TEXT PRIMARY KEY, size INTEGER NOT NULL, atime REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime)")
+        self._init_totals(self._index_existing_files)
+
+    def _index_existing_files(self, conn):
+        """
+        Tracks the files cached before there was an index, using their
+        modification time as last access time. Returns their total size.
+        """
+        total = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                if not name.endswith(".npy"):
+                    continue
+                stat = os.stat(path)
+                conn.execute(
+                    "INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                    (self._index_key(path), stat.st_size, stat.st_mtime),
+                )
+                total += stat.st_size
+        return total
+
+    def _index_key(self, path):
+        return os.path.relpath(path, self.cache_dir)
+
+    def _record_add(self, path):
+        key = self._index_key(path)
+        size = os.path.getsize(path)
+        with self._transaction() as conn:
+            row = conn.execute("SELECT size FROM entries WHERE path = ?", (key,)).fetchone()
+            old_size = row[0] if row is not None else 0
+            conn.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                (key, size, time.time()),
+            )
+            total = self._add_bytes(conn, size - old_size)
+        if self.max_bytes is not None and total > self.max_bytes:
+            self._schedule_eviction()
+
+    def _record_access(self, path):
+        self._check_pid()
+        now = time.time()
+        with self._lock:
+            self.hits += 1
+            self._pending_access[self._index_key(path)] = now
+            flush = (
+                len(self._pending_access) >= ACCESS_FLUSH_SIZE
+                or now - self._last_flush >= ACCESS_FLUSH_INTERVAL
+            )
+        if flush:
+            self.flush_access_times()
+
+    def flush_access_times(self):
+        """
+        Writes the access times of the cache hits since the last flush to the index,
+        in a single transaction.
+        """
+        self._check_pid()
+        with self._lock:
+            pending, self._pending_access = self._pending_access, {}
+            self._last_flush = time.time()
+        if not pending:
+            return
+
+        missing = []
+        with self._transaction() as conn:
+            for key, atime in pending.items():
+                # A file added again since the hit has a later access time
+                cursor = conn.execute(
+                    "UPDATE entries SET atime = MAX(atime, ?) WHERE path = ?",
+                    (atime, key),
+                )
+                if cursor.rowcount == 0:
+                    missing.append(key)
+        for key in missing:
+            path = os.path.join(self.cache_dir, key)
+            if os.path.isfile(path):
+                self._record_add(path)
+
+    def _record_remove(self, path):
+        key = self._index_key(path)
+        with self._transaction() as conn:
+            row = conn.execute("SELECT size FROM entries WHERE path = ?", (key,)).fetchone()
+            if row is not None:
+                conn.execute("DELETE FROM entries WHERE path = ?", (key,))
+                self._add_bytes(conn, -row[0])
+
+    def record_miss(self):
+        self._count(misses=1)
+
+    def stats(self):
+        """
+        Returns the DiskCacheStats of the cache
+        """
+        self.flush_access_times()
+        num_files, total = (
+            self._connect()
+            .execute("SELECT COUNT(*), (SELECT bytes FROM totals) FROM entries")
+            .fetchone()
+        )
+        with self._lock:
+            return DiskCacheStats(
+                self.hits, self.misses, self.evictions, num_files, total
+            )
+
+    def evict(self, target_bytes=None):
+        """
+        Removes the least recently used files until at most `target_bytes`
+        are cached, by default `EVICTION_LOW_WATER` of `max_bytes`.
+        Returns the number of removed files.
+        """
+        if target_bytes is None:
+            if self.max_bytes is None:
+                return 0
+            target_bytes = int(self.max_bytes * EVICTION_LOW_WATER)
+
+        # Least recently used according to all the hits so far
+        self.flush_access_times()
+        evicted = 0
+        while True:
+            with self._transaction() as conn:
+                total = self._total_bytes(conn)
+                rows = conn.execute(
+                    "SELECT path, size FROM entries ORDER BY atime LIMIT ?",
+                    (EVICTION_BATCH_SIZE,),
+                ).fetchall()
+                if total <= target_bytes or not rows:
+                    break
+                for key, size in rows:
+                    if total <= target_bytes:
+                        break
+                    self._unlink(os.path.join(self.cache_dir, key))
+                    conn.execute("DELETE FROM entries WHERE path = ?", (key,))
+                    total -= size
+                    evicted += 1
+                conn.execute("UPDATE totals SET bytes = ?", (total,))
+
+        self._count(evictions=evicted)
+        return evicted
+
+    def _schedule_eviction(self):
+        self._check_pid()
+        with self._lock:
+            if self._evictor is None or not self._evictor.is_alive():
+                self._evictor = threading.Thread(
+                    target=self._evict_loop, name="sybil-cache-evictor", daemon=True
+                )
+                self._evictor.start()
+        self._evict_event.set()
+
+    def _evict_loop(self):
+        evict_event = self._evict_event
+        while True:
+            evict_event.wait()
+            evict_event.clear()
+            try:
+                self.evict()
+            except sqlite3.Error as e:
+                warnings.warn("Failed to evict files from cache: {}".format(e))
+
     def _file_dir(self, attr_key, par_dir):
         return os.path.join(self.cache_dir, attr_key, par_dir)
 
@@ -106,7 +375,10 @@ class cache:
     def get(self, image_path, attr_key):
         hashed_key = md5(image_path)
         par_dir = self._parent_dir(image_path)
-        return np.load(self._file_path(attr_key, par_dir, hashed_key))
+        path = self._file_path(attr_key, par_dir, hashed_key)
+        image = np.load(path)
+        self._record_access(path)
+        return image
 
     def add(self, image_path, attr_key, image):
         hashed_key = md5(image_path)
@@ -114,13 +386,71 @@ class cache:
         file_dir = self._file_dir(attr_key, par_dir)
         if not os.path.exists(file_dir):
             os.makedirs(file_dir)
-        np.save(self._file_path(attr_key, par_dir, hashed_key), image)
+        path = self._file_path(attr_key, par_dir, hashed_key)
+        np.save(path, image)
+        self._record_add(path)
 
     def rem(self, image_path, attr_key):
         hashed_key = md5(image_path)
         par_dir = self._parent_dir(image_path)
+        self._remove_file(self._file_path(attr_key, par_dir, hashed_key))
+
+    # A series is cached as one .npy file per augmentation key, holding the
+    # stacked (N, H, W) slices followed by a JSON index of the slice paths.
+    # np.load ignores the index, so the slices can be memory-mapped directly.
+    def _series_path(self, image_paths, attr_key):
+        hashed_key = md5("\n".join(image_paths))
+        par_dir = self._parent_dir(image_paths[0])
+        return os.path.join(
+            self.cache_dir, attr_key, par_dir, hashed_key + CACHED_SERIES_EXT
+        )
+
+    def series_exists(self, image_paths, attr_key):
+        return os.path.isfile(self._series_path(image_paths, attr_key))
+
+    def get_series(self, image_paths, attr_key):
+        """
+        Memory-maps the cached slices of a series, of shape (N, H, W).
+        The mapping is copy-on-write: pages are only copied in memory
+        where the volume is written to, and never written back to the cache.
+        """
+        path = self._series_path(image_paths, attr_key)
+        index = read_series_index(path)
+        if index["paths"] != list(image_paths):
+            raise ValueError("Cached series {} has different slices".format(path))
+        volume = np.load(path, mmap_mode="c")
+        self._record_access(path)
+        return volume
+
+    def add_series(self, image_paths, attr_key, volume):
+        path = self._series_path(image_paths, attr_key)
+        file_dir = os.path.dirname(path)
+        if not os.path.exists(file_dir):
+            os.makedirs(file_dir)
+        index = json.dumps({"paths": list(image_paths)}).encode("utf-8")
+        # Write to a temporary file first so readers never see a partial series
+        fd, tmp_path = tempfile.mkstemp(dir=file_dir, suffix=".tmp")
         try:
-            os.remove(self._file_path(attr_key, par_dir, hashed_key))
+            with os.fdopen(fd, "wb") as f:
+                np.lib.format.write_array(f, np.ascontiguousarray(volume))
+                f.write(index)
+            os.replace(tmp_path, path)
+        except Exception:
+            self._unlink(tmp_path)
+            raise
+        self._record_add(path)
+
+    def rem_series(self, image_paths, attr_key):
+        self._remove_file(self._series_path(image_paths, attr_key))
+
+    def _remove_file(self, path):
+        self._unlink(path)
+        self._record_remove(path)
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.remove(path)
         # Don't raise error if file not exists.
         except OSError:
             pass
@@ -129,14 +459,32 @@ class cache:
 class abstract_loader:
     __metaclass__ = ABCMeta
 
-    def __init__(self, cache_path, augmentations, args, apply_augmentations=True):
+    def __init__(
+        self,
+        cache_path,
+        augmentations,
+        args,
+        apply_augmentations=True,
+        volume_augmentations=None,
+    ):
         self.pad_token = IMG_PAD_TOKEN
         self.augmentations = augmentations
         self.args = args
         self.apply_augmentations = apply_augmentations
+        # Whole-volume equivalent of `augmentations`, if there is one
+        self.composed_volume_augmentations = (
+            ComposeAug(volume_augmentations)
+            if volume_augmentations is not None
+            else None
+        )
         if cache_path is not None:
             self.use_cache = True
-            self.cache = cache(cache_path, self.cached_extension)
+            cache_size_gb = getattr(args, "cache_size_gb", None)
+            self.cache = cache(
+                cache_path,
+                self.cached_extension,
+                max_bytes=int(cache_size_gb * 2**30) if cache_size_gb else None,
+            )
             self.split_augmentations = split_augmentations_by_cache(augmentations)
         else:
             self.use_cache = False
@@ -150,14 +498,118 @@ class abstract_loader:
     def load_input3d(self,image):
         pass
 
+    def load_volume3d(self, path):
+        """
+        Loads a 3D file as a single (N, H, W) array, for loaders of 3D files
+        """
+        raise NotImplementedError(
+            "{} does not load 3D files".format(type(self).__name__)
+        )
+
     @property
     @abstractmethod
     def cached_extension(self):
         pass
 
+    def load_volume(self, paths, datasets=None, compact=False):
+        """
+        Loads the slices at `paths` stacked into a single (N, H, W) array.
+        `datasets` are already read files for `paths`, for loaders which can use them.
+        If `compact`, loaders may store the same values in a smaller type,
+        for the volume augmentations.
+        """
+        return {"input": np.stack([self.load_input(path)["input"] for path in paths])}
+
     def configure_path(self, path, sample=None):
         return path
 
+    def _use_volume_augmentations(self):
+        return (
+            self.composed_volume_augmentations is not None
+            and self.apply_augmentations
+            and not self.use_cache
+            and not self.args.use_annotations
+        )
+
+    def get_volume(self, paths, sample=None, datasets=None):
+        """
+        Returns the transformed slices at `paths` as a (N, C, H, W) tensor.
+        Uses the vectorized volume augmentations when possible,
+        otherwise transforms the slices one by one with get_image.
+        `datasets` are already read files for `paths`, passed on to load_volume.
+        """
+        if self.use_cache and not self.args.use_annotations:
+            return self._get_cached_volume(paths, sample, datasets)
+
+        if not self._use_volume_augmentations():
+            input_dicts = [self.get_image(path, sample) for path in paths]
+            return {"input": torch.stack([torch.as_tensor(i["input"]) for i in input_dicts])}
+
+        input_dict = self.load_volume(paths, datasets, compact=True)
+        return self.composed_volume_augmentations(input_dict, sample)
+
+    def _get_cached_volume(self, paths, sample=None, datasets=None):
+        """
+        get_volume using the series cache: the slices are read from a single
+        memory-mapped file if available, and cached as one file if not.
+        """
+        for key, post_augmentations in self.split_augmentations:
+            base_key = (
+                DEFAULT_CACHE_DIR + key
+                if key != DEFAULT_CACHE_DIR
+                else DEFAULT_CACHE_DIR
+            )
+            if self.cache.series_exists(paths, base_key):
+                try:
+                    volume = self.cache.get_series(paths, base_key)
+                    if not self.apply_augmentations:
+                        # The tensor shares the mapped pages, no copy is made
+                        return {"input": torch.from_numpy(volume)}
+                    input_dicts = [{"input": image} for image in volume]
+                    input_dicts = apply_augmentations_and_cache_series(
+                        input_dicts,
+                        sample,
+                        paths,
+                        post_augmentations,
+                        self.cache,
+                        base_key=base_key,
+                    )
+                    return {"input": torch.stack([torch.as_tensor(i["input"]) for i in input_dicts])}
+                except Exception:
+                    warnings.warn(CORUPTED_FILE_ERR.format(sys.exc_info()[0]))
+                    self.cache.rem_series(paths, base_key)
+
+        self.cache.record_miss()
+        all_augmentations = self.split_augmentations[-1][1]
+        input_dicts = [{"input": image} for image in self.load_volume(paths, datasets)["input"]]
+        if self.apply_augmentations:
+            input_dicts = apply_augmentations_and_cache_series(
+                input_dicts,
+                sample,
+                paths,
+                all_augmentations,
+                self.cache,
+                base_key=key,
+            )
+        return {"input": torch.stack([torch.as_tensor(i["input"]) for i in input_dicts])}
+
+    def get_volume3d(self, path, sample=None):
+        """
+        Returns the transformed slices of the 3D file at `path` as a (N, C, H, W) tensor.
+        The file is read once, as a whole.
+        Without volume augmentations, the 2D augmentations are applied slice by slice
+        and nothing is cached (all slices share the same path).
+        """
+        input_dict = self.load_volume3d(path)
+        if self._use_volume_augmentations():
+            return self.composed_volume_augmentations(input_dict, sample)
+
+        slices = [{"input": image} for image in input_dict["input"]]
+        if self.apply_augmentations:
+            augmentations = ComposeAug(self.augmentations)
+            slices = [augmentations(slice_dict, sample) for slice_dict in slices]
+        return {"input": torch.stack([torch.as_tensor(i["input"]) for i in slices])}
+
     ## mha 3d
     def get_image3d(self, path, sample, image):
         """
@@ -209,6 +661,7 @@ class abstract_loader:
                     corrupted_file = self.cache._file_path(key, par_dir, hashed_key)
                     warnings.warn(CORUPTED_FILE_ERR.format(sys.exc_info()[0]))
                     self.cache.rem(input_path, key)
+        self.cache.record_miss()
         all_augmentations = self.split_augmentations[-1][1]
         input_dict = self.load_input3d(image)
         if self.apply_augmentations:
@@ -273,6 +726,7 @@ class abstract_loader:
                     corrupted_file = self.cache._file_path(key, par_dir, hashed_key)
                     warnings.warn(CORUPTED_FILE_ERR.format(sys.exc_info()[0]))
                     self.cache.rem(input_path, key)
+        self.cache.record_miss()
         all_augmentations = self.split_augmentations[-1][1]
         input_dict = self.load_input(input_path)
         if self.apply_augmentations:
@@ -1,3 +1,6 @@
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import os
 from sybil.loaders.abstract_loader import abstract_loader
 import cv2
 import pydicom
@@ -7,6 +10,40 @@ import SimpleITK as sitk
 LOADING_ERROR = "LOADING ERROR! {}"
 
 
+def get_num_io_workers(num_workers=None):
+    """
+    Number of threads to use for reading files.
+    None picks a default based on the number of CPUs, values below 1 mean no threading.
+    """
+    if num_workers is None:
+        # File reading is mostly I/O bound, more threads than this rarely help
+        return min(8, os.cpu_count() or 1)
+    return max(1, num_workers)
+
+
+def parallel_map(fn, items, num_workers=None):
+    """
+    Apply `fn` to every item with a pool of `num_workers` threads.
+    Results are returned in the order of `items`.
+    """
+    items = list(items)
+    num_workers = min(get_num_io_workers(num_workers), len(items))
+    if num_workers <= 1:
+        return [fn(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        return list(executor.map(fn, items))
+
+
+def read_dicoms(paths, num_workers=None, stop_before_pixels=False):
+    """
+    Read the DICOM files at `paths` in parallel, including their (still encoded) pixel data
+    unless `stop_before_pixels`
+    """
+    read = functools.partial(pydicom.dcmread, stop_before_pixels=stop_before_pixels)
+    return parallel_map(read, paths, num_workers)
+
+
 class OpenCVLoader(abstract_loader):
 
     def load_input(self, path):
@@ -26,9 +63,17 @@ class SimpleITKLoader(abstract_loader):
         Loads MHA file as grayscale image
         """
         # image = sitk.ReadImage(path)
-        ar = sitk.GetArrayFromImage(image).astype(np.float64)
-        arr = apply_windowing(ar, -600, 1500)
-        arr = arr//256
+        arr = window_image(sitk.GetArrayViewFromImage(image), -600, 1500)
+        return {"input": arr}
+
+    def load_volume3d(self, path):
+        """
+        Loads a 3D MHA file as a single grayscale (N, H, W) volume
+        """
+        image = sitk.ReadImage(path)
+        # View on the pixel buffer of `image`, no copy until windowing
+        volume = sitk.GetArrayViewFromImage(image)
+        arr = window_image(volume, -600, 1500)
         return {"input": arr}
 
     def load_input(self, path):
@@ -44,10 +89,20 @@ class SimpleITKLoader(abstract_loader):
         return ".mha"
 
 class DicomLoader(abstract_loader):
-    def __init__(self, cache_path, augmentations, args, apply_augmentations=True):
-        super(DicomLoader, self).__init__(cache_path, augmentations, args, apply_augmentations)
+    def __init__(
+        self,
+        cache_path,
+        augmentations,
+        args,
+        apply_augmentations=True,
+        volume_augmentations=None,
+    ):
+        super(DicomLoader, self).__init__(
+            cache_path, augmentations, args, apply_augmentations, volume_augmentations
+        )
         self.window_center = -600
         self.window_width = 1500
+        self.num_workers = getattr(args, "io_workers", 1)
 
     def load_input(self, path):
         try:
@@ -55,10 +110,52 @@ class DicomLoader(abstract_loader):
             # dcm = sitk.GetArrayFromImage(image)
             
             dcm = pydicom.dcmread(path)
-            dcm = apply_modality_lut(dcm.pixel_array, dcm)
-            arr = apply_windowing(dcm, self.window_center, self.window_width)
-            arr = arr//256  # parity with images loaded as 8 bit
-            
+            arr = self._load_windowed(dcm)
+
+        except Exception:
+            raise Exception(LOADING_ERROR.format("COULD NOT LOAD DICOM."))
+        return {"input": arr}
+
+    def _load_windowed(self, dcm, dtype=np.float64):
+        """
+        Windows the pixels of a DICOM slice, quantized to 8 bit and stored as `dtype`.
+        8 and 16 bit pixels rescaled linearly (or not at all) are windowed with a
+        lookup table, others go through apply_modality_lut and apply_windowing.
+        """
+        if not isinstance(dcm, pydicom.Dataset):
+            dcm = pydicom.dcmread(dcm)
+        pixels = dcm.pixel_array
+        if has_windowing_lut(pixels.dtype) and not dcm.get("ModalityLUTSequence"):
+            slope, intercept = None, None
+            if "RescaleSlope" in dcm and "RescaleIntercept" in dcm:
+                slope, intercept = float(dcm.RescaleSlope), float(dcm.RescaleIntercept)
+            lut = windowing_lut(
+                pixels.dtype.str,
+                self.window_center,
+                self.window_width,
+                slope,
+                intercept,
+                out_dtype=np.dtype(dtype).str,
+            )
+            return apply_lut(pixels, lut)
+
+        arr = apply_modality_lut(pixels, dcm)
+        arr = apply_windowing(arr, self.window_center, self.window_width)
+        arr = arr // 256  # parity with images loaded as 8 bit
+        return arr.astype(dtype, copy=False)
+
+    def load_volume(self, paths, datasets=None, compact=False):
+        """
+        Loads and windows a series, decoding the slices in parallel.
+        If given, the already read `datasets` are used instead of reading `paths` again.
+        The windowed values fit in 8 bit, so if `compact` the volume is uint8, 1/8 of
+        the float64 slices of load_input. Scale_3d resizes it as float64, like Scale_2d.
+        """
+        try:
+            sources = datasets if datasets is not None else paths
+            dtype = np.uint8 if compact else np.float64
+            load = functools.partial(self._load_windowed, dtype=dtype)
+            arr = np.stack(parallel_map(load, sources, self.num_workers))
         except Exception:
             raise Exception(LOADING_ERROR.format("COULD NOT LOAD DICOM."))
         return {"input": arr}
@@ -100,3 +197,104 @@ def apply_windowing(image, center, width, bit_size=16):
         image[between] = ((image[between] - c) / w + 0.5) * y_range + y_min
 
     return image
+
+
+
+def window_and_quantize(volume, center, width, bit_size=16):
+    """Window a whole volume and quantize it to 8 bit.
+
+    Vectorized equivalent of ``apply_windowing(volume, center, width, bit_size) // 256``
+    for floating point volumes, computed with a few in-place array operations
+    instead of boolean masks.
+    Args:
+        volume (ndarray): Numpy array of shape (N, H, W), after the modality LUT
+        center (float): Window center (or level)
+        width (float): Window width
+        bit_size (int): Max bit size of pixel
+    Returns:
+        ndarray: float64 array with values in [0, 2 ** (bit_size - 8) - 1]
+    """
+    y_max = 2 ** bit_size - 1
+
+    c = center - 0.5
+    w = width - 1
+
+    # Same expression as for the pixels within the window in apply_windowing,
+    # pixels outside of it land below 0 or above y_max and are clipped
+    out = np.subtract(volume, c, dtype=np.float64)
+    out /= w
+    out += 0.5
+    out *= y_max
+    np.clip(out, 0, y_max, out=out)
+
+    # Division by a power of 2 is exact, so this matches floor division
+    out /= 256
+    np.floor(out, out=out)
+    return out
+
+
+def has_windowing_lut(dtype):
+    """Whether images of `dtype` can be windowed with windowing_lut"""
+    dtype = np.dtype(dtype)
+    return dtype.kind in "iu" and dtype.itemsize <= 2
+
+
+@functools.lru_cache(maxsize=32)
+def windowing_lut(
+    dtype, center, width, slope=None, intercept=None, bit_size=16, out_dtype=None
+):
+    """Lookup table windowing every value of an 8 or 16 bit integer type.
+
+    Holds ``apply_windowing(values, center, width, bit_size) // 256`` for all
+    values of `dtype`, so windowing an image is a single ``np.take``.
+    With `slope` and `intercept`, the values are rescaled first, as
+    ``apply_modality_lut`` does. The table is indexed by the values viewed as
+    unsigned integers, see apply_lut.
+    Args:
+        dtype (str): Integer type of the images, 8 or 16 bit
+        center (float): Window center (or level)
+        width (float): Window width
+        slope (float): Rescale slope
+        intercept (float): Rescale intercept
+        bit_size (int): Max bit size of pixel
+        out_dtype (str): Type of the table, e.g. "|u1" since the values fit in 8 bit.
+            By default, the type apply_windowing gives
+    Returns:
+        ndarray: Read-only table of 2 ** (8 * itemsize) entries
+    """
+    dtype = np.dtype(dtype)
+    info = np.iinfo(dtype)
+    values = np.arange(info.min, info.max + 1).astype(dtype)
+    image = values.copy()
+    if slope is not None:
+        image = values.astype(np.float64) * slope
+        image += intercept
+    windowed = apply_windowing(image, center, width, bit_size) // 256
+
+    lut = np.empty_like(windowed, dtype=out_dtype or windowed.dtype)
+    lut[values.view("u{}".format(dtype.itemsize))] = windowed
+    lut.flags.writeable = False
+    return lut
+
+
+def apply_lut(image, lut, out=None):
+    """Maps the values of an 8 or 16 bit integer image through a table from windowing_lut"""
+    return np.take(lut, image.view("u{}".format(image.dtype.itemsize)), out=out)
+
+
+def window_image(image, center, width):
+    """Window an image or volume and quantize it to 8 bit.
+
+    Same as ``apply_windowing(image.astype(np.float64), center, width) // 256``,
+    using a lookup table for 8 and 16 bit integer images.
+    Args:
+        image (ndarray): Numpy array, after the modality LUT
+        center (float): Window center (or level)
+        width (float): Window width
+    Returns:
+        ndarray: float64 array of the windowed image
+    """
+    if has_windowing_lut(image.dtype):
+        lut = windowing_lut(image.dtype.str, center, width, 1.0, 0.0)
+        return apply_lut(image, lut)
+    return window_and_quantize(image, center, width)
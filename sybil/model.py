@@ -1,18 +1,47 @@
 from argparse import Namespace
-from io import BytesIO
+import hashlib
+import inspect
+import json
 import os
-from typing import NamedTuple, Union, Dict, List, Optional, Tuple
-from urllib.request import urlopen
-from zipfile import ZipFile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Union, Deque, Dict, Iterable, Iterator, List, Literal, Optional, Tuple
 
 import torch
 import numpy as np
 
 from sybil.serie import Serie
-from sybil.models.sybil import SybilNet
+from sybil.models.sybil import SybilNet, ENCODER_DEPTH_HALO, ENCODER_DEPTH_STRIDE
+from sybil.models.compiled_sybil import (
+    COMPILE_MODES,
+    compile_inductor,
+    load_torchscript,
+    save_torchscript,
+    torchscript_path,
+)
+from sybil.models.mmap_checkpoint import (
+    MMAP_CHECKPOINT_EXT,
+    load_mmap_checkpoint,
+    mmap_checkpoint_path,
+)
+from sybil.models.onnx_sybil import OnnxSybilNet, export_onnx
+from sybil.models.quantization import (
+    QUANTIZE_MODES,
+    quantize_sybilnet,
+    synthetic_calibration_volumes,
+)
 from sybil.models.calibrator import SimpleClassifierGroup
+from sybil.utils.download import download_and_extract as _download_and_extract
+from sybil.utils.download import file_lock, recorded_md5, verify_file
+from sybil.utils.hashing import file_md5
+from sybil.utils.prediction_cache import PredictionCache
 from sybil.utils.logging_utils import get_logger
-from sybil.utils.device_utils import get_default_device, get_most_free_gpu, get_device_mem_info
+from sybil.utils.device_utils import (
+    get_default_device,
+    get_most_free_gpu,
+    get_device_mem_info,
+    get_available_memory,
+)
 
 
 # Leaving this here for a bit; these are IDs to download the models from Google Drive
@@ -66,6 +95,32 @@ NAME_TO_FILE = {
     },
 }
 
+# Model outputs returned per serie when attentions are requested
+ATTENTION_KEYS = ["image_attention_1", "volume_attention_1", "hidden"]
+# Model outputs needed for risk scores
+PREDICTION_KEYS = ["logit"]
+
+# Approximate peak memory needed to run one volume through the encoder,
+# as a multiple of the size of the 3-channel input volume (measured ~27 on CPU).
+ACTIVATION_MEMORY_FACTOR = 28
+# Channels of the encoder activations are the same with a fused 1-channel input,
+# so memory estimates count volumes as if they had this many channels.
+ENCODER_INPUT_CHANNELS = 3
+# Upper bound on the automatically chosen inference batch size
+MAX_AUTO_BATCH_SIZE = 8
+
+# Dtype the encoder runs in for each inference precision, None for float32
+PRECISION_TO_DTYPE = {"fp32": None, "bf16": torch.bfloat16}
+
+# Modules can take tensors as their parameters, instead of copying them (torch >= 2.1)
+LOAD_STATE_DICT_ASSIGN = "assign" in inspect.signature(torch.nn.Module.load_state_dict).parameters
+
+# Marks the end of an iterator of series
+_END = object()
+
+# Lock file in the cache folder, held while downloading models
+DOWNLOAD_LOCK_FILE = ".download.lock"
+
 CHECKPOINT_URL = os.getenv("SYBIL_CHECKPOINT_URL", "https://github.com/reginabarzilaygroup/Sybil/releases/download/v1.5.0/sybil_checkpoints.zip")
 
 
@@ -81,8 +136,12 @@ class Evaluation(NamedTuple):
     attentions: List[Dict[str, np.ndarray]] = None
 
 
-def download_sybil(name, cache) -> Tuple[List[str], str]:
-    """Download trained models and calibrator"""
+def download_sybil(name, cache, url=None) -> Tuple[List[str], str]:
+    """Download trained models and calibrator, unless already there and verified.
+
+    Checkpoints are checked against the md5 listed in NAME_TO_FILE. Processes sharing
+    the cache folder wait for each other, so only one of them downloads.
+    """
     # Create cache folder if not exists
     cache = os.path.expanduser(cache)
     os.makedirs(cache, exist_ok=True)
@@ -91,28 +150,30 @@ def download_sybil(name, cache) -> Tuple[List[str], str]:
     model_files = NAME_TO_FILE[name]
     checkpoints = model_files["checkpoint"]
     download_calib_path = os.path.join(cache, f"{name}_simple_calibrator.json")
-    have_all_files = os.path.exists(download_calib_path)
+    download_model_paths = [os.path.join(cache, f"{checkpoint}.ckpt") for checkpoint in checkpoints]
+    expected_md5s = {f"{checkpoint}.ckpt": checkpoint for checkpoint in checkpoints}
 
-    download_model_paths = []
-    for checkpoint in checkpoints:
-        cur_checkpoint_path = os.path.join(cache, f"{checkpoint}.ckpt")
-        have_all_files &= os.path.exists(cur_checkpoint_path)
-        download_model_paths.append(cur_checkpoint_path)
+    def have_all_files():
+        return os.path.exists(download_calib_path) and all(
+            verify_file(path, checkpoint)
+            for path, checkpoint in zip(download_model_paths, checkpoints)
+        )
 
-    if not have_all_files:
-        print(f"Downloading models to {cache}")
-        download_and_extract(CHECKPOINT_URL, cache)
+    if not have_all_files():
+        with file_lock(os.path.join(cache, DOWNLOAD_LOCK_FILE)):
+            # Another process may have downloaded them while we waited
+            if not have_all_files():
+                print(f"Downloading models to {cache}")
+                download_and_extract(url or CHECKPOINT_URL, cache, expected_md5s)
 
     return download_model_paths, download_calib_path
 
 
-def download_and_extract(remote_url: str, local_dir: str) -> List[str]:
-    os.makedirs(local_dir, exist_ok=True)
-    resp = urlopen(remote_url)
-    with ZipFile(BytesIO(resp.read())) as zip_file:
-        all_files_and_dirs = zip_file.namelist()
-        zip_file.extractall(local_dir)
-    return all_files_and_dirs
+def download_and_extract(
+    remote_url: str, local_dir: str, expected_md5s: Optional[Dict[str, str]] = None
+) -> List[str]:
+    """Stream a zip archive to disk and extract it atomically, see sybil.utils.download."""
+    return _download_and_extract(remote_url, local_dir, expected_md5s)
 
 
 def _torch_set_num_threads(threads) -> int:
@@ -138,6 +199,14 @@ class Sybil:
         cache: str = "~/.sybil/",
         calibrator_path: Optional[str] = None,
         device: Optional[str] = None,
+        fuse_input_channels: bool = False,
+        backend: Literal["torch", "onnxruntime"] = "torch",
+        quantize: Optional[Literal["int8"]] = None,
+        calibration_series: Optional[List[Serie]] = None,
+        precision: Literal["fp32", "bf16"] = "fp32",
+        compile_mode: Optional[Literal["torchscript", "inductor"]] = None,
+        max_encoder_memory: Optional[int] = None,
+        result_cache: Optional[Union[str, PredictionCache]] = None,
     ):
         """Initialize a trained Sybil model for inference.
 
@@ -153,6 +222,39 @@ class Sybil:
         device: str
             If provided, will run inference using this device.
             By default, uses GPU with the most free memory, if available.
+        fuse_input_channels: bool
+            If True, the models take single channel volumes instead of the
+            grayscale volume replicated over 3 channels, see SybilNet.fuse_input_channels.
+            Uses 3 times less input memory, outputs are equal up to floating point error.
+        backend: str
+            "torch" to run the models with PyTorch, or "onnxruntime" to run them
+            on CPU with onnxruntime. The models are exported to ONNX next to their
+            checkpoint the first time, see sybil.models.onnx_sybil.
+        quantize: str
+            If "int8", the models are quantized for CPU inference, see
+            sybil.models.quantization.quantize_sybilnet. Runs on CPU only.
+        calibration_series: List[Serie]
+            Series to calibrate the quantized models with.
+            By default, random volumes are used.
+        precision: str
+            Default precision of the encoder at inference, see predict.
+        compile_mode: str
+            "torchscript" to run traced and frozen models, saved in `cache` by
+            checkpoint md5 and torch version and loaded from there on later runs.
+            The device is then fixed to the one picked now.
+            "inductor" to torch.compile the models, with the compiled kernels kept in `cache`.
+            This sets TORCHINDUCTOR_CACHE_DIR for the process, see compile_inductor.
+        max_encoder_memory: int
+            If provided, approximate ceiling in bytes on the memory used by the encoder.
+            The encoder then runs over depth slabs sized to fit, see SybilNet.encode_slabs,
+            and series are predicted one at a time unless a batch size is given.
+            The slabs overlap by the encoder receptive field, so even the smallest ones
+            span about 120 of the 200 slices of a volume.
+        result_cache: str or PredictionCache
+            If provided, predictions are stored in this cache, or in a PredictionCache
+            at this path, and returned from there for series with the same content,
+            see Serie.fingerprint. Entries are specific to the checkpoints, calibrator
+            and inference options, so a new model never reuses older predictions.
 
         """
         self._logger = get_logger()
@@ -171,20 +273,62 @@ class Sybil:
         if (calibrator_path is not None) and (not os.path.exists(calibrator_path)):
             raise ValueError(f"Path not found for calibrator {calibrator_path}")
 
+        if backend not in ("torch", "onnxruntime"):
+            raise ValueError(f"Unknown backend {backend}")
+        if quantize is not None and quantize not in QUANTIZE_MODES:
+            raise ValueError(f"Unknown quantization mode {quantize}")
+        if quantize is not None and backend != "torch":
+            raise ValueError("Quantization is only supported with the torch backend")
+        if compile_mode is not None and compile_mode not in COMPILE_MODES:
+            raise ValueError(f"Unknown compile mode {compile_mode}")
+        if compile_mode is not None and (backend != "torch" or quantize is not None):
+            raise ValueError("Compilation is only supported with the torch backend without quantization")
+        self.backend = backend
+        self.quantize = quantize
+        self.compile_mode = compile_mode
+        if max_encoder_memory is not None and (
+            backend != "torch" or compile_mode == "torchscript"
+        ):
+            raise ValueError("max_encoder_memory needs the torch backend, without tracing")
+        self.max_encoder_memory = max_encoder_memory
+        self.precision = self._check_precision(precision, backend, quantize, compile_mode)
+        self._cache_dir = os.path.expanduser(cache)
+        self._calibration_series = calibration_series
+        self._calibration_volumes = None
+
         # Set device.
         # If set manually, use it and stay there.
         # Otherwise, pick the most free GPU now and at predict time.
         self._device_flexible = True
-        if device is not None:
+        if backend == "onnxruntime" or quantize is not None:
+            if device is not None and torch.device(device).type != "cpu":
+                raise ValueError("The onnxruntime backend and quantized models only run on CPU")
+            self.device = "cpu"
+            self._device_flexible = False
+        elif device is not None:
             self.device = device
             self._device_flexible = False
         else:
             self.device = get_default_device()
+        if compile_mode == "torchscript":
+            # Traced graphs hold their weights as constants, they can't be moved
+            self._device_flexible = False
+
+        self.fuse_input_channels = fuse_input_channels
+        if isinstance(result_cache, str):
+            result_cache = PredictionCache(os.path.expanduser(result_cache))
+        self.result_cache = result_cache
+        self._model_fingerprint = None
+        if result_cache is not None:
+            self._model_fingerprint = self._fingerprint_model(name_or_path, calibrator_path)
 
         self.ensemble = torch.nn.ModuleList()
         for path in name_or_path:
             self.ensemble.append(self.load_model(path))
         self.to(self.device)
+        # Calibration volumes are not needed anymore
+        self._calibration_series = None
+        self._calibration_volumes = None
 
         if calibrator_path is not None:
             self.calibrator = SimpleClassifierGroup.from_json_grouped(calibrator_path)
@@ -197,31 +341,128 @@ class Sybil:
         Parameters
         ----------
         path : str
-            Path to a sybil checkpoint.
+            Path to a sybil checkpoint, or to a checkpoint converted with
+            sybil.models.mmap_checkpoint.convert_checkpoint. A converted checkpoint
+            next to the given one is used instead, if up to date.
 
         Returns
         -------
         model
             Pretrained Sybil model
         """
-        # Load checkpoint
-        checkpoint = torch.load(path, map_location="cpu")
-        args = checkpoint["args"]
+        if self.compile_mode == "torchscript":
+            # Keyed on the md5 recorded when the checkpoint was verified, if it was
+            in_channels = 1 if self.fuse_input_channels else 3
+            traced_path = torchscript_path(
+                self._cache_dir, recorded_md5(path), in_channels, self.device
+            )
+            if os.path.exists(traced_path):
+                traced, traced_args = load_torchscript(traced_path, self.device)
+                # Traces saved without their args need the checkpoint
+                if traced_args is not None:
+                    self._max_followup = traced_args["max_followup"]
+                    self._censoring_dist = traced_args["censoring_distribution"]
+                    self._logger.info(f"Loaded traced model from {traced_path}")
+                    return traced
+
+        # Memory-mapped weights and JSON args when converted, no unpickling
+        mmap_path = path if path.endswith(MMAP_CHECKPOINT_EXT) else mmap_checkpoint_path(path)
+        use_mmap = os.path.exists(mmap_path) and os.path.getmtime(mmap_path) >= os.path.getmtime(path)
+        if use_mmap:
+            state_dict, args = load_mmap_checkpoint(mmap_path)
+        else:
+            checkpoint = torch.load(path, map_location="cpu", weights_only=False)
+            args = checkpoint["args"]
+            # Remove model from param names
+            state_dict = {k[6:]: v for k, v in checkpoint["state_dict"].items()}
         self._max_followup = args.max_followup
         self._censoring_dist = args.censoring_distribution
-        model = SybilNet(args)
 
-        # Remove model from param names
-        state_dict = {k[6:]: v for k, v in checkpoint["state_dict"].items()}
-        model.load_state_dict(state_dict)  # type: ignore
+        if use_mmap and LOAD_STATE_DICT_ASSIGN:
+            # Parameters are the mapped tensors themselves, so they need no initialization
+            with torch.device("meta"):
+                model = SybilNet(args, pretrained_backbone=False)
+            model.load_state_dict(state_dict, assign=True)
+        else:
+            # No need for the Kinetics weights, they are overwritten by the checkpoint
+            model = SybilNet(args, pretrained_backbone=False)
+            model.load_state_dict(state_dict)  # type: ignore
+        if self.fuse_input_channels:
+            model.fuse_input_channels()
         if self.device is not None:
             model.to(self.device)
 
         # Set eval
         model.eval()
         self._logger.info(f"Loaded model from {path}")
+        if self.backend == "onnxruntime":
+            return self._load_onnx_model(model, path)
+        if self.quantize is not None:
+            self._logger.info(f"Quantizing model to {self.quantize}")
+            return quantize_sybilnet(model, self._get_calibration_volumes())
+        if self.compile_mode == "torchscript":
+            self._logger.info(f"Saving traced model to {traced_path}")
+            os.makedirs(self._cache_dir, exist_ok=True)
+            traced_args = {
+                "max_followup": args.max_followup,
+                "censoring_distribution": {
+                    str(k): float(v) for k, v in (args.censoring_distribution or {}).items()
+                },
+            }
+            return save_torchscript(model, traced_path, traced_args)
+        if self.compile_mode == "inductor":
+            return compile_inductor(model, self._cache_dir)
         return model
 
+    def _fingerprint_model(self, paths: List[str], calibrator_path: Optional[str]) -> str:
+        """Hash of the checkpoints, calibrator and options that predictions depend on."""
+        model = {
+            "checkpoints": [file_md5(path) for path in paths],
+            "calibrator": file_md5(calibrator_path) if calibrator_path is not None else None,
+            "fuse_input_channels": self.fuse_input_channels,
+            "backend": self.backend,
+            "quantize": self.quantize,
+        }
+        return hashlib.md5(json.dumps(model, sort_keys=True).encode()).hexdigest()
+
+    def _result_key(self, serie: Serie, precision: str) -> str:
+        if not isinstance(serie, Serie):
+            raise ValueError("Expected a list of Serie objects.")
+        return f"{serie.fingerprint()}-{self._model_fingerprint}-{precision}"
+
+    def _get_calibration_volumes(self) -> List[torch.Tensor]:
+        """Volumes to calibrate quantized models with, loaded once for all members."""
+        if self._calibration_volumes is None:
+            num_chan = 1 if self.fuse_input_channels else 3
+            if self._calibration_series:
+                self._calibration_volumes = [
+                    serie.get_volume(num_chan=num_chan) for serie in self._calibration_series
+                ]
+            else:
+                self._calibration_volumes = synthetic_calibration_volumes(num_chan=num_chan)
+        return self._calibration_volumes
+
+    def _load_onnx_model(self, model, path):
+        """Export the model loaded from checkpoint `path` to ONNX, if not done yet, and load it."""
+        suffix = ".1chan.onnx" if self.fuse_input_channels else ".onnx"
+        onnx_path = os.path.splitext(path)[0] + suffix
+        if not os.path.exists(onnx_path) or os.path.getmtime(onnx_path) < os.path.getmtime(path):
+            self._logger.info(f"Exporting model to {onnx_path}")
+            export_onnx(model, onnx_path)
+        return OnnxSybilNet(onnx_path)
+
+    @staticmethod
+    def _check_precision(precision, backend, quantize, compile_mode) -> str:
+        if precision not in PRECISION_TO_DTYPE:
+            raise ValueError(f"Unknown precision {precision}")
+        if precision != "fp32" and (
+            backend != "torch" or quantize is not None or compile_mode == "torchscript"
+        ):
+            raise ValueError(
+                f"Precision {precision} needs the torch backend, without quantization or tracing"
+            )
+        return precision
+
     def _calibrate(self, scores: np.ndarray) -> np.ndarray:
         """Calibrate raw predictions
 
@@ -245,27 +486,188 @@ class Sybil:
 
         return np.stack(calibrated_scores, axis=1)
 
-    def _predict(
+    @staticmethod
+    def _activation_memory(volume: torch.Tensor) -> int:
+        """Approximate peak encoder memory in bytes for volumes of shape (B, C, N, H, W)."""
+        num_voxels = volume.numel() // volume.shape[1]
+        return num_voxels * ENCODER_INPUT_CHANNELS * volume.element_size() * ACTIVATION_MEMORY_FACTOR
+
+    def _auto_batch_size(self, volume: torch.Tensor) -> int:
+        """Pick a batch size which should fit in the free memory of the current device.
+
+        Parameters
+        ----------
+        volume: torch.Tensor
+            A single CT volume of shape (1, C, N, H, W), used to estimate memory per serie.
+
+        Returns
+        -------
+        int
+            Number of series to run through the model at once.
+        """
+        available_mem = get_available_memory(self.device)
+        if available_mem is None:
+            return 1
+
+        # Leave headroom for the rest of the process and anything else on the device
+        mem_per_serie = self._activation_memory(volume)
+        batch_size = int(0.5 * available_mem // mem_per_serie)
+        return max(1, min(MAX_AUTO_BATCH_SIZE, batch_size))
+
+    def _encoder_slab_size(self, volume: torch.Tensor) -> Optional[int]:
+        """Number of slices per encoder slab to stay within max_encoder_memory.
+
+        Parameters
+        ----------
+        volume: torch.Tensor
+            Batch of volumes of shape (B, C, N, H, W).
+
+        Returns
+        -------
+        int, optional
+            Slab size, a multiple of the encoder depth stride, or None without a memory ceiling.
+        """
+        if self.max_encoder_memory is None:
+            return None
+        slice_mem = self._activation_memory(volume[:, :, :1])
+        max_depth = self.max_encoder_memory // slice_mem
+        slab_size = (max_depth - 2 * ENCODER_DEPTH_HALO) // ENCODER_DEPTH_STRIDE * ENCODER_DEPTH_STRIDE
+        return max(ENCODER_DEPTH_STRIDE, int(slab_size))
+
+    @staticmethod
+    def _accepts_output_keys(model) -> bool:
+        # Models compiled with torch.compile wrap the original module
+        model = getattr(model, "_orig_mod", model)
+        return isinstance(model, SybilNet)
+
+    def _get_volume(self, serie: Serie) -> torch.Tensor:
+        if not isinstance(serie, Serie):
+            raise ValueError("Expected a list of Serie objects.")
+        if self.fuse_input_channels:
+            return serie.get_volume(num_chan=1)
+        return serie.get_volume()
+
+    def _iter_volumes(
+        self, series: Iterable[Serie], num_workers: int = 0, prefetch: Optional[int] = None
+    ) -> Iterator[Tuple[Serie, torch.Tensor]]:
+        """Load the volumes of series, in order.
+
+        Parameters
+        ----------
+        series : Iterable[Serie]
+            Series to load.
+        num_workers : int
+            If positive, volumes are loaded by this many background threads, ahead of
+            the serie being consumed, so loading overlaps with the work of the caller.
+            If 0, each volume is loaded when requested.
+        prefetch : int, optional
+            Maximum number of series being loaded or waiting to be consumed.
+            By default, twice the number of workers.
+
+        Yields
+        ------
+        Tuple[Serie, torch.Tensor]
+            Each serie and its volume, of shape (1, C, N, H, W).
+        """
+        if num_workers <= 0:
+            for serie in series:
+                yield serie, self._get_volume(serie)
+            return
+
+        if prefetch is None:
+            prefetch = 2 * num_workers
+        iterator = iter(series)
+        pending = deque()
+        executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="sybil-loader")
+        try:
+            while True:
+                # Keep the queue full, the workers load while the caller runs the models
+                while len(pending) < max(1, prefetch):
+                    serie = next(iterator, _END)
+                    if serie is _END:
+                        break
+                    pending.append((serie, executor.submit(self._get_volume, serie)))
+                if not pending:
+                    return
+                serie, future = pending.popleft()
+                yield serie, future.result()
+        finally:
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def _iter_batches(
         self,
-        model: SybilNet,
+        series: Iterable[Serie],
+        batch_size: Optional[int] = None,
+        num_workers: int = 0,
+        prefetch: Optional[int] = None,
+    ) -> Iterator[Tuple[List[Serie], torch.Tensor]]:
+        """Load series and stack their volumes into mini-batches.
+
+        Parameters
+        ----------
+        series : Iterable[Serie]
+            Series to load.
+        batch_size : int, optional
+            Number of series per batch. If None, chosen automatically from available memory.
+        num_workers : int
+            Number of background threads loading upcoming volumes, see _iter_volumes.
+        prefetch : int, optional
+            Maximum number of series loaded ahead, see _iter_volumes.
+
+        Yields
+        ------
+        Tuple[List[Serie], torch.Tensor]
+            The series in the batch and their volumes, of shape (B, C, N, H, W).
+        """
+        batch_series, batch_volumes = [], []
+        for serie, volume in self._iter_volumes(series, num_workers, prefetch):
+            if batch_size is None:
+                batch_size = self._auto_batch_size(volume)
+                self._logger.debug(f"Using batch size {batch_size} for inference")
+
+            batch_series.append(serie)
+            batch_volumes.append(volume)
+            if len(batch_volumes) >= batch_size:
+                yield batch_series, torch.cat(batch_volumes, dim=0)
+                batch_series, batch_volumes = [], []
+
+        if batch_volumes:
+            yield batch_series, torch.cat(batch_volumes, dim=0)
+
+    def _predict_members(
+        self,
+        models: List[SybilNet],
         series: Union[Serie, List[Serie]],
         return_attentions: bool = False,
+        batch_size: Optional[int] = None,
+        precision: str = "fp32",
     ) -> Prediction:
-        """Run predictions over the given serie(s).
+        """Run predictions for every model over the given serie(s).
+
+        Each batch of volumes is loaded once and passed through all models
+        before moving on to the next batch.
 
         Parameters
         ----------
-        model: SybilNet
-            Instance of SybilNet
+        models: List[SybilNet]
+            Models to run, e.g. the members of the ensemble.
         series : Union[Serie, Iterable[Serie]]
             One or multiple series to run predictions for.
         return_attentions : bool
             If True, returns attention scores for each serie. See README for details.
+        batch_size : int, optional
+            Number of series to run through the models at once.
+            If None, chosen automatically based on available memory.
+        precision : str
+            Precision of the encoder, "fp32" or "bf16".
 
         Returns
         -------
         Prediction
-            Output prediction as risk scores.
+            Per serie, risk scores as an array of shape (num_models, max_followup)
+            and attentions stacked over models as tensors of shape (num_models, 1, ...).
 
         """
         if isinstance(series, Serie):
@@ -273,39 +675,118 @@ class Sybil:
         elif not isinstance(series, list):
             raise ValueError("Expected either a Serie object or list of Serie objects.")
 
-        scores: List[List[float]] = []
-        attentions: List[Dict[str, np.ndarray]] = [] if return_attentions else None
-        for serie in series:
-            if not isinstance(serie, Serie):
-                raise ValueError("Expected a list of Serie objects.")
+        scores: List[np.ndarray] = []
+        attentions: List[Dict[str, torch.Tensor]] = [] if return_attentions else None
+        for _, pred in self._iter_member_predictions(
+            models, series, return_attentions, batch_size, precision
+        ):
+            scores.extend(pred.scores)
+            if return_attentions:
+                attentions.extend(pred.attentions)
+
+        return Prediction(scores=scores, attentions=attentions)
 
-            volume = serie.get_volume()
+    def _iter_member_predictions(
+        self,
+        models: List[SybilNet],
+        series: Iterable[Serie],
+        return_attentions: bool = False,
+        batch_size: Optional[int] = None,
+        precision: str = "fp32",
+        num_workers: int = 0,
+        prefetch: Optional[int] = None,
+    ) -> Iterator[Tuple[List[Serie], Prediction]]:
+        """Run every model over batches of series, see _predict_members.
+
+        Yields
+        ------
+        Tuple[List[Serie], Prediction]
+            The series of each batch and their predictions by every model.
+        """
+        # Only pass options along when needed, so any module can be a member by default
+        autocast_dtype = PRECISION_TO_DTYPE[precision]
+        model_kwargs = {} if autocast_dtype is None else {"autocast_dtype": autocast_dtype}
+        if self.max_encoder_memory is not None and batch_size is None:
+            batch_size = 1
+        # SybilNet members only keep the outputs read below, the feature maps are freed early
+        if all(self._accepts_output_keys(model) for model in models):
+            model_kwargs["output_keys"] = PREDICTION_KEYS + (ATTENTION_KEYS if return_attentions else [])
+
+        for batch_series, volume in self._iter_batches(series, batch_size, num_workers, prefetch):
             if self.device is not None:
                 volume = volume.to(self.device)
 
+            slab_size = self._encoder_slab_size(volume)
+            if slab_size is not None:
+                model_kwargs["slab_size"] = slab_size
+
+            member_scores, member_attentions = [], []
             with torch.no_grad():
-                out = model(volume)
-                score = out["logit"].sigmoid().squeeze(0).cpu().numpy()
-                scores.append(score.tolist())
-                if return_attentions:
-                    attentions.append(
-                        {
-                            "image_attention_1": out["image_attention_1"]
-                            .detach()
-                            .cpu(),
-                            "volume_attention_1": out["volume_attention_1"]
-                            .detach()
-                            .cpu(),
-                            "hidden": out["hidden"]
-                            .detach()
-                            .cpu(),
-                        }
-                    )
+                for model in models:
+                    out = model(volume, **model_kwargs)
+                    member_scores.append(out["logit"].sigmoid().cpu().numpy())
+                    if return_attentions:
+                        member_attentions.append(
+                            {key: out[key].detach().cpu() for key in ATTENTION_KEYS}
+                        )
+                    del out
+            del volume
+
+            # (num_models, B, max_followup) -> B x (num_models, max_followup)
+            scores = list(np.stack(member_scores, axis=1))
+            attentions = None
+            if return_attentions:
+                attentions = [
+                    {
+                        key: torch.stack([att[key][i : i + 1] for att in member_attentions])
+                        for key in ATTENTION_KEYS
+                    }
+                    for i in range(len(batch_series))
+                ]
+            yield batch_series, Prediction(scores=scores, attentions=attentions)
+
+    def _predict(
+        self,
+        model: SybilNet,
+        series: Union[Serie, List[Serie]],
+        return_attentions: bool = False,
+        batch_size: Optional[int] = None,
+    ) -> Prediction:
+        """Run predictions over the given serie(s).
+
+        Parameters
+        ----------
+        model: SybilNet
+            Instance of SybilNet
+        series : Union[Serie, Iterable[Serie]]
+            One or multiple series to run predictions for.
+        return_attentions : bool
+            If True, returns attention scores for each serie. See README for details.
+        batch_size : int, optional
+            Number of series to run through the model at once.
+            If None, chosen automatically based on available memory.
+
+        Returns
+        -------
+        Prediction
+            Output prediction as risk scores.
+
+        """
+        pred = self._predict_members([model], series, return_attentions, batch_size)
+        scores = [score[0].tolist() for score in pred.scores]
+        attentions = None
+        if return_attentions:
+            attentions = [{key: val[0] for key, val in att.items()} for att in pred.attentions]
 
         return Prediction(scores=scores, attentions=attentions)
 
     def predict(
-        self, series: Union[Serie, List[Serie]], return_attentions: bool = False, threads=0,
+        self,
+        series: Union[Serie, List[Serie]],
+        return_attentions: bool = False,
+        threads=0,
+        batch_size: Optional[int] = None,
+        precision: Optional[Literal["fp32", "bf16"]] = None,
     ) -> Prediction:
         """Run predictions over the given serie(s) and ensemble
 
@@ -316,7 +797,14 @@ class Sybil:
         return_attentions : bool
             If True, returns attention scores for each serie. See README for details.
         threads : int
-            Number of CPU threads to use for PyTorch inference.
+            Number of CPU threads to use for PyTorch or onnxruntime inference.
+        batch_size : int, optional
+            Number of series to stack into a single forward pass.
+            If None, chosen automatically based on the memory available on the device.
+        precision : str, optional
+            "fp32", or "bf16" to run the encoder under bfloat16 autocast.
+            Pooling, the hazard layer and calibration stay in float32.
+            By default, the precision the model was created with.
 
         Returns
         -------
@@ -324,40 +812,163 @@ class Sybil:
             Output prediction. See details for :class:`~sybil.model.Prediction`".
 
         """
+        precision = self._prepare_predict(threads, precision)
+        if self.result_cache is None:
+            return self._predict_ensemble(series, return_attentions, batch_size, precision)
 
+        if isinstance(series, Serie):
+            series = [series]
+        elif not isinstance(series, list):
+            raise ValueError("Expected either a Serie object or list of Serie objects.")
+
+        # Only run the models on series without a stored prediction
+        keys = [self._result_key(serie, precision) for serie in series]
+        results = [self.result_cache.get(key, return_attentions) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        self._logger.debug(f"{len(series) - len(missing)} of {len(series)} predictions cached")
+        if missing:
+            pred = self._predict_ensemble(
+                [series[i] for i in missing], return_attentions, batch_size, precision
+            )
+            for j, i in enumerate(missing):
+                attentions = pred.attentions[j] if return_attentions else None
+                self.result_cache.put(keys[i], pred.scores[j], attentions)
+                results[i] = (pred.scores[j], attentions)
+
+        scores = [score for score, _ in results]
+        attentions = [att for _, att in results] if return_attentions else None
+        return Prediction(scores=scores, attentions=attentions)
+
+    def predict_iter(
+        self,
+        series: Iterable[Serie],
+        return_attentions: bool = False,
+        threads=0,
+        batch_size: Optional[int] = None,
+        precision: Optional[Literal["fp32", "bf16"]] = None,
+        num_workers: int = 1,
+        prefetch: Optional[int] = None,
+    ) -> Iterator[Tuple[Serie, Prediction]]:
+        """Run predictions over a stream of series, yielding results as they complete.
+
+        Background threads read and preprocess the volumes of upcoming series,
+        through a bounded queue, while the ensemble runs on the current batch.
+
+        Parameters
+        ----------
+        series : Iterable[Serie]
+            Series to run predictions for, e.g. a generator.
+        return_attentions : bool
+            If True, returns attention scores for each serie. See README for details.
+        threads : int
+            Number of CPU threads to use for PyTorch or onnxruntime inference.
+        batch_size : int, optional
+            Number of series to stack into a single forward pass.
+            If None, chosen automatically based on the memory available on the device.
+        precision : str, optional
+            "fp32" or "bf16", see predict.
+        num_workers : int
+            Number of threads loading volumes. If 0, volumes are loaded in turn with
+            inference, like in predict.
+        prefetch : int, optional
+            Maximum number of series loaded ahead of inference, which bounds the memory
+            held by upcoming volumes. By default, twice the number of workers.
+
+        Yields
+        ------
+        Tuple[Serie, Prediction]
+            Each serie with its prediction, holding a single serie. Series are in input order,
+            except those with a prediction in the result cache, which come out first.
+        """
+        precision = self._prepare_predict(threads, precision)
+
+        # Keys of the series sent to the models, which keep their order
+        keys: Deque[str] = deque()
+        cached: Deque[Tuple[Serie, Prediction]] = deque()
+
+        def uncached_series():
+            for serie in series:
+                if self.result_cache is None:
+                    yield serie
+                    continue
+                key = self._result_key(serie, precision)
+                result = self.result_cache.get(key, return_attentions)
+                if result is None:
+                    keys.append(key)
+                    yield serie
+                else:
+                    score, att = result
+                    cached.append(
+                        (serie, Prediction(scores=[score], attentions=[att] if return_attentions else None))
+                    )
+
+        # Every volume is loaded once and run through all ensemble members
+        batches = self._iter_member_predictions(
+            list(self.ensemble),
+            uncached_series(),
+            return_attentions,
+            batch_size,
+            precision,
+            num_workers,
+            prefetch,
+        )
+        for batch_series, member_pred in batches:
+            while cached:
+                yield cached.popleft()
+            pred = self._ensemble_prediction(member_pred)
+            for i, serie in enumerate(batch_series):
+                attentions = [pred.attentions[i]] if return_attentions else None
+                if self.result_cache is not None:
+                    self.result_cache.put(
+                        keys.popleft(), pred.scores[i], attentions[0] if attentions else None
+                    )
+                yield serie, Prediction(scores=[pred.scores[i]], attentions=attentions)
+        while cached:
+            yield cached.popleft()
+
+    def _prepare_predict(self, threads: int, precision: Optional[str]) -> str:
+        """Set threads and device for inference, returns the precision to run in."""
         # Set CPU threads available to torch
         num_threads = _torch_set_num_threads(threads)
         self._logger.debug(f"Using {num_threads} threads for PyTorch inference")
+        if self.backend == "onnxruntime":
+            for model in self.ensemble:
+                model.set_num_threads(num_threads)
 
         if self._device_flexible:
             self.device = self._pick_device()
             self.to(self.device)
         self._logger.debug(f"Beginning prediction on device: {self.device}")
 
-        scores = []
-        attentions_ = [] if return_attentions else None
-        attention_keys = None
-        for sybil in self.ensemble:
-            pred = self._predict(sybil, series, return_attentions)
-            scores.append(pred.scores)
-            if return_attentions:
-                attentions_.append(pred.attentions)
-                if attention_keys is None:
-                    attention_keys = pred.attentions[0].keys()
+        if precision is None:
+            precision = self.precision
+        return self._check_precision(
+            precision, self.backend, self.quantize, self.compile_mode
+        )
+
+    def _predict_ensemble(
+        self,
+        series: Union[Serie, List[Serie]],
+        return_attentions: bool,
+        batch_size: Optional[int],
+        precision: str,
+    ) -> Prediction:
+        # Every volume is loaded once and run through all ensemble members
+        pred = self._predict_members(
+            list(self.ensemble), series, return_attentions, batch_size, precision
+        )
+        return self._ensemble_prediction(pred)
 
-        scores = np.mean(np.array(scores), axis=0)
+    def _ensemble_prediction(self, pred: Prediction) -> Prediction:
+        """Average and calibrate the scores of ensemble members, see _predict_members."""
+        scores = np.asarray(pred.scores, dtype=np.float64).mean(axis=1)
         calib_scores = self._calibrate(scores).tolist()
 
         attentions = None
-        if return_attentions:
-            attentions = []
-            for i in range(len(series)):
-                att = {}
-                for key in attention_keys:
-                    att[key] = np.stack([
-                        attentions_[j][i][key] for j in range(len(self.ensemble))
-                    ])
-                attentions.append(att)
+        if pred.attentions is not None:
+            attentions = [
+                {key: val.numpy() for key, val in att.items()} for att in pred.attentions
+            ]
 
         return Prediction(scores=calib_scores, attentions=attentions)
 
@@ -422,6 +1033,31 @@ class Sybil:
         self.device = device
         self.ensemble.to(device)
 
+    def share_memory(self):
+        """Move the weights of the ensemble to shared memory, in place.
+
+        Processes receiving the model through torch.multiprocessing, e.g. the workers
+        of a SybilPool, then use the same weights instead of a copy each.
+        The model stays on CPU, where shared memory lives.
+
+        Returns
+        -------
+        Sybil
+            This model.
+        """
+        if (
+            self.backend != "torch"
+            or self.quantize is not None
+            or self.compile_mode is not None
+            or torch.device(self.device).type != "cpu"
+        ):
+            raise ValueError(
+                "Shared memory needs CPU torch models, without quantization or compilation"
+            )
+        self._device_flexible = False
+        self.ensemble.share_memory()
+        return self
+
     def _pick_device(self):
         """
         Pick the device to run inference on.
@@ -0,0 +1,86 @@
+import json
+import os
+import tempfile
+
+import torch
+
+
+COMPILE_MODES = ("torchscript", "inductor")
+# File of the traced model holding the checkpoint args needed without the checkpoint
+TORCHSCRIPT_ARGS_FILE = "sybil_args.json"
+
+
+def torchscript_path(cache_dir, checkpoint_md5, in_channels, device):
+    """
+    Path of the TorchScript SybilNet for a checkpoint in `cache_dir`.
+    Traced graphs are specific to the torch version, input channels and device type.
+    """
+    device = torch.device(device)
+    name = f"{checkpoint_md5}-torch{torch.__version__}-{in_channels}chan-{device.type}.torchscript.pt"
+    return os.path.join(cache_dir, name)
+
+
+def save_torchscript(model, path, args=None):
+    """
+    Trace a SybilNet in eval mode, freeze it and save it to `path`, along with the
+    JSON dict `args` if given, see load_torchscript.
+    The traced graph follows the shape of its input, so a small volume is enough to trace it.
+    """
+    in_channels = model.image_encoder[0][0].in_channels
+    device = next(model.parameters()).device
+    dummy = torch.zeros(1, in_channels, 16, 64, 64, device=device)
+    with torch.no_grad():
+        traced = torch.jit.trace(model.eval(), dummy, strict=False, check_trace=False)
+        frozen = torch.jit.freeze(traced)
+
+    # Replace at once, so a partial file is never loaded
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".pt.tmp")
+    os.close(fd)
+    try:
+        extra_files = {TORCHSCRIPT_ARGS_FILE: json.dumps(args)} if args is not None else None
+        torch.jit.save(frozen, tmp_path, _extra_files=extra_files)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return frozen
+
+
+def load_torchscript(path, device):
+    """
+    Load a model saved with save_torchscript.
+    Returns the model and the args saved with it, or None if there are none.
+    """
+    extra_files = {TORCHSCRIPT_ARGS_FILE: ""}
+    model = torch.jit.load(path, map_location=device, _extra_files=extra_files).eval()
+    args = extra_files[TORCHSCRIPT_ARGS_FILE]
+    return model, json.loads(args) if args else None
+
+
+def _has_default_inductor_cache_dir():
+    cache_dir = os.environ.get("TORCHINDUCTOR_CACHE_DIR")
+    if cache_dir is None:
+        return True
+    # Importing some packages (e.g. torchvision) sets the variable to torch's default
+    try:
+        from torch._inductor.runtime.cache_dir_utils import default_cache_dir
+    except ImportError:
+        return False
+    return cache_dir == default_cache_dir()
+
+
+def compile_inductor(model, cache_dir):
+    """
+    torch.compile a SybilNet. Compiled kernels are kept in an "inductor"
+    directory of `cache_dir`, unless TORCHINDUCTOR_CACHE_DIR is set, so
+    later processes reuse them instead of compiling again.
+
+    Note that this sets TORCHINDUCTOR_CACHE_DIR for the whole process, since
+    compilation happens later, at the first call of the model. Other models
+    compiled by the process then share the directory.
+    """
+    if not hasattr(torch, "compile"):
+        raise RuntimeError(f"torch.compile is not available in torch {torch.__version__}")
+    if _has_default_inductor_cache_dir():
+        os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.join(cache_dir, "inductor")
+    return torch.compile(model)
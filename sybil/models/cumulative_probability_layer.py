@@ -9,6 +9,7 @@ class Cumulative_Probability_Layer(nn.Module):
         self.hazard_fc = nn.Linear(num_features, max_followup)
         self.base_hazard_fc = nn.Linear(num_features, 1)
         self.relu = nn.ReLU(inplace=True)
+        # Not used by forward anymore, kept so that existing checkpoints load as is
         mask = torch.ones([max_followup, max_followup])
         mask = torch.tril(mask, diagonal=0)
         mask = torch.nn.Parameter(torch.t(mask), requires_grad=False)
@@ -20,14 +21,10 @@ class Cumulative_Probability_Layer(nn.Module):
         return pos_hazard
 
     def forward(self, x):
-        hazards = self.hazards(x)
-        B, T = hazards.size()  # hazards is (B, T)
-        expanded_hazards = hazards.unsqueeze(-1).expand(
-            B, T, T
-        )  # expanded_hazards is (B,T, T)
-        masked_hazards = (
-            expanded_hazards * self.upper_triagular_mask
-        )  # masked_hazards now (B,T, T)
+        hazards = self.hazards(x)  # hazards is (B, T)
+        # Cumulative hazard up to each follow-up year, i.e. the sum of hazards
+        # masked by the upper triangular mask, in O(T) instead of O(T^2)
+        cum_hazards = torch.cumsum(hazards, dim=1)
         base_hazard = self.base_hazard_fc(x)
-        cum_prob = torch.sum(masked_hazards, dim=1) + base_hazard
+        cum_prob = cum_hazards + base_hazard
         return cum_prob
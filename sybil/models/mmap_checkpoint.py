@@ -0,0 +1,216 @@
+import argparse
+import json
+import os
+import struct
+import tempfile
+from argparse import Namespace
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import torch
+
+from sybil.utils.hashing import file_md5
+from sybil.utils.logging_utils import get_logger
+
+MMAP_CHECKPOINT_EXT = ".safetensors"
+ARGS_SIDECAR_EXT = ".args.json"
+
+# Tensor dtypes of the safetensors format
+DTYPE_TO_NAME = {
+    torch.float64: "F64",
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int16: "I16",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+}
+NAME_TO_DTYPE = {name: dtype for dtype, name in DTYPE_TO_NAME.items()}
+# The header is padded so that tensor data starts 8-byte aligned
+HEADER_ALIGNMENT = 8
+
+
+def mmap_checkpoint_path(checkpoint_path: str) -> str:
+    """Path of the converted checkpoint next to a Sybil checkpoint."""
+    return os.path.splitext(checkpoint_path)[0] + MMAP_CHECKPOINT_EXT
+
+
+def args_sidecar_path(path: str) -> str:
+    """Path of the JSON file holding the args of a converted checkpoint."""
+    return os.path.splitext(path)[0] + ARGS_SIDECAR_EXT
+
+
+def _atomic_write(path: str, write):
+    # Replace at once, so a partial file is never loaded
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def save_safetensors(
+    tensors: Dict[str, torch.Tensor], path: str, metadata: Optional[Dict[str, str]] = None
+):
+    """
+    Write tensors to `path` in the safetensors format: a JSON header giving the dtype,
+    shape and byte range of every tensor, followed by their raw little-endian data.
+    Tensors are ordered by decreasing item size, so that each one is aligned.
+    """
+    names = sorted(tensors, key=lambda name: (-tensors[name].element_size(), name))
+    header = {}
+    offset = 0
+    for name in names:
+        tensor = tensors[name]
+        if tensor.dtype not in DTYPE_TO_NAME:
+            raise ValueError(f"Unsupported dtype {tensor.dtype} for tensor {name}")
+        size = tensor.numel() * tensor.element_size()
+        header[name] = {
+            "dtype": DTYPE_TO_NAME[tensor.dtype],
+            "shape": list(tensor.shape),
+            "data_offsets": [offset, offset + size],
+        }
+        offset += size
+    if metadata:
+        header["__metadata__"] = metadata
+
+    header_bytes = json.dumps(header, separators=(",", ":")).encode()
+    header_bytes += b" " * (-(8 + len(header_bytes)) % HEADER_ALIGNMENT)
+
+    def write(f):
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for name in names:
+            data = tensors[name].detach().cpu().contiguous()
+            f.write(data.view(-1).view(torch.uint8).numpy().tobytes())
+
+    _atomic_write(path, write)
+
+
+def load_safetensors(path: str) -> Tuple[Dict[str, torch.Tensor], Dict[str, str]]:
+    """
+    Memory-map a safetensors file. Tensors are views of the copy-on-write mapping,
+    so pages are only read from disk when used, and no pickle is involved.
+
+    Returns
+    -------
+    Tuple[Dict[str, torch.Tensor], Dict[str, str]]
+        Tensors by name, and the metadata of the file.
+    """
+    with open(path, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+    metadata = header.pop("__metadata__", {})
+
+    data_start = 8 + header_size
+    if os.path.getsize(path) == data_start:
+        buffer = np.zeros(0, dtype=np.uint8)
+    else:
+        buffer = np.memmap(path, dtype=np.uint8, mode="c", offset=data_start)
+    tensors = {}
+    for name, info in header.items():
+        start, end = info["data_offsets"]
+        data = torch.from_numpy(buffer[start:end])
+        tensors[name] = data.view(NAME_TO_DTYPE[info["dtype"]]).reshape(info["shape"])
+    return tensors, metadata
+
+
+def _json_args(args: Namespace) -> Dict:
+    """Arguments of a checkpoint which can be written as JSON."""
+    logger = get_logger()
+    json_args = {}
+    for key, value in vars(args).items():
+        if isinstance(value, np.generic):
+            value = value.item()
+        try:
+            json.dumps(value)
+        except TypeError:
+            logger.debug(f"Skipping argument {key} of type {type(value).__name__}")
+            continue
+        json_args[key] = value
+    return json_args
+
+
+def convert_checkpoint(checkpoint_path: str, out_path: Optional[str] = None) -> str:
+    """Convert a Sybil checkpoint to a memory-mappable tensor file and a JSON of its args.
+
+    The checkpoint is unpickled once here. The converted files are loaded with
+    load_mmap_checkpoint, without executing any pickle.
+
+    Parameters
+    ----------
+    checkpoint_path: str
+        Path of a Sybil checkpoint, as saved by training.
+    out_path: str, optional
+        Path of the tensor file, next to the checkpoint by default, see mmap_checkpoint_path.
+        The args are written next to it, see args_sidecar_path.
+
+    Returns
+    -------
+    str
+        Path of the tensor file.
+    """
+    if out_path is None:
+        out_path = mmap_checkpoint_path(checkpoint_path)
+    checkpoint = torch.load(checkpoint_path, map_location="cpu", weights_only=False)
+    args = checkpoint["args"]
+
+    # Remove 'model.' from param names
+    state_dict = {k[6:]: v for k, v in checkpoint["state_dict"].items()}
+    censoring_distribution = {
+        str(k): float(v) for k, v in (args.censoring_distribution or {}).items()
+    }
+    sidecar = {
+        "args": _json_args(args),
+        "max_followup": args.max_followup,
+        "censoring_distribution": censoring_distribution,
+        "source_md5": file_md5(checkpoint_path),
+    }
+
+    save_safetensors(state_dict, out_path, metadata={"format": "pt"})
+    _atomic_write(
+        args_sidecar_path(out_path), lambda f: f.write(json.dumps(sidecar, indent=2).encode())
+    )
+    return out_path
+
+
+def load_mmap_checkpoint(path: str) -> Tuple[Dict[str, torch.Tensor], Namespace]:
+    """Load a checkpoint converted with convert_checkpoint.
+
+    Returns
+    -------
+    Tuple[Dict[str, torch.Tensor], Namespace]
+        The memory-mapped state dict of the SybilNet, and its args.
+    """
+    with open(args_sidecar_path(path), "r") as f:
+        sidecar = json.load(f)
+    args = Namespace(**sidecar["args"])
+    args.max_followup = sidecar["max_followup"]
+    args.censoring_distribution = sidecar["censoring_distribution"]
+    state_dict, _ = load_safetensors(path)
+    return state_dict, args
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        description="Convert Sybil checkpoints to memory-mappable tensor files, "
+        "written next to them with a JSON of their args."
+    )
+    parser.add_argument("checkpoints", nargs="+", help="Paths of Sybil checkpoints")
+    return parser
+
+
+def main():
+    args = _get_parser().parse_args()
+    for checkpoint_path in args.checkpoints:
+        print(convert_checkpoint(checkpoint_path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import inspect
+import os
+import tempfile
+
+import torch
+import torch.nn as nn
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    # onnxruntime is not installed, the onnxruntime backend will not be available
+    ort = None
+
+
+# SybilNet outputs kept in the exported graph, enough for predictions and attentions
+ONNX_OUTPUT_KEYS = ["logit", "hidden", "image_attention_1", "volume_attention_1"]
+ONNX_INPUT_NAME = "volume"
+ONNX_OPSET = 17
+
+# Batch size and volume shape can change between runs of the exported graph
+ONNX_DYNAMIC_AXES = {
+    ONNX_INPUT_NAME: {0: "batch", 2: "slices", 3: "height", 4: "width"},
+    "logit": {0: "batch"},
+    "hidden": {0: "batch"},
+    "image_attention_1": {0: "batch", 1: "encoded_slices", 2: "encoded_pixels"},
+    "volume_attention_1": {0: "batch", 1: "encoded_slices"},
+}
+
+
+class _OnnxExportWrapper(nn.Module):
+    """Returns the SybilNet outputs in ONNX_OUTPUT_KEYS as a tuple, for export."""
+
+    def __init__(self, model):
+        super(_OnnxExportWrapper, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        output = self.model(x, output_keys=ONNX_OUTPUT_KEYS)
+        return tuple(output[key] for key in ONNX_OUTPUT_KEYS)
+
+
+def export_onnx(model, path, opset_version=ONNX_OPSET):
+    """
+    Export a SybilNet (encoder, attention pooling and cumulative probability layer)
+    to an ONNX file at `path`, in eval mode.
+    The batch size and volume shape are dynamic. The number of input channels is
+    the one of the model, see SybilNet.fuse_input_channels.
+    """
+    in_channels = model.image_encoder[0][0].in_channels
+    device = next(model.parameters()).device
+    # Any volume large enough for the encoder works, the shape is dynamic
+    dummy = torch.zeros(1, in_channels, 16, 64, 64, device=device)
+
+    kwargs = {}
+    # Newer versions of torch default to the dynamo based exporter
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        kwargs["dynamo"] = False
+
+    was_training = model.training
+    wrapper = _OnnxExportWrapper(model).eval()
+    out_dir = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=out_dir, suffix=".onnx.tmp")
+    os.close(fd)
+    try:
+        with torch.no_grad():
+            torch.onnx.export(
+                wrapper,
+                (dummy,),
+                tmp_path,
+                input_names=[ONNX_INPUT_NAME],
+                output_names=ONNX_OUTPUT_KEYS,
+                dynamic_axes=ONNX_DYNAMIC_AXES,
+                opset_version=opset_version,
+                **kwargs,
+            )
+        # Replace at once, so a partial export is never loaded
+        os.replace(tmp_path, path)
+    finally:
+        model.train(was_training)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return path
+
+
+class OnnxSybilNet(nn.Module):
+    """
+    SybilNet exported with export_onnx, run by onnxruntime on CPU.
+    Called like SybilNet on a (B, C, T, H, W) volume, returns a dict
+    with the outputs in ONNX_OUTPUT_KEYS.
+    """
+
+    def __init__(self, path, num_threads=0):
+        super(OnnxSybilNet, self).__init__()
+        if ort is None:
+            raise ImportError(
+                "onnxruntime is required for the onnxruntime backend, "
+                "install it with `pip install onnxruntime`"
+            )
+        self.path = path
+        self.num_threads = None
+        self.session = None
+        self.set_num_threads(num_threads)
+
+    def set_num_threads(self, num_threads):
+        """
+        Set the number of threads of the onnxruntime session, 0 for its default.
+        The session is created again if the number changes.
+        """
+        if num_threads == self.num_threads:
+            return
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(
+            self.path, options, providers=["CPUExecutionProvider"]
+        )
+        self.num_threads = num_threads
+
+    def forward(self, x):
+        volume = x.detach().cpu().float().contiguous().numpy()
+        outputs = self.session.run(ONNX_OUTPUT_KEYS, {ONNX_INPUT_NAME: volume})
+        return {key: torch.from_numpy(val) for key, val in zip(ONNX_OUTPUT_KEYS, outputs)}
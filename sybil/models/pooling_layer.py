@@ -21,9 +21,18 @@ class MultiAttentionPool(nn.Module):
         self.multi_img_hidden_fc = nn.Linear(2 * 512, 512)
         self.hidden_fc = nn.Linear(3 * 512, 512)         
 
-    def forward(self, x):
+    def forward(self, x, *, output_keys=None):
+        '''
+        args:
+            - x: tensor of shape (B, C, T, W, H)
+            - output_keys: if given, only these intermediates are kept in the output,
+              'hidden' is always returned. 'multi_image_hidden' is only computed if requested.
+        '''
         #X dim: B, C, T, W, H
         output = {}
+
+        def keep(key):
+            return output_keys is None or key in output_keys
         
         image_pool_out1 = self.image_pool1(x) # contains keys: "multi_image_hidden", "image_attention"
         volume_pool_out1 = self.volume_pool1(image_pool_out1['multi_image_hidden'])  # contains keys: "hidden", "volume_attention"
@@ -33,15 +42,19 @@ class MultiAttentionPool(nn.Module):
 
         for pool_out, num in [(image_pool_out1, 1), (volume_pool_out1, 1), (image_pool_out2, 2), (volume_pool_out2, 2) ]:
             for key, val in pool_out.items():
-                output['{}_{}'.format(key, num)] = val
+                if keep('{}_{}'.format(key, num)):
+                    output['{}_{}'.format(key, num)] = val
     
-        maxpool_out = self.global_max_pool(x)
-        output['maxpool_hidden'] = maxpool_out['hidden']
+        maxpool_hidden = self.global_max_pool(x)['hidden']
+        if keep('maxpool_hidden'):
+            output['maxpool_hidden'] = maxpool_hidden
         
-        multi_image_hidden = torch.cat( [ image_pool_out1['multi_image_hidden'], image_pool_out2['multi_image_hidden']], dim = -2 )
-        output['multi_image_hidden'] = self.multi_img_hidden_fc(multi_image_hidden.permute([0,2,1]).contiguous()).permute([0,2,1]).contiguous()
+        if keep('multi_image_hidden'):
+            multi_image_hidden = torch.cat( [ image_pool_out1['multi_image_hidden'], image_pool_out2['multi_image_hidden']], dim = -2 )
+            output['multi_image_hidden'] = self.multi_img_hidden_fc(multi_image_hidden.permute([0,2,1]).contiguous()).permute([0,2,1]).contiguous()
+        del image_pool_out1, image_pool_out2
 
-        hidden = torch.cat( [ volume_pool_out1['hidden'], volume_pool_out2['hidden'], output['maxpool_hidden']], dim = -1 )
+        hidden = torch.cat( [ volume_pool_out1['hidden'], volume_pool_out2['hidden'], maxpool_hidden], dim = -1 )
         output['hidden'] = self.hidden_fc(hidden)
 
         return output 
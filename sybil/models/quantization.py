@@ -0,0 +1,138 @@
+import copy
+from typing import List, NamedTuple, Sequence
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+
+QUANTIZE_MODES = ("int8",)
+
+# Quantized kernels to use, by order of preference
+QUANTIZED_ENGINES = ("x86", "fbgemm", "qnnpack")
+
+# Normalization of the 8 bit volumes produced by Serie
+IMG_MEAN = 128.1722
+IMG_STD = 87.1849
+
+
+class ScoreDrift(NamedTuple):
+    """Absolute difference of risk scores to reference scores, per follow-up year."""
+
+    mean_abs: List[float]
+    max_abs: List[float]
+    num_series: int
+
+
+def get_quantized_engine() -> str:
+    """Best quantized engine supported by this build of torch"""
+    supported = torch.backends.quantized.supported_engines
+    for engine in QUANTIZED_ENGINES:
+        if engine in supported:
+            return engine
+    raise RuntimeError("No quantized engine available in this build of PyTorch")
+
+
+def synthetic_calibration_volumes(
+    num_volumes: int = 2,
+    num_chan: int = 3,
+    shape: Sequence[int] = (200, 256, 256),
+    seed: int = 0,
+) -> List[torch.Tensor]:
+    """Random volumes covering the range of normalized Serie intensities.
+
+    Parameters
+    ----------
+    num_volumes : int
+        Number of volumes.
+    num_chan : int
+        Number of channels, copies of the same grayscale volume.
+    shape : Sequence[int]
+        Volume shape, (N, H, W).
+    seed : int
+        Random seed.
+
+    Returns
+    -------
+    List[torch.Tensor]
+        Volumes of shape (1, num_chan, N, H, W)
+    """
+    generator = torch.Generator().manual_seed(seed)
+    volumes = []
+    for _ in range(num_volumes):
+        pixels = torch.randint(0, 256, (1, 1, *shape), generator=generator).float()
+        volume = pixels.sub_(IMG_MEAN).div_(IMG_STD)
+        volumes.append(volume.expand(-1, num_chan, -1, -1, -1))
+    return volumes
+
+
+def quantize_sybilnet(model: nn.Module, calibration_volumes: Sequence[torch.Tensor]) -> nn.Module:
+    """Returns an int8 copy of a SybilNet for CPU inference.
+
+    The convolutions of the r3d encoder are statically quantized, with activation
+    ranges calibrated on `calibration_volumes`. The linear layers of the attention
+    pooling and cumulative probability layers are dynamically quantized.
+
+    Parameters
+    ----------
+    model : SybilNet
+        Model to quantize, left unchanged.
+    calibration_volumes : Sequence[torch.Tensor]
+        Volumes of shape (B, C, N, H, W) to calibrate the encoder with,
+        ideally real Serie volumes. See synthetic_calibration_volumes otherwise.
+
+    Returns
+    -------
+    SybilNet
+        Quantized model, in eval mode.
+    """
+    engine = get_quantized_engine()
+    torch.backends.quantized.engine = engine
+
+    model = copy.deepcopy(model).cpu().eval()
+    encoder = prepare_fx(
+        model.image_encoder,
+        get_default_qconfig_mapping(engine),
+        example_inputs=(calibration_volumes[0],),
+    )
+    with torch.no_grad():
+        for volume in calibration_volumes:
+            encoder(volume.cpu())
+    model.image_encoder = convert_fx(encoder)
+
+    model.pool = quantize_dynamic(model.pool, {nn.Linear}, dtype=torch.qint8)
+    model.prob_of_failure_layer = quantize_dynamic(
+        model.prob_of_failure_layer, {nn.Linear}, dtype=torch.qint8
+    )
+    return model
+
+
+def score_drift(reference_scores, scores) -> ScoreDrift:
+    """Compare risk scores, e.g. of a quantized model, to reference scores.
+
+    Parameters
+    ----------
+    reference_scores : array-like
+        Reference scores of shape (num_series, max_followup), e.g. Prediction.scores in fp32.
+    scores : array-like
+        Scores to compare, of the same shape.
+
+    Returns
+    -------
+    ScoreDrift
+        Mean and max absolute difference per follow-up year.
+    """
+    reference_scores = np.asarray(reference_scores, dtype=np.float64)
+    scores = np.asarray(scores, dtype=np.float64)
+    if reference_scores.shape != scores.shape:
+        raise ValueError(
+            f"Scores of shape {scores.shape} do not match reference of shape {reference_scores.shape}"
+        )
+    drift = np.abs(scores - reference_scores)
+    return ScoreDrift(
+        mean_abs=drift.mean(axis=0).tolist(),
+        max_abs=drift.max(axis=0).tolist(),
+        num_series=len(drift),
+    )
@@ -1,3 +1,5 @@
+import math
+
 import torch
 import torch.nn as nn
 import torchvision
@@ -5,14 +7,26 @@ from sybil.models.cumulative_probability_layer import Cumulative_Probability_Lay
 from sybil.models.pooling_layer import MultiAttentionPool
 from sybil.datasets.nlst_risk_factors import NLSTRiskFactorVectorizer
 
+# Depth stride of the r3d_18 encoder, in input slices
+ENCODER_DEPTH_STRIDE = 8
+# Radius of the encoder receptive field along depth (54 slices),
+# rounded up to the stride so that slabs stay aligned with the output
+ENCODER_DEPTH_HALO = 56
+
 
 class SybilNet(nn.Module):
-    def __init__(self, args):
+    def __init__(self, args, pretrained_backbone=True):
+        """
+        args: model configuration, needs `dropout` and `max_followup`
+        pretrained_backbone: initialize the r3d_18 encoder with Kinetics weights.
+            Set to False when the weights will be loaded from a Sybil checkpoint anyway,
+            which avoids downloading them.
+        """
         super(SybilNet, self).__init__()
 
         self.hidden_dim = 512
 
-        encoder = torchvision.models.video.r3d_18(pretrained=True)
+        encoder = torchvision.models.video.r3d_18(pretrained=pretrained_backbone)
         self.image_encoder = nn.Sequential(*list(encoder.children())[:-2])
 
         self.pool = MultiAttentionPool()
@@ -24,9 +38,28 @@ class SybilNet(nn.Module):
             self.hidden_dim, args, max_followup=args.max_followup
         )
 
-    def forward(self, x, batch=None):
+    def forward(self, x, batch=None, autocast_dtype=None, slab_size=None, output_keys=None):
+        """
+        autocast_dtype: if given, e.g. torch.bfloat16, the encoder runs under autocast
+            with this dtype. Pooling and the hazard layer always run in float32.
+        slab_size: if given, the encoder runs over slabs of this many slices, see encode_slabs.
+        output_keys: if given, only these outputs are returned, e.g. ["logit"] for inference.
+            The encoder feature map ("activ") and pooling intermediates are then released
+            as soon as they are no longer needed, instead of being kept in the output.
+        """
         output = {}
-        x = self.image_encoder(x)
+        x = self.encode(x, autocast_dtype, slab_size)
+        if output_keys is not None:
+            output_keys = set(output_keys)
+            if "activ" in output_keys:
+                output["activ"] = x
+            pool_output = self.aggregate_and_classify(x, output_keys)
+            del x
+            output.update(pool_output)
+            if "prob" in output_keys:
+                output["prob"] = pool_output["logit"].sigmoid()
+            return {key: val for key, val in output.items() if key in output_keys}
+
         pool_output = self.aggregate_and_classify(x)
         output["activ"] = x
         output.update(pool_output)
@@ -34,8 +67,54 @@ class SybilNet(nn.Module):
 
         return output
 
-    def aggregate_and_classify(self, x):
-        pool_output = self.pool(x)
+    def encode(self, x, autocast_dtype=None, slab_size=None):
+        if autocast_dtype is None:
+            return self._encode(x, slab_size)
+        with torch.autocast(x.device.type, dtype=autocast_dtype):
+            x = self._encode(x, slab_size)
+        return x.float()
+
+    def _encode(self, x, slab_size=None):
+        if slab_size is None or slab_size >= x.shape[2]:
+            return self.image_encoder(x)
+        return self.encode_slabs(x, slab_size)
+
+    def encode_slabs(self, x, slab_size):
+        """
+        Runs the encoder over consecutive depth slabs of `slab_size` slices, and stitches
+        their feature maps into the (B, 512, T', H', W') map of the whole volume.
+        Each slab is extended by ENCODER_DEPTH_HALO slices on both sides, which covers
+        the receptive field of the encoder, so the feature map is the same as in one pass.
+        Peak memory follows the depth of the extended slabs instead of the volume's.
+
+        x: volume of shape (B, C, T, H, W)
+        slab_size: number of slices per slab, a multiple of ENCODER_DEPTH_STRIDE
+        """
+        if slab_size <= 0 or slab_size % ENCODER_DEPTH_STRIDE != 0:
+            raise ValueError(
+                "slab_size should be a positive multiple of {}".format(ENCODER_DEPTH_STRIDE)
+            )
+        depth = x.shape[2]
+        output = None
+        for start in range(0, depth, slab_size):
+            end = min(start + slab_size, depth)
+            low = max(0, start - ENCODER_DEPTH_HALO)
+            high = min(depth, end + ENCODER_DEPTH_HALO)
+            features = self.image_encoder(x[:, :, low:high])
+
+            # Keep the features of the slab itself, without its halos
+            first = (start - low) // ENCODER_DEPTH_STRIDE
+            length = math.ceil((end - start) / ENCODER_DEPTH_STRIDE)
+            if output is None:
+                B, C, _, H, W = features.shape
+                output = features.new_empty(B, C, math.ceil(depth / ENCODER_DEPTH_STRIDE), H, W)
+            out_start = start // ENCODER_DEPTH_STRIDE
+            output[:, :, out_start : out_start + length] = features[:, :, first : first + length]
+            del features
+        return output
+
+    def aggregate_and_classify(self, x, output_keys=None):
+        pool_output = self.pool(x, output_keys=output_keys)
 
         pool_output["hidden"] = self.relu(pool_output["hidden"])
         pool_output["hidden"] = self.dropout(pool_output["hidden"])
@@ -43,11 +122,39 @@ class SybilNet(nn.Module):
 
         return pool_output
 
+    def fuse_input_channels(self):
+        """
+        Inference optimization for grayscale input, replicated over the 3 input channels.
+        The first convolution of the encoder is replaced by a single channel one,
+        with its kernel summed over the input channels. The model then takes
+        (B, 1, T, H, W) volumes, and gives the same outputs up to floating point error.
+        """
+        stem = self.image_encoder[0][0]
+        if stem.in_channels == 1:
+            return self
+
+        fused = nn.Conv3d(
+            1,
+            stem.out_channels,
+            kernel_size=stem.kernel_size,
+            stride=stem.stride,
+            padding=stem.padding,
+            bias=stem.bias is not None,
+        ).to(stem.weight.device, stem.weight.dtype)
+        with torch.no_grad():
+            fused.weight.copy_(stem.weight.sum(dim=1, keepdim=True))
+            if stem.bias is not None:
+                fused.bias.copy_(stem.bias)
+        fused.weight.requires_grad_(stem.weight.requires_grad)
+        self.image_encoder[0][0] = fused
+        return self
+
     @staticmethod
     def load(path):
-        checkpoint = torch.load(path, map_location="cpu")
+        checkpoint = torch.load(path, map_location="cpu", weights_only=False)
         args = checkpoint["args"]
-        model = SybilNet(args)
+        # Encoder weights come from the checkpoint
+        model = SybilNet(args, pretrained_backbone=False)
 
         # Remove 'model' from param names
         state_dict = {k[6:]: v for k, v in checkpoint["state_dict"].items()}
@@ -56,8 +163,9 @@ class SybilNet(nn.Module):
 
 
 class RiskFactorPredictor(SybilNet):
-    def __init__(self, args):
-        super(RiskFactorPredictor, self).__init__(args)
+    def __init__(self, args, pretrained_backbone=True):
+        super(RiskFactorPredictor, self).__init__(args, pretrained_backbone)
+        self.args = args
 
         self.length_risk_factor_vector = NLSTRiskFactorVectorizer(args).vector_length
         for key in args.risk_factor_keys:
@@ -65,10 +173,9 @@ class RiskFactorPredictor(SybilNet):
             key_fc = nn.Linear(args.hidden_dim, num_key_features)
             self.add_module("{}_fc".format(key), key_fc)
 
-    def forward(self, x, batch):
-        output = {}
+    def forward(self, x, batch=None):
         x = self.image_encoder(x)
-        output = self.pool(x, batch)
+        output = self.pool(x)
 
         hidden = output["hidden"]
         for indx, key in enumerate(self.args.risk_factor_keys):
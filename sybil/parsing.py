@@ -407,6 +407,12 @@ def parse_args(args_strings=None):
         default=8,
         help="Num workers for each data loader [default: 4]",
     )
+    parser.add_argument(
+        "--io_workers",
+        type=int,
+        default=1,
+        help="Num threads used to read and decode the DICOM files of a series [default: 1]",
+    )
 
     # storing results
     parser.add_argument(
@@ -444,6 +450,12 @@ def parse_args(args_strings=None):
     parser.add_argument(
         "--cache_path", type=str, default=None, help="Dir to cache images."
     )
+    parser.add_argument(
+        "--cache_size_gb",
+        type=float,
+        default=None,
+        help="Size budget of the image cache in GB. Least recently used files are evicted beyond it.",
+    )
     parser.add_argument(
         "--cache_full_img",
         action="store_true",
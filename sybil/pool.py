@@ -0,0 +1,338 @@
+import functools
+import os
+import queue
+import traceback
+from typing import Callable, Dict, List, Optional, Union
+
+import torch
+import torch.multiprocessing as mp
+
+from sybil.model import Prediction, Sybil, _torch_set_num_threads
+from sybil.serie import Serie
+from sybil.utils.device_utils import get_available_devices
+from sybil.utils.logging_utils import get_logger
+
+# Threads per CPU worker by default, see _torch_set_num_threads
+DEFAULT_WORKER_THREADS = 8
+# Batches of series queued per worker, so that a worker always has one ready
+# when it finishes one
+TASKS_PER_WORKER = 2
+# Seconds between checks that the workers are still alive
+POLL_INTERVAL = 1.0
+# Seconds to wait for workers to exit on close
+JOIN_TIMEOUT = 10
+
+
+def _create_sybil(name_or_path, device, **sybil_kwargs) -> Sybil:
+    return Sybil(name_or_path, device=device, **sybil_kwargs)
+
+
+def _attach_shared(model, device) -> Sybil:
+    # The weights were received from the pool through shared memory,
+    # moving them to the CPU keeps them there
+    model.to(device)
+    return model
+
+
+def _make_serie(item, serie_kwargs) -> Serie:
+    if isinstance(item, dict):
+        return Serie(**{**serie_kwargs, **item})
+    return Serie(item, **serie_kwargs)
+
+
+def _worker_main(worker_id, model_factory, model_args, device, threads, tasks, results):
+    """Loop of a worker process: load the model, then predict the series sent to it."""
+    try:
+        _torch_set_num_threads(threads)
+        model = model_factory(*model_args, device=device)
+    except BaseException:
+        results.put(("failed", worker_id, None, traceback.format_exc()))
+        return
+    results.put(("ready", worker_id, None, None))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        index, items, serie_kwargs, predict_kwargs = task
+        try:
+            series = [_make_serie(item, serie_kwargs) for item in items]
+            pred = model.predict(series, threads=threads, **predict_kwargs)
+            results.put(("done", worker_id, index, pred))
+        except Exception:
+            results.put(("error", worker_id, index, traceback.format_exc()))
+
+
+class SybilPool:
+    def __init__(
+        self,
+        name_or_path: Union[List[str], str] = "sybil_ensemble",
+        num_workers: Optional[int] = None,
+        threads_per_worker: Optional[int] = None,
+        devices: Optional[List[Union[str, torch.device]]] = None,
+        max_restarts: int = 3,
+        serie_kwargs: Optional[Dict] = None,
+        model_factory: Optional[Callable[..., Sybil]] = None,
+        share_weights: bool = False,
+        **sybil_kwargs,
+    ):
+        """Pool of worker processes, each holding a loaded Sybil model.
+
+        Series are sent to the workers as file paths, in batches, loaded and predicted
+        there, and the predictions gathered in input order. A worker process which dies
+        is started again and its pending series are sent to it again.
+
+        Parameters
+        ----------
+        name_or_path: list or str
+            Model to load in every worker, see Sybil.
+        num_workers: int, optional
+            Number of worker processes. By default, one per GPU, or on CPU
+            one per `threads_per_worker` cores.
+        threads_per_worker: int, optional
+            CPU threads of each worker, see _torch_set_num_threads.
+            By default, 8 on CPU and 0 (up to 8) on GPU.
+        devices: list, optional
+            Device of each worker. By default, from get_available_devices,
+            cycling over GPUs or all on CPU.
+        max_restarts: int
+            Maximum number of times a worker process is restarted after dying,
+            e.g. running out of memory, before the pool gives up.
+        serie_kwargs: dict, optional
+            Arguments of Serie for every serie, e.g. {"file_type": "dicom"}.
+        model_factory: callable, optional
+            Picklable function creating the model of a worker, called as
+            model_factory(name_or_path, device=device, **sybil_kwargs).
+            By default, creates a Sybil.
+        share_weights: bool
+            If True, the model is created once in this process with its weights in
+            shared memory, see Sybil.share_memory, and the workers use them instead
+            of loading their own copy. Workers then all run on CPU.
+        sybil_kwargs:
+            Other arguments of Sybil, e.g. calibrator_path or precision.
+        """
+        self._logger = get_logger()
+        cpu_count = os.cpu_count() or 1
+        if devices is None:
+            if num_workers is None and not torch.cuda.is_available():
+                num_workers = max(1, cpu_count // (threads_per_worker or DEFAULT_WORKER_THREADS))
+            devices = get_available_devices(num_devices=num_workers)
+        if num_workers is None:
+            num_workers = len(devices)
+        if num_workers < 1 or len(devices) < num_workers:
+            raise ValueError(f"Expected at least one device per worker, got {len(devices)} for {num_workers}")
+        self.devices = [torch.device(device) for device in devices[:num_workers]]
+
+        if threads_per_worker is None:
+            on_cpu = all(device.type == "cpu" for device in self.devices)
+            threads_per_worker = max(1, min(DEFAULT_WORKER_THREADS, cpu_count // num_workers)) if on_cpu else 0
+        self.threads_per_worker = threads_per_worker
+        self.num_workers = num_workers
+        self.max_restarts = max_restarts
+        self.restarts = 0
+        self.serie_kwargs = dict(serie_kwargs or {})
+
+        model_factory = model_factory or _create_sybil
+        if sybil_kwargs:
+            model_factory = functools.partial(model_factory, **sybil_kwargs)
+        self._model_factory = model_factory
+        self._model_args = (name_or_path,)
+        # Model whose weights the workers share, kept alive as long as the pool
+        self.shared_model = None
+        if share_weights:
+            if any(device.type != "cpu" for device in self.devices):
+                raise ValueError("Shared weights are only supported with CPU workers")
+            self.shared_model = model_factory(name_or_path, device="cpu").share_memory()
+            self._model_factory = _attach_shared
+            self._model_args = (self.shared_model,)
+
+        # Spawned processes, so that workers can use CUDA
+        self._ctx = mp.get_context("spawn")
+        self._results = self._ctx.Queue()
+        self._workers: List[Optional[mp.Process]] = [None] * num_workers
+        self._tasks: List[Optional[mp.Queue]] = [None] * num_workers
+        # Series sent to each worker and not returned yet, by index
+        self._assigned: List[Dict[int, tuple]] = [{} for _ in range(num_workers)]
+        self._closed = False
+        for worker_id in range(num_workers):
+            self._start_worker(worker_id)
+        self._wait_ready()
+
+    def _start_worker(self, worker_id: int):
+        self._tasks[worker_id] = self._ctx.Queue()
+        worker = self._ctx.Process(
+            target=_worker_main,
+            args=(
+                worker_id,
+                self._model_factory,
+                self._model_args,
+                self.devices[worker_id],
+                self.threads_per_worker,
+                self._tasks[worker_id],
+                self._results,
+            ),
+            name=f"sybil-worker-{worker_id}",
+            daemon=True,
+        )
+        worker.start()
+        self._workers[worker_id] = worker
+        self._logger.debug(
+            f"Started worker {worker_id} on {self.devices[worker_id]} "
+            f"with {self.threads_per_worker} threads"
+        )
+
+    def _wait_ready(self):
+        """Wait until every worker has loaded its model."""
+        num_ready = 0
+        while num_ready < self.num_workers:
+            message = self._get_result()
+            if message is None:
+                continue
+            kind, worker_id, _, error = message
+            if kind == "failed":
+                self.close()
+                raise RuntimeError(f"Worker {worker_id} failed to load the model:\n{error}")
+            if kind == "ready":
+                num_ready += 1
+
+    def _get_result(self):
+        """Next message from the workers, or None if there was none within POLL_INTERVAL.
+
+        Dead workers are restarted first, so that a worker dying while the others
+        keep sending results is noticed.
+        """
+        for worker_id, worker in enumerate(self._workers):
+            if not worker.is_alive():
+                self._restart_worker(worker_id)
+        try:
+            return self._results.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            return None
+
+    def _restart_worker(self, worker_id: int):
+        worker = self._workers[worker_id]
+        if self.restarts >= self.max_restarts:
+            self.close()
+            raise RuntimeError(
+                f"Worker {worker_id} died with exit code {worker.exitcode}, "
+                f"after {self.restarts} restarts"
+            )
+        self.restarts += 1
+        self._logger.warning(
+            f"Worker {worker_id} died with exit code {worker.exitcode}, restarting it"
+        )
+        self._start_worker(worker_id)
+        # Send again the series the worker did not return
+        for task in self._assigned[worker_id].values():
+            self._tasks[worker_id].put(task)
+
+    def _assign(self, worker_id: int, task: tuple):
+        self._assigned[worker_id][task[0]] = task
+        self._tasks[worker_id].put(task)
+
+    def predict(
+        self,
+        series: List[Union[List[str], Dict]],
+        return_attentions: bool = False,
+        batch_size: Optional[int] = None,
+        precision: Optional[str] = None,
+    ) -> Prediction:
+        """Run predictions for series spread over the workers.
+
+        Parameters
+        ----------
+        series : List[Union[List[str], Dict]]
+            Series as lists of file paths, or as dicts of Serie arguments,
+            combined with `serie_kwargs`.
+        return_attentions : bool
+            If True, returns attention scores for each serie. See README for details.
+        batch_size : int, optional
+            Number of series sent to a worker at once and run through the model
+            together, see Sybil.predict. By default, series are sent one by one.
+        precision : str, optional
+            See Sybil.predict.
+
+        Returns
+        -------
+        Prediction
+            Scores and attentions of the series, in input order.
+        """
+        if self._closed:
+            raise RuntimeError("The pool is closed")
+        batch_size = batch_size or 1
+        predict_kwargs = {"return_attentions": return_attentions, "batch_size": batch_size}
+        if precision is not None:
+            predict_kwargs["precision"] = precision
+        batches = [
+            series[start : start + batch_size] for start in range(0, len(series), batch_size)
+        ]
+        todo = [
+            (index, batch, self.serie_kwargs, predict_kwargs)
+            for index, batch in enumerate(batches)
+        ][::-1]
+        predictions: List[Optional[Prediction]] = [None] * len(batches)
+        errors = {}
+
+        def fill():
+            # Least loaded workers first
+            for worker_id in sorted(range(self.num_workers), key=lambda i: len(self._assigned[i])):
+                while todo and len(self._assigned[worker_id]) < TASKS_PER_WORKER:
+                    self._assign(worker_id, todo.pop())
+
+        fill()
+        num_done = 0
+        while num_done < len(batches):
+            message = self._get_result()
+            if message is None:
+                continue
+            kind, worker_id, index, payload = message
+            if kind == "failed":
+                # A restarted worker could not load the model
+                self.close()
+                raise RuntimeError(f"Worker {worker_id} failed to load the model:\n{payload}")
+            if kind not in ("done", "error") or index not in self._assigned[worker_id]:
+                continue
+            del self._assigned[worker_id][index]
+            num_done += 1
+            if kind == "done":
+                predictions[index] = payload
+            else:
+                errors[index] = payload
+            fill()
+
+        if errors:
+            index = min(errors)
+            start = index * batch_size
+            end = start + len(batches[index]) - 1
+            raise RuntimeError(
+                f"Prediction failed for {len(errors)} batches, first for series {start} to {end}:"
+                f"\n{errors[index]}"
+            )
+
+        scores = [score for pred in predictions for score in pred.scores]
+        attentions = None
+        if return_attentions:
+            attentions = [attention for pred in predictions for attention in pred.attentions]
+        return Prediction(scores=scores, attentions=attentions)
+
+    def close(self):
+        """Stop the worker processes."""
+        if self._closed:
+            return
+        self._closed = True
+        for worker, tasks in zip(self._workers, self._tasks):
+            if worker is not None and worker.is_alive():
+                tasks.put(None)
+        for worker in self._workers:
+            if worker is None:
+                continue
+            worker.join(JOIN_TIMEOUT)
+            if worker.is_alive():
+                worker.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
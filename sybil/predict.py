@@ -9,7 +9,7 @@ import json
 import os
 import pickle
 import typing
-from typing import Literal
+from typing import Literal, Optional
 
 import sybil.utils.logging_utils
 import sybil.datasets.utils
@@ -73,6 +73,21 @@ def _get_parser():
                              "Default is 0 (use all available cores)."
                              "Set to a negative number to use Pytorch default.")
 
+    parser.add_argument(
+        "--backend",
+        default="torch",
+        choices=["torch", "onnxruntime"],
+        help="Run inference with PyTorch, or with onnxruntime on CPU.",
+    )
+
+    parser.add_argument(
+        "--result-cache",
+        default=None,
+        dest="result_cache",
+        help="Path of a SQLite database to store predictions in, "
+             "and reuse them for series with the same content.",
+    )
+
     parser.add_argument("-v", "--version", action="version", version=__version__)
 
     return parser
@@ -86,6 +101,8 @@ def predict(
     write_attention_images=False,
     file_type: Literal["auto", "dicom", "png"] = "auto",
     threads: int = 0,
+    backend: Literal["torch", "onnxruntime"] = "torch",
+    result_cache: Optional[str] = None,
 ):
     logger = sybil.utils.logging_utils.get_logger()
 
@@ -117,7 +134,7 @@ def predict(
     logger.debug(f"Beginning prediction using {num_files} {file_type} files from {image_dir}")
 
     # Load a trained model
-    model = Sybil(model_name)
+    model = Sybil(model_name, backend=backend, result_cache=result_cache)
 
     # Get risk scores
     serie = Serie(input_files, voxel_spacing=voxel_spacing, file_type=file_type)
@@ -163,6 +180,8 @@ def main():
         args.write_attention_images,
         file_type=args.file_type,
         threads=args.threads,
+        backend=args.backend,
+        result_cache=args.result_cache,
     )
 
     print(json.dumps(pred_dict, indent=2))
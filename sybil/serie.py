@@ -1,16 +1,20 @@
-import functools
+import hashlib
+import uuid
+import weakref
 from typing import List, Optional, NamedTuple, Literal
 from argparse import Namespace
 
 import torch
 import numpy as np
-import pydicom
 import torchio as tio
 import SimpleITK as sitk
 import os
 
 from sybil.datasets.utils import order_slices, VOXEL_SPACING
+from sybil.loaders.image_loaders import get_num_io_workers, parallel_map, read_dicoms
+from sybil.utils.hashing import file_md5
 from sybil.utils.loading import get_sample_loader
+from sybil.utils.volume_cache import get_volume_cache, discard_volume
 
 
 # torch.manual_seed(42)
@@ -33,6 +37,14 @@ class Label(NamedTuple):
     censor_time: int
 
 
+def read_image_information(path: str) -> sitk.ImageFileReader:
+    """Read the header of an image file (size, spacing, meta data) without its pixels."""
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    return reader
+
+
 class Serie:
     def __init__(
         self,
@@ -44,6 +56,8 @@ class Serie:
         seed = seed,
         file_type: Literal["png", "dicom","mha"] = "mha",
         split: Literal["train", "dev", "test"] = "test",
+        num_workers: Optional[int] = None,
+        keep_pixel_data: bool = True,
     ):
         """Initialize a Serie.
 
@@ -65,6 +79,16 @@ class Serie:
         `split`: Literal['train', 'dev', 'test']
             Dataset split into which the serie falls into.
             Assumed to be test by default
+        `num_workers`: Optional[int]
+            Number of threads used to read and decode DICOM files.
+            By default, based on the number of CPUs. Set to 0 to read sequentially.
+        `keep_pixel_data`: bool
+            For DICOM series, whether the files read for the metadata are kept, with
+            their still encoded pixel data, until the volume is loaded, so that each
+            file is read once. This holds about the size of the files in memory per
+            serie, often hundreds of MB for a CT exam, from creation until get_volume.
+            Set to False when creating many series ahead of inference: only the
+            headers are read here, and the files are read again by get_volume.
         """
         if label is not None and censor_time is None:
             raise ValueError("censor_time should also provided with label.")
@@ -76,8 +100,12 @@ class Serie:
         self.file_type = file_type
         self.mha3d = mha3d
         self._label = label
-        args = self._load_args(file_type)
+        self._keep_pixel_data = keep_pixel_data
+        args = self._load_args(file_type, num_workers)
         self._args = args
+        # DICOM files read while loading the metadata, reused for the pixel data
+        self._datasets = None
+        self._fingerprint = None
         self._loader = get_sample_loader(split, args)
         self._meta = self._load_metadata(dicoms, voxel_spacing, file_type)
         self._check_valid(args)
@@ -85,6 +113,10 @@ class Serie:
         self.padding_transform = tio.transforms.CropOrPad(
             target_shape=tuple(args.img_size + [args.num_images]), padding_mode=0
         )
+        # Key of this serie's volume in the shared volume cache,
+        # the cached volume is dropped along with the serie
+        self._volume_key = f"serie-{uuid.uuid4().hex}"
+        weakref.finalize(self, discard_volume, self._volume_key)
     
     def break_mha_into_slices(self, input_mha_file):
         sitk_image = sitk.ReadImage(input_mha_file)
@@ -179,30 +211,95 @@ class Serie:
         images = [i["input"] for i in input_dicts]
         return images
 
-    @functools.lru_cache
-    def get_volume(self) -> torch.Tensor:
+    def get_volume(self, num_chan: int = 3) -> torch.Tensor:
         """
-        Load loaded 3D CT volume
+        Load loaded 3D CT volume.
+        The volume is kept in the shared volume cache, see sybil.utils.volume_cache.
+
+        Parameters
+        ----------
+        num_chan : int
+            Number of channels, copies of the same grayscale volume.
+            The channels are an expanded view of a single one.
 
         Returns
         -------
         torch.Tensor
-            CT volume of shape (1, C, N, H, W)
+            CT volume of shape (1, num_chan, N, H, W)
+        """
+        cache = get_volume_cache()
+        x = cache.get(self._volume_key)
+        if x is None:
+            x = self._load_volume()
+            cache.put(self._volume_key, x)
+        if num_chan != x.shape[1]:
+            x = x.expand(-1, num_chan, -1, -1, -1)
+        return x
+
+    def fingerprint(self) -> str:
+        """
+        Content fingerprint of the serie, e.g. to cache its predictions.
+        For DICOM series, made of the SOPInstanceUID and a hash of the still encoded
+        pixel data of every slice, in slice order. Otherwise, a hash of every file.
+        The voxel spacing the volume is resampled with is included as well.
+
+        Returns
+        -------
+        str
+            md5 hex digest
+        """
+        if self._fingerprint is not None:
+            return self._fingerprint
+
+        voxel_spacing = self._meta.voxel_spacing
+        digest = hashlib.md5()
+        digest.update(repr((
+            self.file_type,
+            self.mha3d,
+            None if voxel_spacing is None else voxel_spacing.tolist(),
+        )).encode())
+        if self.file_type == "dicom":
+            datasets = self._datasets
+            if datasets is None:
+                # Pixel data was not kept, or already decoded into the volume
+                datasets = read_dicoms(self._meta.paths, self._args.io_workers)
+            slice_hashes = parallel_map(
+                lambda dcm: hashlib.md5(dcm.PixelData).hexdigest(), datasets, self._args.io_workers
+            )
+            for dcm, slice_hash in zip(datasets, slice_hashes):
+                digest.update("{} {}".format(dcm.SOPInstanceUID, slice_hash).encode())
+        else:
+            paths = self._meta.paths
+            if isinstance(paths, str):
+                paths = [paths]
+            for file_hash in parallel_map(file_md5, paths, self._args.io_workers):
+                digest.update(file_hash.encode())
+
+        self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    def drop_volume(self):
+        """Remove this serie's volume from the volume cache."""
+        discard_volume(self._volume_key)
+
+    def _load_volume(self) -> torch.Tensor:
+        """
+        Load and preprocess the 3D CT volume
+
+        Returns
+        -------
+        torch.Tensor
+            CT volume of shape (1, 1, N, H, W)
         """
         sample = {"seed": 1} #?
-        if self.file_type == 'mha':
-            # mha 3d
-            if self.mha3d:
-                input_dicts = [self._loader.get_image3d(self._meta.paths[0],sample, image) for image in self.break_mha_into_slices(self._meta.paths)]
-            else:
-                input_dicts = [self._loader.get_image(path, sample) for path in self._meta.paths]
-                
-        elif self.file_type == 'dicom':
-            input_dicts = [
-                self._loader.get_image(path) for path in self._meta.paths
-            ]
+        if self.file_type == 'mha' and self.mha3d:
+            input_dict = self._loader.get_volume3d(self._meta.paths, sample)
+        else:
+            input_dict = self._loader.get_volume(self._meta.paths, sample, self._datasets)
+            # The decoded volume is all we need from here on
+            self._datasets = None
 
-        x = torch.cat([i["input"].unsqueeze(0) for i in input_dicts], dim=0)
+        x = input_dict["input"]
 
         # Convert from (T, C, H, W) to (C, T, H, W)
         x = x.permute(1, 0, 2, 3)
@@ -236,16 +333,19 @@ class Serie:
             slice_positions: list of indices for dicoms along z-axis
         """
         if file_type == "dicom":
-            slice_positions = []
-            processed_paths = []
-            for path in paths:
-                dcm = pydicom.dcmread(path, stop_before_pixels=True)
-                processed_paths.append(path)
-                slice_positions.append(float(dcm.ImagePositionPatient[-1]))
+            # Read each file once, keeping the pixel data for get_volume if asked to
+            datasets = read_dicoms(
+                paths, self._args.io_workers, stop_before_pixels=not self._keep_pixel_data
+            )
+            slice_positions = [float(dcm.ImagePositionPatient[-1]) for dcm in datasets]
 
             processed_paths, slice_positions = order_slices(
-                processed_paths, slice_positions
+                list(paths), slice_positions
             )
+            if self._keep_pixel_data:
+                path_to_dataset = dict(zip(paths, datasets))
+                self._datasets = [path_to_dataset[path] for path in processed_paths]
+            dcm = datasets[-1]
 
             thickness = float(dcm.SliceThickness)
             pixel_spacing = list(map(float, dcm.PixelSpacing))
@@ -267,30 +367,28 @@ class Serie:
                 paths = paths[0]
                 processed_paths = paths
                 slice_positions = list(range(len(paths)))
-                
-                for path in paths:
-                    itk_image = sitk.ReadImage(str(path), sitk.sitkFloat64)
-                    
 
-                thickness = (float(itk_image.GetMetaData("SliceThickness")))
-                pixelspacingstring = itk_image.GetMetaData("PixelSpacing")
+                # Only the header of the last slice is needed
+                reader = read_image_information(str(paths[-1]))
+                thickness = (float(reader.GetMetaData("SliceThickness")))
+                pixelspacingstring = reader.GetMetaData("PixelSpacing")
                 pixel_spacing = list(map(float, pixelspacingstring.split()))
                 manufacturer = ""
                 voxel_spacing = torch.tensor(pixel_spacing + [thickness])
             else:
             # mha 3d
-                itk_image = sitk.ReadImage(paths[0], sitk.sitkFloat64)
-                ar = np.shape(sitk.GetArrayFromImage(itk_image))
-                slice_positions = list(range(ar[0]))
-
-                itk_image = self.break_mha_into_slices(paths[0])[0]
-                thickness = (float(itk_image.GetMetaData("SliceThickness")))
-                pixelspacingstring = itk_image.GetMetaData("PixelSpacing")
-                pixel_spacing = list(map(float, pixelspacingstring.split()))
+                # Header only, the pixels are read once in get_volume
+                reader = read_image_information(paths[0])
+                slice_positions = list(range(reader.GetSize()[2]))
+
+                # Same spacing as set on the slices by break_mha_into_slices
+                spacing = reader.GetSpacing()
+                thickness = float(spacing[2]) if len(spacing) >= 3 else None
+                pixel_spacing = list(map(float, spacing))
                 manufacturer = ""
-                voxel_spacing = torch.tensor(pixel_spacing + [thickness])
+                voxel_spacing = torch.tensor(pixel_spacing + [thickness]) if thickness is not None else None
                 processed_paths = paths[0]
-                
+
         meta = Meta(
                 paths = processed_paths,
                 thickness=thickness,
@@ -301,7 +399,7 @@ class Serie:
                         )
         return meta
 
-    def _load_args(self, file_type):
+    def _load_args(self, file_type, num_workers=None):
         """
         Load default args required for a single Serie volume
 
@@ -309,6 +407,8 @@ class Serie:
         ----------
         file_type : Literal['png', 'dicom']
             File type of CT slices
+        num_workers : Optional[int]
+            Number of threads used to read and decode DICOM files
 
         Returns
         -------
@@ -322,11 +422,14 @@ class Serie:
                 "img_std": [87.1849],
                 "num_images": 200,
                 "img_file_type": file_type,
-                "num_chan": 3,
+                # Grayscale channels are only replicated by get_volume,
+                # after resampling
+                "num_chan": 1,
                 "cache_path": None,
                 "use_annotations": False,
                 "fix_seed_for_multi_image_augmentations": True,
                 "slice_thickness_filter": 5,
+                "io_workers": get_num_io_workers(num_workers),
             }
         )
         return args
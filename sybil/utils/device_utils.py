@@ -51,6 +51,33 @@ def get_device_mem_info(device: Union[int, torch.device]):
     return free_mem, total_mem
 
 
+def get_available_memory(device: Union[str, torch.device, None]):
+    """
+    Get the approximate number of free bytes on `device`.
+    For CPU devices this is the memory available to new allocations on the host.
+    Returns None if it cannot be determined.
+    """
+    device = torch.device(device) if device is not None else torch.device('cpu')
+    if device.type == "cuda":
+        mem_info = get_device_mem_info(device)
+        return mem_info[0] if mem_info is not None else None
+    elif device.type != "cpu":
+        return None
+
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
 def get_most_free_gpu():
     """
     Get the GPU with the most free memory
@@ -0,0 +1,261 @@
+import hashlib
+import http.client
+import json
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+from zipfile import ZipFile
+
+from sybil.utils.hashing import CHUNK_SIZE, file_digest, file_md5
+from sybil.utils.logging_utils import get_logger
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+# Attempts to finish a download, each resuming where the previous one stopped
+DOWNLOAD_ATTEMPTS = 5
+DOWNLOAD_TIMEOUT = 60
+LOCK_POLL_INTERVAL = 0.5
+PARTIAL_EXT = ".part"
+# Checksum of a verified file, with its size and modification time
+VERIFIED_EXT = ".md5"
+
+
+class ChecksumError(ValueError):
+    pass
+
+
+@contextmanager
+def file_lock(path: str, timeout: Optional[float] = None):
+    """
+    Exclusive lock on the file at `path`, created if needed, shared by processes
+    and threads. It is released if the holder dies.
+    Raises TimeoutError if not acquired within `timeout` seconds.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    start = time.monotonic()
+    with open(path, "a+b") as f:
+        while True:
+            try:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                break
+            except OSError:
+                if timeout is not None and time.monotonic() - start > timeout:
+                    raise TimeoutError(f"Could not lock {path} within {timeout} seconds")
+                time.sleep(LOCK_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _stream_to(url: str, partial_path: str, digest) -> Tuple[bool, "hashlib._Hash"]:
+    """
+    Append the rest of `url` to `partial_path`, with a Range request from its size.
+    Returns whether the whole content was received, and the md5 digest of the file.
+    """
+    offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+    request = Request(url)
+    if offset:
+        request.add_header("Range", f"bytes={offset}-")
+    try:
+        response = urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+    except HTTPError as e:
+        if e.code == 416 and offset:
+            # Nothing left to download
+            return True, digest
+        raise
+
+    with response:
+        if offset and response.status != 206:
+            # The server does not support ranges, start over
+            offset = 0
+            digest = hashlib.md5()
+        expected_size = response.headers.get("Content-Length")
+        expected_size = offset + int(expected_size) if expected_size is not None else None
+        with open(partial_path, "r+b" if offset else "wb") as f:
+            f.seek(offset)
+            f.truncate()
+            for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+                f.write(chunk)
+                digest.update(chunk)
+            size = f.tell()
+    return expected_size is None or size >= expected_size, digest
+
+
+def download_file(
+    url: str, path: str, expected_md5: Optional[str] = None, attempts: int = DOWNLOAD_ATTEMPTS
+) -> str:
+    """Download `url` to `path`, streaming in chunks.
+
+    The content goes to `path` + ".part" first, and a download interrupted in this
+    or an earlier call resumes from there with an HTTP Range request.
+    The file is only moved to `path` once complete and matching `expected_md5`.
+
+    Parameters
+    ----------
+    url: str
+        URL to download.
+    path: str
+        Destination file.
+    expected_md5: str, optional
+        md5 hex digest of the content. Raises ChecksumError on mismatch.
+    attempts: int
+        Number of times to try, each resuming the previous one.
+
+    Returns
+    -------
+    str
+        `path`
+    """
+    logger = get_logger()
+    partial_path = path + PARTIAL_EXT
+    digest = file_digest(partial_path) if os.path.exists(partial_path) else hashlib.md5()
+    for attempt in range(1, attempts + 1):
+        try:
+            complete, digest = _stream_to(url, partial_path, digest)
+            if complete:
+                break
+            logger.warning(f"Download of {url} ended early, resuming")
+        except HTTPError:
+            raise
+        except (URLError, OSError, http.client.HTTPException) as e:
+            if attempt == attempts:
+                raise
+            logger.warning(f"Download of {url} failed ({e}), resuming")
+            # The digest may be missing the bytes of a chunk written before the failure
+            digest = file_digest(partial_path) if os.path.exists(partial_path) else hashlib.md5()
+    else:
+        raise IOError(f"Could not download {url} in {attempts} attempts")
+
+    if expected_md5 is not None and digest.hexdigest() != expected_md5:
+        os.remove(partial_path)
+        raise ChecksumError(f"md5 of {url} is {digest.hexdigest()}, expected {expected_md5}")
+    os.replace(partial_path, path)
+    return path
+
+
+def _checksum_record(path: str, md5: Optional[str] = None) -> Dict:
+    stat = os.stat(path)
+    return {"md5": md5, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _read_checksum(path: str) -> Optional[str]:
+    """md5 recorded next to the file at `path`, if the file did not change since"""
+    try:
+        with open(path + VERIFIED_EXT, "r") as f:
+            record = json.load(f)
+        if record == _checksum_record(path, record.get("md5")):
+            return record["md5"]
+    except (OSError, ValueError, AttributeError):
+        pass
+    return None
+
+
+def _write_checksum(path: str, md5: str):
+    # Files in a read-only folder are just not recorded
+    try:
+        with open(path + VERIFIED_EXT, "w") as f:
+            json.dump(_checksum_record(path, md5), f)
+    except OSError as e:
+        get_logger().debug(f"Could not record the checksum of {path}: {e}")
+
+
+def recorded_md5(path: str) -> str:
+    """
+    md5 hex digest of the file at `path`, from the record of verify_file if the
+    file did not change since. Otherwise the file is hashed, and the result recorded.
+    """
+    md5 = _read_checksum(path)
+    if md5 is None:
+        md5 = file_md5(path)
+        _write_checksum(path, md5)
+    return md5
+
+
+def verify_file(path: str, expected_md5: str) -> bool:
+    """
+    Whether the file at `path` has md5 `expected_md5`. The result is recorded next to
+    the file, and reused while its size and modification time do not change.
+    Files in a read-only folder are verified without being recorded.
+    """
+    if not os.path.isfile(path):
+        return False
+    return recorded_md5(path) == expected_md5
+
+
+def download_and_extract(
+    remote_url: str, local_dir: str, expected_md5s: Optional[Dict[str, str]] = None
+) -> List[str]:
+    """Download a zip archive and extract it into `local_dir`.
+
+    The archive is streamed to disk, see download_file, and removed once extracted.
+    Members are extracted to a temporary directory, checked against the CRCs of the
+    archive and `expected_md5s`, then moved into place, so `local_dir` never holds
+    partial files.
+
+    Parameters
+    ----------
+    remote_url: str
+        URL of the zip archive.
+    local_dir: str
+        Directory to extract to.
+    expected_md5s: Dict[str, str], optional
+        md5 hex digests of members, by name. Raises ChecksumError on mismatch.
+
+    Returns
+    -------
+    List[str]
+        Names of the archive members.
+    """
+    os.makedirs(local_dir, exist_ok=True)
+    expected_md5s = expected_md5s or {}
+    archive_name = os.path.basename(remote_url.split("?")[0]) or "download.zip"
+    archive_path = os.path.join(local_dir, archive_name)
+    download_file(remote_url, archive_path)
+
+    tmp_dir = tempfile.mkdtemp(dir=local_dir, prefix=".extract-")
+    try:
+        with ZipFile(archive_path) as zip_file:
+            bad_member = zip_file.testzip()
+            if bad_member is not None:
+                os.remove(archive_path)
+                raise ChecksumError(f"Corrupted member {bad_member} in {remote_url}")
+            all_files_and_dirs = zip_file.namelist()
+            zip_file.extractall(tmp_dir)
+
+        for name, expected_md5 in expected_md5s.items():
+            if not verify_file(os.path.join(tmp_dir, name), expected_md5):
+                os.remove(archive_path)
+                raise ChecksumError(f"md5 of {name} from {remote_url} does not match {expected_md5}")
+
+        for name in all_files_and_dirs:
+            src = os.path.join(tmp_dir, name)
+            if os.path.isdir(src):
+                continue
+            dst = os.path.join(local_dir, name)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            os.replace(src, dst)
+            if os.path.exists(src + VERIFIED_EXT):
+                os.replace(src + VERIFIED_EXT, dst + VERIFIED_EXT)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.remove(archive_path)
+    return all_files_and_dirs
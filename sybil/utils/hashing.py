@@ -0,0 +1,17 @@
+import hashlib
+
+CHUNK_SIZE = 2**20
+
+
+def file_digest(path, chunk_size=CHUNK_SIZE):
+    """md5 hash object of the content of the file at `path`, to update further"""
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest
+
+
+def file_md5(path, chunk_size=CHUNK_SIZE):
+    """md5 hex digest of the content of the file at `path`"""
+    return file_digest(path, chunk_size).hexdigest()
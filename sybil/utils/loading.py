@@ -7,7 +7,7 @@ import torch
 from torch.utils import data
 
 from sybil.utils.sampler import DistributedWeightedSampler
-from sybil.augmentations import get_augmentations
+from sybil.augmentations import get_augmentations, get_volume_augmentations
 from sybil.loaders.image_loaders import OpenCVLoader, DicomLoader, SimpleITKLoader
 
 string_classes = (str, bytes)
@@ -184,11 +184,18 @@ def get_sample_loader(
         img_file_type must be one of "dicom" or "png"
     """
     augmentations = get_augmentations(split_group, args)
+    volume_augmentations = get_volume_augmentations(split_group, args)
     if args.img_file_type == "dicom":
-        return DicomLoader(args.cache_path, augmentations, args, apply_augmentations)
+        return DicomLoader(
+            args.cache_path, augmentations, args, apply_augmentations, volume_augmentations
+        )
     elif args.img_file_type == "png":
-        return OpenCVLoader(args.cache_path, augmentations, args, apply_augmentations)
+        return OpenCVLoader(
+            args.cache_path, augmentations, args, apply_augmentations, volume_augmentations
+        )
     elif args.img_file_type == "mha":
-        return SimpleITKLoader(args.cache_path, augmentations, args)
+        return SimpleITKLoader(
+            args.cache_path, augmentations, args, volume_augmentations=volume_augmentations
+        )
     else:
         raise NotImplementedError
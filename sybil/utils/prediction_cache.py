@@ -0,0 +1,211 @@
+import io
+import json
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from sybil.utils.sqlite_index import EVICTION_LOW_WATER, SQLiteIndex
+
+
+class PredictionCacheStats(NamedTuple):
+    """
+    Statistics of a prediction cache, see SQLiteIndex
+    """
+
+    hits: int
+    misses: int
+    evictions: int
+    num_entries: int
+    bytes: int
+
+
+def _pack_attentions(attentions: Dict[str, np.ndarray]) -> bytes:
+    buffer = io.BytesIO()
+    np.savez(buffer, **attentions)
+    return buffer.getvalue()
+
+
+def _unpack_attentions(blob: bytes) -> Dict[str, np.ndarray]:
+    with np.load(io.BytesIO(blob), allow_pickle=False) as arrays:
+        return {key: arrays[key] for key in arrays.files}
+
+
+class PredictionCache(SQLiteIndex):
+    def __init__(
+        self,
+        path: str,
+        max_bytes: Optional[int] = None,
+        ttl: Optional[float] = None,
+    ):
+        """Persistent cache of Sybil predictions, in a SQLite database.
+
+        Entries are stored under a key built from the content of a serie and the model
+        that predicted it, see Sybil.predict. The database can be shared by processes,
+        see SQLiteIndex.
+
+        Parameters
+        ----------
+        path: str
+            Path of the SQLite database, created if needed.
+        max_bytes: int, optional
+            Byte budget of the stored scores and attentions. When adding an entry takes the
+            cache over the budget, expired entries then the least recently used ones are
+            evicted, down to `EVICTION_LOW_WATER` of the budget. Unbounded if None.
+        ttl: float, optional
+            Time to live of the entries in seconds, since they were added.
+            Entries never expire if None.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        super().__init__(path)
+        self._init_db()
+
+    def _init_db(self):
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS predictions "
+            "(key TEXT PRIMARY KEY, scores TEXT NOT NULL, attentions BLOB, "
+            "size INTEGER NOT NULL, ctime REAL NOT NULL, atime REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS predictions_atime ON predictions (atime)")
+        conn.execute("CREATE INDEX IF NOT EXISTS predictions_ctime ON predictions (ctime)")
+        self._init_totals(self._sum_sizes)
+
+    @staticmethod
+    def _sum_sizes(conn) -> int:
+        row = conn.execute("SELECT COALESCE(SUM(size), 0) FROM predictions").fetchone()
+        return row[0]
+
+    def _delete(self, conn, where: str, params: tuple) -> int:
+        """Deletes the entries matching `where`, within a transaction. Returns their number."""
+        num_entries, size = conn.execute(
+            f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM predictions WHERE {where}",
+            params,
+        ).fetchone()
+        conn.execute(f"DELETE FROM predictions WHERE {where}", params)
+        self._add_bytes(conn, -size)
+        return num_entries
+
+    def get(
+        self, key: str, with_attentions: bool = False
+    ) -> Optional[Tuple[List[float], Optional[Dict[str, np.ndarray]]]]:
+        """Stored prediction for `key`, or None if missing or expired.
+
+        Parameters
+        ----------
+        key: str
+            Entry key.
+        with_attentions: bool
+            If True, entries stored without attentions count as missing.
+
+        Returns
+        -------
+        Tuple[List[float], Optional[Dict[str, np.ndarray]]]
+            Scores and attentions, if stored.
+        """
+        now = time.time()
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT scores, attentions, ctime FROM predictions WHERE key = ?", (key,)
+        ).fetchone()
+        if row is not None and self.ttl is not None and row[2] + self.ttl < now:
+            with self._transaction() as conn:
+                self._delete(conn, "key = ? AND ctime = ?", (key, row[2]))
+            row = None
+        if row is None or (with_attentions and row[1] is None):
+            self._count(misses=1)
+            return None
+
+        conn.execute("UPDATE predictions SET atime = ? WHERE key = ?", (now, key))
+        self._count(hits=1)
+        scores = json.loads(row[0])
+        attentions = _unpack_attentions(row[1]) if with_attentions else None
+        return scores, attentions
+
+    def put(
+        self,
+        key: str,
+        scores: List[float],
+        attentions: Optional[Dict[str, np.ndarray]] = None,
+    ):
+        """Store the prediction for `key`.
+
+        Parameters
+        ----------
+        key: str
+            Entry key.
+        scores: List[float]
+            Risk scores per follow-up year.
+        attentions: Dict[str, np.ndarray], optional
+            Attentions to store along. Attentions already stored for `key`
+            are kept when not given.
+        """
+        scores = json.dumps([float(score) for score in scores])
+        blob = _pack_attentions(attentions) if attentions is not None else None
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT attentions, size FROM predictions WHERE key = ?", (key,)
+            ).fetchone()
+            old_size = row[1] if row is not None else 0
+            if blob is None and row is not None:
+                blob = row[0]
+            size = len(scores) + (len(blob) if blob is not None else 0)
+            conn.execute(
+                "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?)",
+                (key, scores, blob, size, now, now),
+            )
+            total = self._add_bytes(conn, size - old_size)
+        if self.max_bytes is not None and total > self.max_bytes:
+            self.evict()
+
+    def evict(self, target_bytes: Optional[int] = None) -> int:
+        """
+        Removes expired entries, then the least recently used ones until at most
+        `target_bytes` are stored, by default `EVICTION_LOW_WATER` of `max_bytes`.
+        Returns the number of removed entries.
+        """
+        if target_bytes is None and self.max_bytes is not None:
+            target_bytes = int(self.max_bytes * EVICTION_LOW_WATER)
+
+        with self._transaction() as conn:
+            evicted = 0
+            if self.ttl is not None:
+                evicted += self._delete(conn, "ctime < ?", (time.time() - self.ttl,))
+            if target_bytes is not None:
+                total = self._total_bytes(conn)
+                rows = conn.execute("SELECT key, size FROM predictions ORDER BY atime")
+                to_remove = []
+                for key, size in rows:
+                    if total <= target_bytes:
+                        break
+                    to_remove.append((key,))
+                    total -= size
+                conn.executemany("DELETE FROM predictions WHERE key = ?", to_remove)
+                conn.execute("UPDATE totals SET bytes = ?", (total,))
+                evicted += len(to_remove)
+
+        self._count(evictions=evicted)
+        return evicted
+
+    def clear(self):
+        """Remove all entries."""
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM predictions")
+            conn.execute("UPDATE totals SET bytes = 0")
+
+    def stats(self) -> PredictionCacheStats:
+        """
+        Returns the PredictionCacheStats of the cache
+        """
+        num_entries, total = (
+            self._connect()
+            .execute("SELECT COUNT(*), (SELECT bytes FROM totals) FROM predictions")
+            .fetchone()
+        )
+        with self._lock:
+            return PredictionCacheStats(
+                self.hits, self.misses, self.evictions, num_entries, total
+            )
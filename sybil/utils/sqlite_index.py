@@ -0,0 +1,106 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Eviction brings a cache down to this fraction of its byte budget
+EVICTION_LOW_WATER = 0.9
+INDEX_TIMEOUT = 60
+
+
+class SQLiteIndex:
+    """
+    Base of the caches which track their entries in a SQLite database, shared
+    by all the processes using the cache (e.g. DataLoader workers).
+
+    `hits`, `misses` and `evictions` are counted by this process, while the
+    entries and their total size in bytes are read from the shared database.
+    The total is kept in a single row, updated along with the entries.
+
+    Parameters
+    ----------
+    index_path : str
+        Path of the SQLite database, created if needed.
+    """
+
+    # Attributes created by _init_runtime, which are not pickled
+    _runtime_attrs = ("_lock", "_local")
+
+    def __init__(self, index_path):
+        os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+        self.index_path = index_path
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._init_runtime()
+
+    # Threads, locks and connections do not survive pickling or forking,
+    # so they are recreated in every process using the cache.
+    def _init_runtime(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for attr in self._runtime_attrs:
+            del state[attr]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_runtime()
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._init_runtime()
+
+    def _connect(self):
+        self._check_pid()
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.index_path, timeout=INDEX_TIMEOUT, isolation_level=None
+            )
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _init_totals(self, count_bytes):
+        """
+        Creates the row holding the total size of the entries. For a new row,
+        the total is `count_bytes(conn)`, called within the transaction.
+        """
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS totals "
+            "(id INTEGER PRIMARY KEY, bytes INTEGER NOT NULL)"
+        )
+        with self._transaction() as conn:
+            if conn.execute("SELECT bytes FROM totals").fetchone() is None:
+                conn.execute("INSERT INTO totals VALUES (0, ?)", (count_bytes(conn),))
+
+    @staticmethod
+    def _add_bytes(conn, num_bytes):
+        """Adds `num_bytes` to the total and returns it, within a transaction."""
+        conn.execute("UPDATE totals SET bytes = bytes + ?", (num_bytes,))
+        return SQLiteIndex._total_bytes(conn)
+
+    @staticmethod
+    def _total_bytes(conn):
+        return conn.execute("SELECT bytes FROM totals").fetchone()[0]
+
+    def _count(self, hits=0, misses=0, evictions=0):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+            self.evictions += evictions
@@ -0,0 +1,249 @@
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import torch
+
+from sybil.utils.logging_utils import get_logger
+
+# Default in-memory budget, one preprocessed volume is ~150 MB
+DEFAULT_MAX_BYTES = int(os.getenv("SYBIL_VOLUME_CACHE_BYTES", 1024**3))
+
+
+class CacheStats(NamedTuple):
+    hits: int
+    disk_hits: int
+    misses: int
+    evictions: int
+    num_entries: int
+    bytes: int
+    disk_bytes: int
+
+
+def _tensor_bytes(tensor: torch.Tensor) -> int:
+    return tensor.numel() * tensor.element_size()
+
+
+class VolumeCache:
+    def __init__(
+        self,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        spill_dir: Optional[str] = None,
+        max_spill_bytes: Optional[int] = None,
+    ):
+        """Least-recently-used cache of preprocessed CT volumes with a byte budget.
+
+        Parameters
+        ----------
+        max_bytes: int
+            Maximum total size of the volumes kept in memory. 0 disables caching.
+        spill_dir: str, optional
+            If provided, volumes evicted from memory are written to this directory
+            and loaded from there on the next access, instead of being dropped.
+        max_spill_bytes: int, optional
+            Maximum total size of the spilled volumes. Unbounded by default.
+        """
+        self._logger = get_logger()
+        self._lock = threading.RLock()
+        self._entries: "OrderedDict[str, torch.Tensor]" = OrderedDict()
+        self._spilled: "OrderedDict[str, Tuple[str, int]]" = OrderedDict()
+        # Volumes evicted from memory and being written to spill_dir
+        self._writing: Dict[str, torch.Tensor] = {}
+        self.max_bytes = max_bytes
+        self.max_spill_bytes = max_spill_bytes
+        self.spill_dir = spill_dir
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+        self._bytes = 0
+        self._disk_bytes = 0
+        self._hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key: str) -> Optional[torch.Tensor]:
+        """Return the volume stored under `key`, or None if it is not cached."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return self._entries[key]
+
+            volume = self._writing.pop(key, None)
+            if volume is not None:
+                # Still in memory, the file being written is dropped by _spill
+                self._hits += 1
+                victims = self._put(key, volume)
+            else:
+                spilled = self._spilled.pop(key, None)
+                if spilled is None:
+                    self._misses += 1
+                    return None
+                self._disk_bytes -= spilled[1]
+        if volume is not None:
+            self._spill(victims)
+            return volume
+
+        path = spilled[0]
+        try:
+            volume = torch.load(path)
+        except Exception as e:
+            self._logger.warning(f"Could not load spilled volume {path}: {e}")
+        self._remove_file(path)
+        with self._lock:
+            if volume is None:
+                self._misses += 1
+                return None
+            self._disk_hits += 1
+            victims = self._put(key, volume)
+        self._spill(victims)
+        return volume
+
+    def put(self, key: str, volume: torch.Tensor):
+        """Store `volume` under `key`, evicting least recently used volumes as needed."""
+        with self._lock:
+            self.discard(key)
+            victims = self._put(key, volume)
+        self._spill(victims)
+
+    def _put(self, key: str, volume: torch.Tensor) -> List[Tuple[str, torch.Tensor]]:
+        """Store `volume`, returns the volumes to write to disk with _spill."""
+        if self.max_bytes == 0:
+            return []
+
+        victims = []
+        nbytes = _tensor_bytes(volume)
+        if nbytes > self.max_bytes:
+            self._reserve_spill(key, volume, victims)
+            return victims
+
+        self._entries[key] = volume
+        self._bytes += nbytes
+        return self._evict(self.max_bytes)
+
+    def _evict(self, max_bytes: int) -> List[Tuple[str, torch.Tensor]]:
+        victims = []
+        while self._bytes > max_bytes and self._entries:
+            key, volume = self._entries.popitem(last=False)
+            self._bytes -= _tensor_bytes(volume)
+            self._evictions += 1
+            self._reserve_spill(key, volume, victims)
+        return victims
+
+    def _reserve_spill(self, key: str, volume: torch.Tensor, victims: list):
+        """Add an evicted volume to `victims` if it can be written to disk."""
+        if self.spill_dir is None:
+            return
+        if self.max_spill_bytes is not None and _tensor_bytes(volume) > self.max_spill_bytes:
+            return
+        self._writing[key] = volume
+        victims.append((key, volume))
+
+    def _spill(self, victims: List[Tuple[str, torch.Tensor]]):
+        """
+        Write evicted volumes to spill_dir. Called without holding the lock,
+        so that other threads can use the cache while the files are written.
+        """
+        for key, volume in victims:
+            # Unique file, as the same key may be evicted again during the write
+            fd, path = tempfile.mkstemp(dir=self.spill_dir, prefix=f"{key}.", suffix=".pt")
+            os.close(fd)
+            try:
+                torch.save(volume.contiguous(), path)
+            except Exception as e:
+                self._logger.warning(f"Could not spill volume to {path}: {e}")
+                self._remove_file(path)
+                with self._lock:
+                    if self._writing.get(key) is volume:
+                        del self._writing[key]
+                continue
+
+            with self._lock:
+                if self._writing.get(key) is not volume:
+                    # Taken back into memory or discarded during the write
+                    self._remove_file(path)
+                    continue
+                del self._writing[key]
+                nbytes = _tensor_bytes(volume)
+                self._spilled[key] = (path, nbytes)
+                self._disk_bytes += nbytes
+                while self.max_spill_bytes is not None and self._disk_bytes > self.max_spill_bytes:
+                    _, (old_path, old_nbytes) = self._spilled.popitem(last=False)
+                    self._disk_bytes -= old_nbytes
+                    self._remove_file(old_path)
+
+    @staticmethod
+    def _remove_file(path: str):
+        try:
+            os.remove(path)
+        # Don't raise error if file not exists.
+        except OSError:
+            pass
+
+    def discard(self, key: str):
+        """Remove the volume stored under `key`, from memory and disk."""
+        with self._lock:
+            volume = self._entries.pop(key, None)
+            if volume is not None:
+                self._bytes -= _tensor_bytes(volume)
+            self._writing.pop(key, None)
+            spilled = self._spilled.pop(key, None)
+            if spilled is not None:
+                self._disk_bytes -= spilled[1]
+                self._remove_file(spilled[0])
+
+    def clear(self):
+        """Drop all cached volumes."""
+        with self._lock:
+            for key in list(self._entries) + list(self._writing) + list(self._spilled):
+                self.discard(key)
+
+    def resize(self, max_bytes: int):
+        """Change the in-memory budget, evicting volumes if it shrinks."""
+        with self._lock:
+            self.max_bytes = max_bytes
+            victims = self._evict(max_bytes)
+        self._spill(victims)
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(
+                hits=self._hits,
+                disk_hits=self._disk_hits,
+                misses=self._misses,
+                evictions=self._evictions,
+                num_entries=len(self._entries),
+                bytes=self._bytes,
+                disk_bytes=self._disk_bytes,
+            )
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries or key in self._writing or key in self._spilled
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries) + len(self._writing) + len(self._spilled)
+
+
+_volume_cache = VolumeCache()
+
+
+def get_volume_cache() -> VolumeCache:
+    """The cache used by all Serie objects."""
+    return _volume_cache
+
+
+def set_volume_cache(cache: VolumeCache):
+    """Replace the cache used by Serie objects, e.g. to enable spilling to disk."""
+    global _volume_cache
+    _volume_cache.clear()
+    _volume_cache = cache
+
+
+def discard_volume(key: str):
+    """Remove a volume from the current cache, used when a Serie is garbage collected."""
+    _volume_cache.discard(key)
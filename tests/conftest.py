@@ -1 +1,25 @@
-# import pytest
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from synthetic import write_dicom_series
+
+
+@pytest.fixture
+def dicom_series(tmp_path):
+    return write_dicom_series(str(tmp_path))
+
+
+def write_mha_volume(path, num_slices=12, size=64, seed=0):
+    """Write a small 3D CT volume in HU as an MHA file."""
+    rng = np.random.default_rng(seed)
+    volume = rng.integers(-1024, 2000, size=(num_slices, size, size)).astype(np.int16)
+    image = sitk.GetImageFromArray(volume)
+    image.SetSpacing((0.7, 0.7, 2.5))
+    sitk.WriteImage(image, path)
+    return path
+
+
+@pytest.fixture
+def mha_volume(tmp_path):
+    return write_mha_volume(str(tmp_path / "volume.mha"))
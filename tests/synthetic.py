@@ -0,0 +1,46 @@
+import os
+
+import numpy as np
+import pydicom
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+
+def write_dicom_series(out_dir, num_slices=12, size=64, seed=0):
+    """Write a CT series with random pixel data, returns the file paths."""
+    rng = np.random.default_rng(seed)
+    series_uid = generate_uid()
+    paths = []
+    for i in range(num_slices):
+        file_meta = FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = pydicom.uid.CTImageStorage
+        file_meta.MediaStorageSOPInstanceUID = generate_uid()
+        file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+        path = os.path.join(out_dir, f"{i:04d}.dcm")
+        ds = FileDataset(path, {}, file_meta=file_meta, preamble=b"\0" * 128)
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+        ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+        ds.SeriesInstanceUID = series_uid
+        ds.Modality = "CT"
+        ds.Manufacturer = "synthetic"
+        # Written in reverse order so that sorting by position matters
+        ds.ImagePositionPatient = [0.0, 0.0, float(num_slices - i) * 2.5]
+        ds.SliceThickness = 2.5
+        ds.PixelSpacing = [0.7, 0.7]
+        ds.RescaleSlope = 1
+        ds.RescaleIntercept = -1024
+        ds.Rows = ds.Columns = size
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 1
+        pixels = rng.integers(0, 3000, size=(size, size), dtype=np.int16)
+        ds.PixelData = pixels.tobytes()
+        ds.save_as(path)
+        paths.append(path)
+    return paths
@@ -16,3 +16,17 @@ def test_create_sybilnet():
 
     assert sybil_net.hidden_dim == 512
     assert sybil_net.prob_of_failure_layer is not None
+
+
+def test_create_sybilnet_without_pretrained_backbone():
+    from sybil.models.sybil import SybilNet
+
+    fake_args = argparse.Namespace(
+        dropout=0.1,
+        max_followup=5,
+        )
+
+    sybil_net = SybilNet(fake_args, pretrained_backbone=False)
+
+    assert sybil_net.hidden_dim == 512
+    assert sybil_net.prob_of_failure_layer is not None
@@ -0,0 +1,162 @@
+import hashlib
+import io
+import os
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from sybil import model as sybil_model
+from sybil.utils.download import (
+    ChecksumError,
+    download_and_extract,
+    download_file,
+    verify_file,
+)
+
+
+class RangeServer(ThreadingHTTPServer):
+    """Serves `content` at any path, with Range requests. The first
+    `num_truncated` responses stop after `truncate_at` bytes."""
+
+    def __init__(self, content, truncate_at=None, num_truncated=0):
+        super().__init__(("127.0.0.1", 0), RangeHandler)
+        self.content = content
+        self.truncate_at = truncate_at
+        self.num_truncated = num_truncated
+        self.requests = []
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/sybil_checkpoints.zip".format(self.server_address[1])
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        content = server.content
+        range_header = self.headers.get("Range")
+        server.requests.append(range_header)
+        start = int(range_header[len("bytes="):].rstrip("-")) if range_header else 0
+        body = content[start:]
+
+        self.send_response(206 if range_header else 200)
+        if range_header:
+            self.send_header("Content-Range", f"bytes {start}-{len(content) - 1}/{len(content)}")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if server.num_truncated > 0:
+            server.num_truncated -= 1
+            body = body[: server.truncate_at]
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(content, **kwargs):
+        server = RangeServer(content, **kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def _zip(files):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zip_file:
+        for name, data in files.items():
+            zip_file.writestr(name, data)
+    return buffer.getvalue()
+
+
+def _md5(data):
+    return hashlib.md5(data).hexdigest()
+
+
+def test_download_resumes(serve, tmp_path):
+    content = os.urandom(3 * 2**20 + 17)
+    server = serve(content, truncate_at=2**20 + 5, num_truncated=2)
+    path = str(tmp_path / "file.bin")
+
+    download_file(server.url, path, expected_md5=_md5(content))
+
+    with open(path, "rb") as f:
+        assert f.read() == content
+    assert server.requests == [None, "bytes=1048581-", "bytes=2097162-"]
+    assert not os.path.exists(path + ".part")
+
+
+def test_download_checksum_mismatch(serve, tmp_path):
+    server = serve(b"corrupted")
+    path = str(tmp_path / "file.bin")
+    with pytest.raises(ChecksumError):
+        download_file(server.url, path, expected_md5=_md5(b"content"))
+    assert os.listdir(tmp_path) == []
+
+
+def test_download_and_extract(serve, tmp_path):
+    files = {"model.ckpt": b"weights", "calibrator.json": b"{}"}
+    server = serve(_zip(files))
+
+    names = download_and_extract(server.url, str(tmp_path), {"model.ckpt": _md5(b"weights")})
+
+    assert sorted(names) == sorted(files)
+    for name, data in files.items():
+        with open(tmp_path / name, "rb") as f:
+            assert f.read() == data
+    # Only the extracted files, and the checksum record of the verified one
+    assert sorted(os.listdir(tmp_path)) == ["calibrator.json", "model.ckpt", "model.ckpt.md5"]
+
+    with pytest.raises(ChecksumError):
+        download_and_extract(server.url, str(tmp_path / "other"), {"model.ckpt": _md5(b"other")})
+    assert os.listdir(tmp_path / "other") == []
+
+
+def test_concurrent_download_sybil(serve, tmp_path, monkeypatch):
+    weights = {name: os.urandom(1024) for name in ["a", "b"]}
+    checkpoints = [_md5(data) for data in weights.values()]
+    files = {f"{md5}.ckpt": data for md5, data in zip(checkpoints, weights.values())}
+    files["toy_simple_calibrator.json"] = b"{}"
+    server = serve(_zip(files))
+    monkeypatch.setitem(sybil_model.NAME_TO_FILE, "toy", {"checkpoint": checkpoints})
+
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(sybil_model.download_sybil("toy", str(tmp_path), server.url))
+        )
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Downloaded once, the others waited and found the files
+    assert server.requests == [None]
+    assert len(results) == 4
+    paths, calib_path = results[0]
+    assert os.path.exists(calib_path)
+    for path, data in zip(paths, weights.values()):
+        with open(path, "rb") as f:
+            assert f.read() == data
+
+
+def test_verify_file_without_record(tmp_path):
+    path = tmp_path / "model.ckpt"
+    path.write_bytes(b"weights")
+    # The record cannot be written, e.g. in a read-only model cache
+    (tmp_path / "model.ckpt.md5").mkdir()
+
+    assert verify_file(str(path), _md5(b"weights"))
+    assert not verify_file(str(path), _md5(b"other"))
@@ -0,0 +1,124 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from sybil.loaders.abstract_loader import DiskCacheStats, cache, read_series_index
+from sybil.utils.loading import get_sample_loader
+
+
+def _args(cache_path=None):
+    return argparse.Namespace(
+        img_size=[32, 32],
+        img_mean=[128.1722],
+        img_std=[87.1849],
+        num_chan=3,
+        img_file_type="dicom",
+        cache_path=cache_path,
+        use_annotations=False,
+    )
+
+
+def test_series_cache(dicom_series, tmp_path):
+    cache_dir = tmp_path / "cache"
+    expected = get_sample_loader("test", _args()).get_volume(dicom_series)["input"]
+
+    loader = get_sample_loader("test", _args(str(cache_dir)))
+    first = loader.get_volume(dicom_series)["input"]
+    cached_files = [p for p in cache_dir.rglob("*.series.npy")]
+    assert len(cached_files) == 1
+    assert read_series_index(str(cached_files[0]))["paths"] == dicom_series
+    assert np.load(str(cached_files[0]), mmap_mode="r").shape == (len(dicom_series), 32, 32)
+
+    second = loader.get_volume(dicom_series)["input"]
+    assert torch.equal(first, expected)
+    assert torch.equal(second, expected)
+
+
+def test_cached_series_is_copy_on_write(dicom_series, tmp_path):
+    loader = get_sample_loader("test", _args(str(tmp_path / "cache")))
+    expected = loader.get_volume(dicom_series)["input"].clone()
+
+    cached = loader.get_volume(dicom_series)["input"]
+    cached += 1
+    assert torch.equal(loader.get_volume(dicom_series)["input"], expected)
+
+
+def test_corrupted_series_cache_is_rebuilt(dicom_series, tmp_path):
+    cache_dir = tmp_path / "cache"
+    loader = get_sample_loader("test", _args(str(cache_dir)))
+    expected = loader.get_volume(dicom_series)["input"]
+
+    cached_file = next(p for p in cache_dir.rglob("*.series.npy"))
+    cached_file.write_bytes(b"corrupted")
+
+    assert torch.equal(loader.get_volume(dicom_series)["input"], expected)
+
+
+def test_cache_stats(dicom_series, tmp_path):
+    loader = get_sample_loader("test", _args(str(tmp_path / "cache")))
+    loader.get_volume(dicom_series)
+    loader.get_volume(dicom_series)
+
+    stats = loader.cache.stats()
+    series_files = list((tmp_path / "cache").rglob("*.series.npy"))
+    assert (stats.hits, stats.misses, stats.evictions) == (1, 1, 0)
+    assert stats.num_files == len(series_files)
+    assert stats.bytes == sum(p.stat().st_size for p in series_files)
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    store = cache(str(tmp_path / "cache"), max_bytes=None)
+    image = np.zeros((32, 32), dtype=np.uint8)
+    for i in range(4):
+        store.add("/series/{}.dcm".format(i), "default/", image)
+    file_size = store.stats().bytes // 4
+    store.get("/series/0.dcm", "default/")
+
+    assert store.evict(target_bytes=2 * file_size) == 2
+    assert [store.exists("/series/{}.dcm".format(i), "default/") for i in range(4)] == [
+        True,
+        False,
+        False,
+        True,
+    ]
+    assert store.stats() == DiskCacheStats(1, 0, 2, 2, 2 * file_size)
+
+
+def test_cache_evicts_in_background(tmp_path):
+    image = np.zeros((32, 32), dtype=np.uint8)
+    store = cache(str(tmp_path / "cache"))
+    store.add("/series/0.dcm", "default/", image)
+    file_size = store.stats().bytes
+
+    # Reopening the cache reuses the index of the files already cached
+    store = cache(str(tmp_path / "cache"), max_bytes=int(3.5 * file_size))
+    for i in range(1, 8):
+        store.add("/series/{}.dcm".format(i), "default/", image)
+
+    deadline = time.time() + 10
+    while store.stats().bytes > store.max_bytes and time.time() < deadline:
+        time.sleep(0.01)
+    stats = store.stats()
+    assert stats.bytes <= store.max_bytes
+    assert stats.bytes == stats.num_files * file_size
+    assert store.exists("/series/7.dcm", "default/")
+    assert not store.exists("/series/0.dcm", "default/")
+
+
+def test_cache_batches_access_times(tmp_path):
+    store = cache(str(tmp_path / "cache"))
+    image = np.zeros((32, 32), dtype=np.uint8)
+    store.add("/series/0.dcm", "default/", image)
+
+    def index_atime():
+        return store._connect().execute("SELECT atime FROM entries").fetchone()[0]
+
+    added = index_atime()
+    time.sleep(0.01)
+    store.get("/series/0.dcm", "default/")
+    # Hits are only written to the index in batches
+    assert index_atime() == added
+    store.flush_access_times()
+    assert index_atime() > added
@@ -0,0 +1,56 @@
+import json
+
+import torch
+
+from sybil import Sybil
+from sybil.models.mmap_checkpoint import (
+    args_sidecar_path,
+    convert_checkpoint,
+    load_safetensors,
+    save_safetensors,
+)
+from toy_models import write_checkpoint
+
+
+def test_safetensors_roundtrip(tmp_path):
+    path = str(tmp_path / "tensors.safetensors")
+    tensors = {
+        "weight": torch.randn(3, 5),
+        "half": torch.randn(7).to(torch.bfloat16),
+        "count": torch.tensor(4),
+        "mask": torch.tensor([True, False, True]),
+    }
+    save_safetensors(tensors, path, metadata={"format": "pt"})
+
+    loaded, metadata = load_safetensors(path)
+    assert metadata == {"format": "pt"}
+    assert set(loaded) == set(tensors)
+    for name, tensor in tensors.items():
+        assert loaded[name].dtype == tensor.dtype
+        assert torch.equal(loaded[name], tensor)
+
+    # Header as in the safetensors format
+    with open(path, "rb") as f:
+        header_size = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_size))
+    assert header["weight"] == {"dtype": "F32", "shape": [3, 5], "data_offsets": [8, 68]}
+
+
+def test_load_converted_checkpoint(tmp_path, monkeypatch):
+    checkpoint_path = str(tmp_path / "member.ckpt")
+    net = write_checkpoint(checkpoint_path)
+    path = convert_checkpoint(checkpoint_path)
+    with open(args_sidecar_path(path)) as f:
+        assert json.load(f)["max_followup"] == 6
+
+    def fail_load(*args, **kwargs):
+        raise AssertionError("checkpoint unpickled")
+
+    monkeypatch.setattr(torch, "load", fail_load)
+    for model_path in [path, checkpoint_path]:
+        model = Sybil([model_path], device="cpu")
+        loaded = model.ensemble[0].state_dict()
+        assert model._max_followup == 6
+        for key, val in net.state_dict().items():
+            assert loaded[key].device.type == "cpu"
+            assert torch.equal(loaded[key], val)
@@ -0,0 +1,349 @@
+import argparse
+import time
+
+import numpy as np
+import pytest
+import torch
+
+from sybil import Sybil
+from sybil.model import ACTIVATION_MEMORY_FACTOR
+from sybil.models.cumulative_probability_layer import Cumulative_Probability_Layer
+from sybil.models.quantization import score_drift
+from sybil.models.sybil import RiskFactorPredictor, SybilNet
+from sybil.utils.hashing import file_md5
+from sybil.utils.prediction_cache import PredictionCache
+from toy_models import VolumeSerie, toy_sybil, write_checkpoint
+
+
+def test_batched_predict_matches_single():
+    model = toy_sybil()
+    series = [VolumeSerie(torch.randn(1, 3, 4, 8, 8)) for _ in range(5)]
+
+    single = model.predict(series, return_attentions=True, batch_size=1)
+    batched = model.predict(series, return_attentions=True, batch_size=3)
+
+    assert len(batched.scores) == len(series)
+    np.testing.assert_allclose(single.scores, batched.scores, rtol=1e-6)
+    for single_att, batched_att in zip(single.attentions, batched.attentions):
+        assert single_att.keys() == batched_att.keys()
+        for key in single_att:
+            assert single_att[key].shape == batched_att[key].shape
+            np.testing.assert_allclose(single_att[key], batched_att[key], rtol=1e-6)
+
+
+def test_auto_batch_size():
+    model = toy_sybil()
+    batch_size = model._auto_batch_size(torch.zeros(1, 3, 4, 8, 8))
+    assert batch_size >= 1
+
+
+def test_auto_batch_size_fused_channels(monkeypatch):
+    model = toy_sybil()
+    model.fuse_input_channels = True
+    # Room for 3 series of 3 channels, with the half kept free
+    mem_per_serie = 3 * 4 * 8 * 8 * 4 * ACTIVATION_MEMORY_FACTOR
+    monkeypatch.setattr("sybil.model.get_available_memory", lambda device: 6 * mem_per_serie)
+    # A fused volume has a single channel, but the same activations after the stem
+    assert model._auto_batch_size(torch.zeros(1, 1, 4, 8, 8)) == 3
+    assert model._auto_batch_size(torch.zeros(1, 3, 4, 8, 8)) == 3
+
+
+def test_ensemble_predict_matches_members():
+    model = toy_sybil(num_members=3)
+    series = [VolumeSerie(torch.randn(1, 3, 4, 8, 8)) for _ in range(3)]
+
+    ensemble = model.predict(series, return_attentions=True, batch_size=2)
+    members = [model._predict(member, series, return_attentions=True) for member in model.ensemble]
+
+    expected_scores = np.mean([member.scores for member in members], axis=0)
+    np.testing.assert_allclose(ensemble.scores, expected_scores, rtol=1e-6)
+    for i, att in enumerate(ensemble.attentions):
+        for key, val in att.items():
+            expected = np.stack([member.attentions[i][key] for member in members])
+            np.testing.assert_allclose(val, expected, rtol=1e-6)
+
+
+def test_sybilnet_output_keys():
+    torch.manual_seed(0)
+    args = argparse.Namespace(dropout=0.1, max_followup=6, censoring_distribution={})
+    net = SybilNet(args, pretrained_backbone=False).eval()
+    volume = torch.randn(2, 3, 16, 64, 64)
+
+    with torch.no_grad():
+        full = net(volume)
+        out = net(volume, output_keys=["logit", "image_attention_1", "prob"])
+
+    assert set(out) == {"logit", "image_attention_1", "prob"}
+    for key, val in out.items():
+        torch.testing.assert_close(val, full[key])
+
+
+def test_risk_factor_predictor():
+    torch.manual_seed(0)
+    args = argparse.Namespace(
+        dropout=0.1,
+        max_followup=6,
+        censoring_distribution={},
+        hidden_dim=512,
+        risk_factor_keys=["age", "is_smoker"],
+    )
+    net = RiskFactorPredictor(args, pretrained_backbone=False).eval()
+    volume = torch.randn(2, 3, 16, 64, 64)
+    batch = {"y": torch.zeros(2)}
+
+    with torch.no_grad():
+        out = net(volume, batch)
+
+    assert out["hidden"].shape == (2, 512)
+    for key in args.risk_factor_keys:
+        num_classes = args.risk_factor_key_to_num_class[key]
+        assert out["{}_logit".format(key)].shape == (2, num_classes)
+
+
+@pytest.mark.parametrize("max_followup", [6, 15])
+def test_cumulative_probability_layer(max_followup):
+    torch.manual_seed(0)
+    layer = Cumulative_Probability_Layer(16, None, max_followup)
+    # Checkpoints still hold the triangular mask
+    state_dict = Cumulative_Probability_Layer(16, None, max_followup).state_dict()
+    assert "upper_triagular_mask" in state_dict
+    layer.load_state_dict(state_dict)
+
+    x = torch.randn(4, 16)
+    hazards = layer.hazards(x)
+    masked = hazards.unsqueeze(-1).expand(4, max_followup, max_followup) * layer.upper_triagular_mask
+    expected = masked.sum(dim=1) + layer.base_hazard_fc(x)
+    torch.testing.assert_close(layer(x), expected)
+
+
+def test_result_cache(tmp_path):
+    model = toy_sybil()
+    model.result_cache = PredictionCache(str(tmp_path / "predictions.sqlite"))
+    model._model_fingerprint = "toy"
+    series = [VolumeSerie(torch.randn(1, 3, 4, 8, 8)) for _ in range(3)]
+
+    expected = model.predict(series[:2], return_attentions=True)
+    # Only the new serie runs through the models
+    calls = []
+    for member in model.ensemble:
+        member.register_forward_hook(lambda module, args, out: calls.append(args[0].shape[0]))
+    pred = model.predict(series[::-1], return_attentions=True)
+
+    assert sum(calls) == len(model.ensemble)
+    assert pred.scores[1:] == expected.scores[::-1]
+    for att, expected_att in zip(pred.attentions[1:], expected.attentions[::-1]):
+        for key, val in expected_att.items():
+            np.testing.assert_array_equal(att[key], val)
+    assert model.result_cache.stats().hits == 2
+
+    # Cached predictions come out of the stream first
+    new_serie = VolumeSerie(torch.randn(1, 3, 4, 8, 8))
+    results = list(model.predict_iter([new_serie, series[0]], num_workers=1))
+    assert [serie for serie, _ in results] == [series[0], new_serie]
+    assert results[0][1].scores == [expected.scores[0]]
+    assert model.result_cache.stats().num_entries == 4
+
+
+class SlowSerie(VolumeSerie):
+    """Serie recording when its volume is being loaded."""
+
+    def __init__(self, volume, intervals):
+        super().__init__(volume)
+        self._intervals = intervals
+
+    def get_volume(self, num_chan=3):
+        start = time.perf_counter()
+        time.sleep(0.05)
+        self._intervals.append((start, time.perf_counter()))
+        return super().get_volume(num_chan)
+
+
+def test_predict_iter_matches_predict():
+    model = toy_sybil()
+    series = [VolumeSerie(torch.randn(1, 3, 4, 8, 8)) for _ in range(5)]
+
+    expected = model.predict(series, return_attentions=True, batch_size=2)
+    results = list(model.predict_iter(iter(series), return_attentions=True, batch_size=2, num_workers=2))
+
+    assert [serie for serie, _ in results] == series
+    for i, (_, pred) in enumerate(results):
+        assert pred.scores == [expected.scores[i]]
+        for key, val in expected.attentions[i].items():
+            np.testing.assert_array_equal(pred.attentions[0][key], val)
+
+
+def test_predict_iter_overlaps_loading():
+    model = toy_sybil(num_members=1)
+    load_intervals, model_intervals = [], []
+
+    def slow_forward(module, args, out):
+        start = time.perf_counter()
+        time.sleep(0.05)
+        model_intervals.append((start, time.perf_counter()))
+
+    model.ensemble[0].register_forward_hook(slow_forward)
+    series = [SlowSerie(torch.randn(1, 3, 4, 8, 8), load_intervals) for _ in range(4)]
+    results = list(model.predict_iter(series, batch_size=1, num_workers=1))
+
+    assert len(results) == 4
+    # Upcoming volumes were loaded while the model ran
+    assert any(
+        load_start < model_end and model_start < load_end
+        for load_start, load_end in load_intervals
+        for model_start, model_end in model_intervals
+    )
+
+
+def test_load_checkpoint(tmp_path):
+    path = str(tmp_path / "member.ckpt")
+    net = write_checkpoint(path)
+
+    model = Sybil([path], device="cpu")
+    loaded = model.ensemble[0]
+    for key, val in net.state_dict().items():
+        assert torch.equal(loaded.state_dict()[key], val)
+
+    assert torch.equal(SybilNet.load(path).state_dict()["pool.hidden_fc.weight"], net.pool.hidden_fc.weight)
+
+
+def test_fused_input_channels_predict(tmp_path):
+    path = str(tmp_path / "member.ckpt")
+    write_checkpoint(path)
+    series = [VolumeSerie(torch.randn(1, 1, 16, 64, 64)) for _ in range(2)]
+
+    model = Sybil([path], device="cpu")
+    fused = Sybil([path], device="cpu", fuse_input_channels=True)
+    assert fused.ensemble[0].image_encoder[0][0].in_channels == 1
+
+    expected = model.predict(series, return_attentions=True)
+    actual = fused.predict(series, return_attentions=True)
+    np.testing.assert_allclose(actual.scores, expected.scores, rtol=1e-4, atol=1e-6)
+    for actual_att, expected_att in zip(actual.attentions, expected.attentions):
+        for key in expected_att:
+            np.testing.assert_allclose(actual_att[key], expected_att[key], rtol=1e-4, atol=1e-5)
+
+
+def test_onnxruntime_backend_matches_torch(tmp_path):
+    pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+    path = str(tmp_path / "member.ckpt")
+    write_checkpoint(path)
+    series = [VolumeSerie(torch.randn(1, 1, 24, 64, 96)) for _ in range(3)]
+
+    model = Sybil([path], device="cpu")
+    onnx_model = Sybil([path], backend="onnxruntime")
+    assert (tmp_path / "member.onnx").exists()
+
+    expected = model.predict(series, return_attentions=True, batch_size=2)
+    actual = onnx_model.predict(series, return_attentions=True, batch_size=2)
+    np.testing.assert_allclose(actual.scores, expected.scores, rtol=1e-4, atol=1e-6)
+    for actual_att, expected_att in zip(actual.attentions, expected.attentions):
+        assert actual_att.keys() == expected_att.keys()
+        for key in expected_att:
+            np.testing.assert_allclose(actual_att[key], expected_att[key], rtol=1e-4, atol=1e-5)
+
+
+def test_int8_quantized_predict(tmp_path):
+    path = str(tmp_path / "member.ckpt")
+    write_checkpoint(path)
+    torch.manual_seed(0)
+    calibration = [VolumeSerie(torch.randn(1, 1, 16, 64, 64)) for _ in range(2)]
+    series = [VolumeSerie(torch.randn(1, 1, 16, 64, 64)) for _ in range(3)]
+
+    model = Sybil([path], device="cpu")
+    quantized = Sybil([path], quantize="int8", calibration_series=calibration)
+    assert not any(isinstance(m, torch.nn.Conv3d) for m in quantized.ensemble[0].modules())
+
+    expected = model.predict(series).scores
+    actual = quantized.predict(series).scores
+    drift = score_drift(expected, actual)
+    assert drift.num_series == len(series)
+    assert len(drift.max_abs) == len(expected[0])
+    assert max(drift.max_abs) < 0.1
+
+
+def test_score_drift():
+    drift = score_drift([[0.1, 0.2], [0.3, 0.4]], [[0.1, 0.25], [0.2, 0.4]])
+    np.testing.assert_allclose(drift.mean_abs, [0.05, 0.025])
+    np.testing.assert_allclose(drift.max_abs, [0.1, 0.05])
+    assert drift.num_series == 2
+
+
+def test_bf16_predict(tmp_path):
+    path = str(tmp_path / "member.ckpt")
+    write_checkpoint(path)
+    series = [VolumeSerie(torch.randn(1, 1, 16, 64, 64)) for _ in range(2)]
+
+    model = Sybil([path], device="cpu")
+    expected = model.predict(series, return_attentions=True)
+    actual = model.predict(series, return_attentions=True, precision="bf16")
+    assert max(score_drift(expected.scores, actual.scores).max_abs) < 0.05
+    for att in actual.attentions:
+        assert all(val.dtype == np.float32 for val in att.values())
+
+    bf16_model = Sybil([path], device="cpu", precision="bf16")
+    np.testing.assert_allclose(bf16_model.predict(series).scores, actual.scores)
+    with pytest.raises(ValueError):
+        model.predict(series, precision="fp8")
+
+
+def test_torchscript_cache(tmp_path, monkeypatch):
+    path = str(tmp_path / "member.ckpt")
+    write_checkpoint(path)
+    cache = tmp_path / "cache"
+    # Not the (16, 64, 64) volume the model is traced with
+    series = [VolumeSerie(torch.randn(1, 3, 24, 48, 40)) for _ in range(2)]
+
+    expected = Sybil([path], device="cpu").predict(series, return_attentions=True)
+    traced = Sybil([path], cache=str(cache), device="cpu", compile_mode="torchscript")
+    traced_files = list(cache.glob("*.torchscript.pt"))
+    assert len(traced_files) == 1
+    assert traced_files[0].name.startswith(file_md5(path))
+
+    # Loaded from the cache the second time, without reading the checkpoint
+    def no_load(*args, **kwargs):
+        raise AssertionError("The checkpoint should not be loaded")
+
+    with monkeypatch.context() as m:
+        m.setattr(torch, "load", no_load)
+        m.setattr("sybil.model.file_md5", no_load)
+        m.setattr("sybil.utils.download.file_md5", no_load)
+        loaded = Sybil([path], cache=str(cache), device="cpu", compile_mode="torchscript")
+    assert isinstance(loaded.ensemble[0], torch.jit.ScriptModule)
+    assert loaded._max_followup == traced._max_followup
+    for model in [traced, loaded]:
+        actual = model.predict(series, return_attentions=True, batch_size=2)
+        np.testing.assert_allclose(actual.scores, expected.scores, rtol=1e-4, atol=1e-6)
+        for actual_att, expected_att in zip(actual.attentions, expected.attentions):
+            for key in expected_att:
+                np.testing.assert_allclose(actual_att[key], expected_att[key], rtol=1e-4, atol=1e-5)
+
+
+def test_slab_encoder_matches_full_volume(tmp_path):
+    path = str(tmp_path / "member.ckpt")
+    net = write_checkpoint(path).eval()
+    volume = torch.randn(1, 3, 197, 16, 16)
+    with torch.no_grad():
+        expected = net.image_encoder(volume)
+        for slab_size in [8, 48]:
+            torch.testing.assert_close(net.encode_slabs(volume, slab_size), expected)
+
+    series = [VolumeSerie(torch.randn(1, 3, 200, 16, 16)) for _ in range(2)]
+    expected = Sybil([path], device="cpu").predict(series).scores
+    # Room for slabs of 16 slices plus halos
+    max_memory = 128 * 3 * 16 * 16 * 4 * ACTIVATION_MEMORY_FACTOR
+    model = Sybil([path], device="cpu", max_encoder_memory=max_memory)
+    assert model._encoder_slab_size(series[0].get_volume()) == 16
+    np.testing.assert_allclose(model.predict(series).scores, expected, rtol=1e-6)
+
+
+def test_slab_encoder_fused_channels(tmp_path):
+    path = str(tmp_path / "member.ckpt")
+    write_checkpoint(path)
+    series = [VolumeSerie(torch.randn(1, 1, 200, 16, 16)) for _ in range(2)]
+    expected = Sybil([path], device="cpu", fuse_input_channels=True).predict(series).scores
+    # Same slabs as with 3 channels, the activations after the stem do not shrink
+    max_memory = 128 * 3 * 16 * 16 * 4 * ACTIVATION_MEMORY_FACTOR
+    model = Sybil([path], device="cpu", fuse_input_channels=True, max_encoder_memory=max_memory)
+    assert model._encoder_slab_size(series[0].get_volume(num_chan=1)) == 16
+    np.testing.assert_allclose(model.predict(series).scores, expected, rtol=1e-6)
@@ -0,0 +1,110 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from sybil import Serie, SybilPool
+from synthetic import write_dicom_series
+from toy_models import toy_sybil
+
+
+def _toy_factory(name_or_path, device):
+    return toy_sybil()
+
+
+def _crash_once_factory(marker_path, device):
+    """Toy model whose process dies on its first prediction, across restarts."""
+    model = toy_sybil()
+
+    def crash(module, args):
+        if not os.path.exists(marker_path):
+            open(marker_path, "w").close()
+            os._exit(1)
+
+    model.ensemble[0].register_forward_pre_hook(crash)
+    return model
+
+
+def _logging_factory(log_path, device):
+    """Toy model writing the batch size of every forward pass to `log_path`."""
+    model = toy_sybil()
+
+    def log(module, args):
+        with open(log_path, "a") as f:
+            f.write(f"{args[0].shape[0]}\n")
+
+    model.ensemble[0].register_forward_pre_hook(log)
+    return model
+
+
+@pytest.fixture
+def series_paths(tmp_path):
+    paths = []
+    for i in range(3):
+        serie_dir = tmp_path / str(i)
+        serie_dir.mkdir()
+        paths.append(write_dicom_series(str(serie_dir), num_slices=4, size=16, seed=i))
+    return paths
+
+
+def test_pool_matches_sybil(series_paths):
+    model = toy_sybil()
+    expected = model.predict([Serie(paths, file_type="dicom") for paths in series_paths])
+
+    with SybilPool(
+        "toy", num_workers=2, devices=["cpu", "cpu"], threads_per_worker=1,
+        serie_kwargs={"file_type": "dicom"}, model_factory=_toy_factory,
+    ) as pool:
+        pred = pool.predict(series_paths)
+
+    np.testing.assert_allclose(pred.scores, expected.scores, rtol=1e-6)
+
+
+def test_pool_batches_series(series_paths, tmp_path):
+    log_path = str(tmp_path / "batches.log")
+    model = toy_sybil()
+    expected = model.predict([Serie(paths, file_type="dicom") for paths in series_paths])
+
+    with SybilPool(
+        log_path, num_workers=1, devices=["cpu"], threads_per_worker=1,
+        serie_kwargs={"file_type": "dicom"}, model_factory=_logging_factory,
+    ) as pool:
+        pred = pool.predict(series_paths, batch_size=2)
+
+    np.testing.assert_allclose(pred.scores, expected.scores, rtol=1e-6)
+    with open(log_path) as f:
+        assert sorted(f.read().split()) == ["1", "2"]
+
+
+def test_pool_restarts_crashed_worker(series_paths, tmp_path):
+    marker_path = str(tmp_path / "crashed")
+    with SybilPool(
+        marker_path, num_workers=1, devices=["cpu"], threads_per_worker=1,
+        serie_kwargs={"file_type": "dicom"}, model_factory=_crash_once_factory,
+    ) as pool:
+        pred = pool.predict(series_paths)
+        assert pool.restarts == 1
+
+    assert os.path.exists(marker_path)
+    assert len(pred.scores) == len(series_paths)
+
+
+def test_pool_shares_weights(series_paths):
+    with SybilPool(
+        "toy", num_workers=2, devices=["cpu", "cpu"], threads_per_worker=1,
+        serie_kwargs={"file_type": "dicom"}, model_factory=_toy_factory, share_weights=True,
+    ) as pool:
+        model = pool.shared_model
+        assert all(param.is_shared() for param in model.ensemble.parameters())
+        before = pool.predict(series_paths)
+
+        # Workers see the weights of this process
+        with torch.no_grad():
+            for member in model.ensemble:
+                member.fc.bias.add_(1.0)
+        after = pool.predict(series_paths)
+
+    expected = model.predict([Serie(paths, file_type="dicom") for paths in series_paths])
+    np.testing.assert_allclose(after.scores, expected.scores, rtol=1e-6)
+    assert not np.allclose(after.scores, before.scores)
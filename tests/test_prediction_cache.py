@@ -0,0 +1,85 @@
+import numpy as np
+
+from sybil.utils.prediction_cache import PredictionCache
+
+
+def test_put_get(tmp_path):
+    cache = PredictionCache(str(tmp_path / "predictions.sqlite"))
+    attentions = {"image_attention_1": np.arange(6, dtype=np.float32).reshape(1, 2, 3)}
+
+    assert cache.get("a") is None
+    cache.put("a", [0.1, 0.2], attentions)
+    scores, stored = cache.get("a", with_attentions=True)
+    assert scores == [0.1, 0.2]
+    np.testing.assert_array_equal(stored["image_attention_1"], attentions["image_attention_1"])
+
+    # Scores only entries do not answer attention requests
+    cache.put("b", [0.3, 0.4])
+    assert cache.get("b") == ([0.3, 0.4], None)
+    assert cache.get("b", with_attentions=True) is None
+    # Storing scores again keeps the attentions
+    cache.put("a", [0.1, 0.2])
+    assert cache.get("a", with_attentions=True) is not None
+
+    # Shared with other instances
+    stats = PredictionCache(cache.path).stats()
+    assert stats.num_entries == 2
+    assert cache.stats().hits == 3
+    assert cache.stats().misses == 2
+
+
+def test_ttl(tmp_path, monkeypatch):
+    import time
+
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now)
+    cache = PredictionCache(str(tmp_path / "predictions.sqlite"), ttl=60)
+    cache.put("a", [0.1])
+    monkeypatch.setattr(time, "time", lambda: now + 30)
+    assert cache.get("a") is not None
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    assert cache.get("a") is None
+    assert cache.stats().num_entries == 0
+
+
+def test_evicts_least_recently_used(tmp_path, monkeypatch):
+    import time
+
+    now = [time.time()]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    path = str(tmp_path / "predictions.sqlite")
+    cache = PredictionCache(path)
+    cache.put("probe", [0.5, 0.5])
+    entry_size = cache.stats().bytes
+    cache.clear()
+
+    cache = PredictionCache(path, max_bytes=3 * entry_size)
+    for key in "abc":
+        now[0] += 1
+        cache.put(key, [0.5, 0.5])
+    now[0] += 1
+    cache.get("a")
+    now[0] += 1
+    # Over budget: down to 90% of it, i.e. 2 entries
+    cache.put("d", [0.5, 0.5])
+
+    assert cache.stats().evictions == 2
+    assert cache.get("b") is None and cache.get("c") is None
+    assert cache.get("a") is not None and cache.get("d") is not None
+
+
+def test_running_total(tmp_path):
+    path = str(tmp_path / "predictions.sqlite")
+    cache = PredictionCache(path, ttl=60)
+    cache.put("a", [0.1, 0.2], {"hidden": np.zeros((1, 8), dtype=np.float32)})
+    cache.put("b", [0.3])
+    # Replacing an entry counts its new size only
+    cache.put("a", [0.1, 0.2])
+    cache.evict(target_bytes=0)
+    cache.put("c", [0.5])
+
+    conn = cache._connect()
+    (expected,) = conn.execute("SELECT SUM(size) FROM predictions").fetchone()
+    assert cache.stats().bytes == expected
+    # Reopened databases reuse the total
+    assert PredictionCache(path).stats().bytes == expected
@@ -0,0 +1,99 @@
+import argparse
+
+import numpy as np
+import pydicom
+import pytest
+import torch
+from pydicom.pixel_data_handlers.util import apply_modality_lut
+
+from sybil import Serie
+from sybil.loaders.image_loaders import (
+    DicomLoader,
+    apply_lut,
+    apply_windowing,
+    window_and_quantize,
+    windowing_lut,
+)
+from sybil.utils.loading import get_sample_loader
+
+
+def _args(file_type="dicom"):
+    return argparse.Namespace(
+        img_size=[32, 32],
+        img_mean=[128.1722],
+        img_std=[87.1849],
+        num_chan=3,
+        img_file_type=file_type,
+        cache_path=None,
+        use_annotations=False,
+    )
+
+
+def test_window_and_quantize_matches_apply_windowing():
+    volume = np.random.default_rng(0).uniform(-3000, 3000, size=(4, 16, 16))
+    volume[0, 0, :4] = [-1350.0, -1349.5, 149.0, 150.0]  # edges of the window
+
+    expected = apply_windowing(volume.copy(), -600, 1500) // 256
+    np.testing.assert_array_equal(window_and_quantize(volume, -600, 1500), expected)
+
+
+@pytest.mark.parametrize("dtype", ["int16", "uint16", "uint8"])
+@pytest.mark.parametrize("rescale", [(None, None), (1.0, -1024.0), (0.5, -300.0)])
+def test_windowing_lut_matches_apply_windowing(dtype, rescale):
+    info = np.iinfo(dtype)
+    image = np.arange(info.min, info.max + 1).astype(dtype).reshape(-1, 16)
+    slope, intercept = rescale
+    expected = image.copy() if slope is None else image * slope + intercept
+    expected = apply_windowing(expected, -600, 1500) // 256
+
+    actual = apply_lut(image, windowing_lut(image.dtype.str, -600, 1500, slope, intercept))
+    assert actual.dtype == expected.dtype
+    np.testing.assert_array_equal(actual, expected)
+
+
+def test_dicom_windowing_matches_modality_lut(dicom_series):
+    loader = DicomLoader(None, [], _args())
+    for path in dicom_series:
+        dcm = pydicom.dcmread(path)
+        expected = apply_windowing(apply_modality_lut(dcm.pixel_array, dcm), -600, 1500) // 256
+        np.testing.assert_array_equal(loader.load_input(path)["input"], expected)
+
+
+def test_volume_preprocessing_matches_per_slice(dicom_series):
+    args = _args()
+    volume_loader = get_sample_loader("test", args)
+    slice_loader = DicomLoader(None, volume_loader.augmentations, args)
+
+    expected = torch.stack([slice_loader.get_image(path)["input"] for path in dicom_series])
+    actual = volume_loader.get_volume(dicom_series)["input"]
+
+    assert actual.shape == (len(dicom_series), 3, 32, 32)
+    assert torch.equal(actual, expected)
+
+
+def test_serie_get_volume(dicom_series):
+    serie = Serie(dicom_series, file_type="dicom")
+    volume = serie.get_volume()
+    assert volume.shape == (1, 3, 200, 256, 256)
+
+    single_channel = serie.get_volume(num_chan=1)
+    assert single_channel.shape == (1, 1, 200, 256, 256)
+    assert torch.equal(volume, single_channel.expand_as(volume))
+
+
+def test_volume3d_matches_per_slice(mha_volume):
+    args = _args("mha")
+    loader = get_sample_loader("test", args)
+
+    slices = Serie.break_mha_into_slices(None, mha_volume)
+    expected = torch.stack([loader.get_image3d(mha_volume, None, image)["input"] for image in slices])
+    actual = loader.get_volume3d(mha_volume)["input"]
+
+    assert actual.shape == (len(slices), 3, 32, 32)
+    assert torch.equal(actual, expected)
+
+
+def test_volume3d_requires_3d_loader(dicom_series):
+    loader = get_sample_loader("test", _args())
+    with pytest.raises(NotImplementedError):
+        loader.get_volume3d(dicom_series[0])
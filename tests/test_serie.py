@@ -0,0 +1,76 @@
+import pydicom
+import SimpleITK as sitk
+import torch
+
+from sybil import Serie
+
+
+def test_dicoms_read_once(dicom_series, monkeypatch):
+    read_paths = []
+    dcmread = pydicom.dcmread
+
+    def counting_dcmread(path, *args, **kwargs):
+        read_paths.append(path)
+        return dcmread(path, *args, **kwargs)
+
+    monkeypatch.setattr(pydicom, "dcmread", counting_dcmread)
+    serie = Serie(dicom_series, file_type="dicom", num_workers=4)
+    serie.get_volume()
+
+    assert sorted(read_paths) == sorted(dicom_series)
+
+
+def test_parallel_read_matches_sequential(dicom_series):
+    sequential = Serie(dicom_series, file_type="dicom", num_workers=0)
+    parallel = Serie(dicom_series, file_type="dicom", num_workers=4)
+
+    assert sequential._meta.paths == parallel._meta.paths
+    assert sequential._meta.slice_positions == parallel._meta.slice_positions
+    assert torch.equal(sequential.get_volume(), parallel.get_volume())
+
+
+def test_mha3d_metadata_from_header(mha_volume, monkeypatch):
+    def fail_read_image(*args, **kwargs):
+        raise AssertionError("pixel data read while loading metadata")
+
+    monkeypatch.setattr(sitk, "ReadImage", fail_read_image)
+    serie = Serie([mha_volume], mha3d=True)
+
+    assert serie._meta.slice_positions == list(range(12))
+    assert serie._meta.thickness == 2.5
+    assert serie._meta.pixel_spacing == [0.7, 0.7, 2.5]
+
+
+def test_fingerprint(dicom_series, tmp_path):
+    serie = Serie(dicom_series, file_type="dicom")
+    fingerprint = serie.fingerprint()
+    # Same content, listed in another order and hashed after decoding
+    reordered = Serie(dicom_series[::-1], file_type="dicom")
+    reordered.get_volume()
+    assert reordered.fingerprint() == fingerprint
+
+    dcm = pydicom.dcmread(dicom_series[0])
+    dcm.PixelData = bytes(len(dcm.PixelData))
+    dcm.save_as(dicom_series[0])
+    assert Serie(dicom_series, file_type="dicom").fingerprint() != fingerprint
+
+
+def test_mha3d_fingerprint(mha_volume, tmp_path):
+    fingerprint = Serie([mha_volume], mha3d=True).fingerprint()
+    assert Serie([mha_volume], mha3d=True).fingerprint() == fingerprint
+
+    image = sitk.ReadImage(mha_volume)
+    other = str(tmp_path / "other.mha")
+    sitk.WriteImage(image + 1, other)
+    assert Serie([other], mha3d=True).fingerprint() != fingerprint
+
+
+def test_without_pixel_data(dicom_series):
+    kept = Serie(dicom_series, file_type="dicom")
+    serie = Serie(dicom_series, file_type="dicom", keep_pixel_data=False)
+
+    assert serie._datasets is None
+    assert serie._meta.paths == kept._meta.paths
+    assert torch.equal(serie._meta.voxel_spacing, kept._meta.voxel_spacing)
+    assert serie.fingerprint() == kept.fingerprint()
+    assert torch.equal(serie.get_volume(), kept.get_volume())
@@ -0,0 +1,99 @@
+import gc
+import threading
+
+import torch
+
+from sybil import Serie
+from sybil.utils.volume_cache import VolumeCache, get_volume_cache
+
+
+def _volume(value, numel=256):
+    return torch.full((numel,), float(value))  # 1 KiB
+
+
+def test_lru_eviction():
+    cache = VolumeCache(max_bytes=2048)
+    cache.put("a", _volume(0))
+    cache.put("b", _volume(1))
+    assert cache.get("a") is not None  # "b" is now least recently used
+    cache.put("c", _volume(2))
+
+    assert "b" not in cache
+    assert cache.get("b") is None
+    stats = cache.stats()
+    assert (stats.hits, stats.misses, stats.evictions) == (1, 1, 1)
+    assert stats.bytes == 2048
+
+    cache.resize(1024)
+    assert len(cache) == 1 and "c" in cache
+
+
+def test_spill_to_disk(tmp_path):
+    cache = VolumeCache(max_bytes=1024, spill_dir=str(tmp_path))
+    cache.put("a", _volume(0))
+    cache.put("b", _volume(1))
+    assert cache.stats().disk_bytes == 1024
+
+    assert torch.equal(cache.get("a"), _volume(0))
+    assert cache.stats().disk_hits == 1
+
+    cache.clear()
+    assert len(cache) == 0
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_zero_budget_disables_spill(tmp_path):
+    cache = VolumeCache(max_bytes=0, spill_dir=str(tmp_path))
+    cache.put("a", _volume(0))
+
+    assert "a" not in cache
+    assert cache.get("a") is None
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_spill_writes_without_lock(tmp_path, monkeypatch):
+    cache = VolumeCache(max_bytes=1024, spill_dir=str(tmp_path))
+    save = torch.save
+    started = []
+    during_write = []
+
+    def save_and_get(obj, path):
+        if not started:
+            started.append(True)
+            # Another thread uses the cache while "a" is being written
+            thread = threading.Thread(target=lambda: during_write.append(cache.get("a")))
+            thread.start()
+            thread.join(timeout=10)
+        save(obj, path)
+
+    monkeypatch.setattr(torch, "save", save_and_get)
+    cache.put("a", _volume(0))
+    cache.put("b", _volume(1))
+
+    # "a" was taken back into memory during its write, evicting "b" to disk
+    assert torch.equal(during_write[0], _volume(0))
+    assert cache.stats().num_entries == 1 and "a" in cache
+    assert cache.stats().disk_bytes == 1024 and "b" in cache
+    assert len(list(tmp_path.iterdir())) == 1
+    assert torch.equal(cache.get("b"), _volume(1))
+
+
+def test_serie_uses_volume_cache(dicom_series):
+    cache = get_volume_cache()
+    serie = Serie(dicom_series, file_type="dicom")
+    key = serie._volume_key
+
+    # The cached volume has a single channel
+    volume = serie.get_volume(num_chan=1)
+    hits = cache.stats().hits
+    assert serie.get_volume(num_chan=1) is volume
+    assert cache.stats().hits == hits + 1
+    assert serie.get_volume().data_ptr() == volume.data_ptr()
+
+    serie.drop_volume()
+    assert key not in cache
+    assert torch.equal(serie.get_volume(num_chan=1), volume)
+
+    del serie, volume
+    gc.collect()
+    assert key not in cache
@@ -0,0 +1,68 @@
+import argparse
+import hashlib
+
+import torch
+
+from sybil import Serie, Sybil
+from sybil.models.sybil import SybilNet
+from sybil.utils.logging_utils import get_logger
+
+
+class VolumeSerie(Serie):
+    """Serie with a preloaded volume, so tests don't need any image files."""
+
+    def __init__(self, volume):
+        self._volume = volume
+
+    def get_volume(self, num_chan=3):
+        return self._volume.expand(-1, num_chan, -1, -1, -1)
+
+    def fingerprint(self):
+        return hashlib.md5(self._volume.numpy().tobytes()).hexdigest()
+
+
+class ToyNet(torch.nn.Module):
+    """Stand-in for SybilNet producing the same output keys."""
+
+    def __init__(self, max_followup=6):
+        super().__init__()
+        self.fc = torch.nn.Linear(1, max_followup)
+
+    def forward(self, x):
+        hidden = x.flatten(2).mean(-1)
+        pooled = hidden.mean(1, keepdim=True)
+        return {
+            "logit": self.fc(pooled),
+            "hidden": hidden,
+            "image_attention_1": x[:, 0].flatten(2),
+            "volume_attention_1": x[:, 0].flatten(2).mean(-1),
+        }
+
+
+def write_checkpoint(path, seed=0):
+    """Save a randomly initialized SybilNet in the layout of the released checkpoints."""
+    torch.manual_seed(seed)
+    args = argparse.Namespace(dropout=0.1, max_followup=6, censoring_distribution={})
+    net = SybilNet(args, pretrained_backbone=False)
+    state_dict = {f"model.{k}": v for k, v in net.state_dict().items()}
+    torch.save({"args": args, "state_dict": state_dict}, path)
+    return net
+
+
+def toy_sybil(num_members=2):
+    """Sybil with an ensemble of ToyNet, skipping the checkpoint loading."""
+    model = Sybil.__new__(Sybil)
+    model._logger = get_logger()
+    model.device = torch.device("cpu")
+    model._device_flexible = False
+    model.calibrator = None
+    model.fuse_input_channels = False
+    model.backend = "torch"
+    model.quantize = None
+    model.precision = "fp32"
+    model.compile_mode = None
+    model.max_encoder_memory = None
+    model.result_cache = None
+    torch.manual_seed(0)
+    model.ensemble = torch.nn.ModuleList([ToyNet().eval() for _ in range(num_members)])
+    return model